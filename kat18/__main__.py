@@ -1,14 +1,23 @@
+import time
+
+# Before anything else is imported, so the startup report includes imports.
+started_at = time.perf_counter()
+
 import logging
 import sys
 
 import kat18.client
+import kat18.workers
 
 
-logging.basicConfig(level='INFO')
-
+# Worker processes import this module too, so only run as the main module.
+if __name__ == '__main__':
+    logging.basicConfig(level='INFO')
 
-if len(sys.argv) != 2:
-    print(f'USAGE: {sys.argv[0]} config-path')
-    exit(1)
-else:
-    kat18.client.KatBot(sys.argv[1]).run()
+    if len(sys.argv) not in (2, 3):
+        print(f'USAGE: {sys.argv[0]} config-path [api-base]')
+        exit(1)
+    elif kat18.workers.worker_count(sys.argv[1]) > 1:
+        exit(kat18.workers.run(*sys.argv[1:]))
+    else:
+        kat18.client.make_bot(*sys.argv[1:], started_at=started_at).run()
@@ -4,6 +4,7 @@ import re
 import discord
 import discord.ext.commands as commands
 
+import kat18.paging as paging
 import kat18.util as util
 
 
@@ -63,7 +64,8 @@ class Admin:
             # command finishes execution.
             user = ctx.bot.get_user(id)
 
-            if ctx.guild is not None and user in ctx.guild.members:
+            if (ctx.guild is not None
+                    and ctx.bot.resolver.is_member(ctx.guild.id, id)):
                 user_strings.append(f'- {user.mention} `{user.id}`')
             else:
                 user_strings.append(f'- {user} `{user.id}`')
@@ -73,40 +75,134 @@ class Admin:
         util.confirm_operation(ctx)
         util.make_closeable(ctx, msg)
 
+    # Each guild is a field, and embeds can only be so long.
+    guilds_per_page = 10
+
     @get_group.command(
         name='guilds',
         aliases=['guild', 'server', 'servers'],
-        brief='Lists the guilds I am part of.'
+        brief='Lists the guilds I am part of.',
+        usage='[guild ID | members>=N | name prefix]...'
     )
-    async def get_guilds(self, ctx):
-        """Lists all guilds I am currently connected to."""
-        embed = discord.Embed(
-            title=f'{ctx.bot.user} is currently a member in',
-            color=0xFFFF00
-        )
+    async def get_guilds(self, ctx, *filters):
+        """
+        Lists the guilds I am currently connected to, a page at a time.
+        React to turn the pages. Filter them with any of:
 
-        for guild in ctx.bot.guilds:
-            d = [
-                f'**ID**: `{guild.id}`',
-                f'**Text Channels**: {len(guild.text_channels)}',
-                f'**Voice Channels**: {len(guild.voice_channels)}',
-                f'**Categories**: {len(guild.categories)}',
-                f'**Members**: {len(guild.members)}',
-                f'**MFA**: {"2FA" if guild.mfa_level else "None"}',
-                f'**Verif\'n Level**: {guild.verification_level}',
-                f'**Content Filter**: {guild.explicit_content_filter}',
-                f'**Owner**: {guild.owner} `{guild.owner.id}`'
-            ]
-
-            if len(embed.fields) == 0:
-                embed.set_thumbnail(url=guild.icon_url)
+        - a guild ID, to only show that guild;
+        - members>=N, to only show guilds with at least N members;
+        - anything else, to only show guilds with names starting with it.
+        """
+        guild_id = None
+        min_members = 0
+        name_words = []
+        for f in filters:
+            if f.isdigit():
+                guild_id = int(f)
+            elif f.startswith('members>='):
+                count = f[len('members>='):]
+                if not count.isdigit():
+                    raise ValueError(f'{count} is not a member count.')
+                min_members = int(count)
+            else:
+                name_words.append(f)
+        name_prefix = ' '.join(name_words).casefold()
 
-            embed.add_field(
-                name=guild.name,
-                value='\n'.join(d),
-                inline=False
+        if guild_id is not None:
+            guild = ctx.bot.resolver.guild(guild_id)
+            guilds = [guild] if guild is not None else []
+        else:
+            guilds = ctx.bot.guilds
+
+        stats = ctx.bot.guild_stats
+
+        # Only the guilds on the pages that are asked for get looked at.
+        matches = (
+            guild for guild in guilds
+            if stats.summary(guild).members >= min_members
+            and guild.name.casefold().startswith(name_prefix)
+        )
+
+        def render(page, index, page_count):
+            embed = discord.Embed(
+                title=f'{ctx.bot.user} is currently a member in',
+                color=0xFFFF00
             )
 
+            if index == 0 and guild_id is None:
+                totals = stats.totals()
+                lines = [f'**Total**: {totals["guilds"]} guilds, '
+                         f'{totals["members"]} members']
+                if ctx.bot.sharded:
+                    shards = stats.shard_totals()
+                    lines.extend(
+                        f'**Shard {shard_id}**: '
+                        f'{shards.get(shard_id, (0, 0))[0]} guilds, '
+                        f'{latency * 1000:.0f}ms'
+                        for shard_id, latency in ctx.bot.latencies
+                    )
+                embed.description = '\n'.join(lines)
+
+            for guild in page:
+                summary = stats.summary(guild)
+                d = [
+                    f'**ID**: `{summary.id}`',
+                    f'**Text Channels**: {summary.text_channels}',
+                    f'**Voice Channels**: {summary.voice_channels}',
+                    f'**Categories**: {summary.categories}',
+                    f'**Members**: {summary.members}',
+                    f'**MFA**: {"2FA" if summary.mfa_level else "None"}',
+                    f'**Verif\'n Level**: {summary.verification_level}',
+                    f'**Content Filter**: '
+                    f'{summary.explicit_content_filter}',
+                    f'**Owner**: {ctx.bot.get_user(summary.owner_id)} '
+                    f'`{summary.owner_id}`'
+                ]
+
+                if ctx.bot.sharded:
+                    d.insert(1, f'**Shard**: {summary.shard_id}')
+
+                if len(embed.fields) == 0:
+                    embed.set_thumbnail(url=summary.icon_url)
+
+                embed.add_field(
+                    name=summary.name,
+                    value='\n'.join(d),
+                    inline=False
+                )
+
+            if not page:
+                embed.add_field(name='No guilds', value='Nothing matched.')
+
+            embed.set_footer(
+                text=f'Page {index + 1} of {page_count or "?"}')
+            return embed
+
+        await paging.send_pages(
+            ctx, paging.LazyPages(matches, self.guilds_per_page, render))
+        util.confirm_operation(ctx)
+
+    @get_group.command(
+        name='outbox',
+        aliases=['backlog', 'queue'],
+        brief='Lists the REST calls I have queued, by route.'
+    )
+    async def get_outbox(self, ctx):
+        """
+        Lists how many reactions, deletes and replies are waiting to be sent
+        on each route.
+        """
+        backlog = ctx.bot.outbox.backlog()
+
+        embed = discord.Embed(
+            title='My outbox',
+            description='\n'.join(
+                f'**{route}**: {count}'
+                for route, count in sorted(backlog.items())
+            ) or 'Nothing is queued.',
+            color=0x00FF7F
+        )
+
         msg = await ctx.send(embed=embed)
         util.confirm_operation(ctx)
         util.make_closeable(ctx, msg)
@@ -179,8 +275,6 @@ class Admin:
         This blacklist exists to ensure that the bot does not react in
         inappropriate situations.
         """
-        blacklist = ctx.bot.dont_react_in.get()
-
         embed = discord.Embed(
             title='Channels I am not allowed to react in',
             description='These are the channels I am not allowed to react to '
@@ -188,23 +282,15 @@ class Admin:
             color=0xB000B5
         )
 
-        # Guild is a string. JSON standard says we can't use ints as keys.
-        # Bloody stupid.
-        for guild, channels in blacklist.items():
-            guild_obj = discord.utils.find(
-                lambda g: str(g.id) == guild,
-                ctx.bot.guilds
-            )
+        for guild_id, channels in ctx.bot.dont_react_in.items():
+            guild_obj = ctx.bot.resolver.guild(guild_id)
 
             if guild_obj is None:
                 continue
 
             channel_objs = []
             for channel in channels:
-                chan_obj = discord.utils.find(
-                    lambda c: c.id == channel,
-                    guild_obj.text_channels
-                )
+                chan_obj = ctx.bot.resolver.channel(channel)
 
                 if chan_obj is None:
                     continue
@@ -245,6 +331,11 @@ class Admin:
             else:
                 patterns.append(f'`{pattern.pattern}` (regex)')
 
+            if pattern.pattern in ctx.bot.triggers.quarantined:
+                patterns[-1] += ' (quarantined, too slow)'
+            elif pattern.pattern in ctx.bot.triggers.unscreened:
+                patterns[-1] += ' (waiting to be screened)'
+
         embed = discord.Embed(
             title=f'Things I react to',
             description='\n'.join(
@@ -287,18 +378,13 @@ class Admin:
         brief='Authorizes a user to talk on my behalf.'
     )
     async def add_commander(self, ctx, *, commander: commands.MemberConverter):
-        commanders = ctx.bot.commanders.get()
-
         if commander == ctx.bot.user:
             raise NameError('I am not going to command _myself_...')
         elif commander.bot:
             raise NameError('I am not going to be controlled by a lowlife bot!')
-        elif commander.id in commanders:
+        elif not await ctx.bot.commanders.add(commander.id):
             raise NameError('That name is already in my list. Tough luck.')
         else:
-            commanders.append(commander.id)
-            # Commit to disk
-            await ctx.bot.commanders.set(commanders)
             util.confirm_operation(ctx)
 
     @commands.check(commands.guild_only())
@@ -323,12 +409,9 @@ class Admin:
     )
     async def add_pattern(self, ctx, *, phrase: str):
         """Compiles the given regular expression."""
-        regex = re.compile(phrase, flags=re.I)
-        # Will assert that this compiled? Maybe?
-        regex.match('')
-        patterns = ctx.bot.patterns
-        patterns.append(regex)
-        await ctx.bot.set_pattern_list(patterns)
+        # Raises re.error if it does not compile.
+        if not await ctx.bot.add_pattern(phrase):
+            raise ValueError('I already react to that.')
         util.confirm_operation(ctx)
 
     @add_group.command(
@@ -341,11 +424,8 @@ class Admin:
         # Hacky, but if I put brackets around said phrase... it should make
         # sure I detect that this is a command added word, then in the list
         # we don't have to show it in backticks. Hacky work around. Sue me, etc.
-        regex = re.compile('\\b(%s)\\b' % phrase, flags=re.I | re.U | re.M)
-        # Will assert that this compiled? Maybe?
-        patterns = ctx.bot.patterns
-        patterns.append(regex)
-        await ctx.bot.set_pattern_list(patterns)
+        if not await ctx.bot.add_pattern('\\b(%s)\\b' % phrase):
+            raise ValueError('I already react to that.')
         util.confirm_operation(ctx)
 
     @commands.check(commands.guild_only())
@@ -358,21 +438,10 @@ class Admin:
         if channel is None:
             channel = ctx.channel
 
-        guild_id = str(ctx.guild.id)
-        chan_id = channel.id
+        if not await ctx.bot.dont_react_in.add(ctx.guild.id, channel.id):
+            raise ValueError(f'{channel.name} is already blacklisted on '
+                             'this server.')
 
-        blacklist = ctx.bot.dont_react_in.get()
-
-        if guild_id in blacklist:
-            if chan_id in blacklist[guild_id]:
-                raise ValueError(f'{channel.name} is already blacklisted on '
-                                 'this server.')
-            else:
-                blacklist[guild_id].append(chan_id)
-        else:
-            blacklist[guild_id] = [chan_id]
-
-        await ctx.bot.dont_react_in.set(blacklist)
         util.confirm_operation(ctx)
 
     """
@@ -389,10 +458,7 @@ class Admin:
         Removes my user from a given server.
         """
         # Try to find the guild.
-        guild_obj = discord.utils.find(
-            lambda g: g.name.lower() == guild.lower() or g.id == guild,
-            ctx.bot.guilds
-        )
+        guild_obj = ctx.bot.resolver.find_guild(guild)
 
         if guild_obj is None:
             raise ValueError('Could not find a guild with that name or ID.')
@@ -415,10 +481,9 @@ class Admin:
         # Don't allow removal of the bot owner.
         if await ctx.bot.is_owner(member):
             raise PermissionError('You cannot remove the bot owner.')
+        elif not await ctx.bot.commanders.remove(member.id):
+            raise ValueError(f'{member} is not a commander anyway.')
         else:
-            commanders = ctx.bot.commanders.get()
-            commanders.remove(member.id)
-            await ctx.bot.commanders.set(commanders)
             util.confirm_operation(ctx)
 
     @remove_group.command(
@@ -430,23 +495,16 @@ class Admin:
         """
         Removes the given pattern from the list of patterns I react to.
         """
-        regex = discord.utils.find(
-            lambda r: r.pattern == pattern,
-            ctx.bot.patterns
-        )
+        source = ctx.bot.triggers.get(pattern)
 
-        if regex is None:
-            regex = discord.utils.find(
-                lambda r: r.pattern.lower() == f'\\b({pattern.lower()})\\b',
-                ctx.bot.patterns
-            )
+        if source is None:
+            source = ctx.bot.triggers.get(f'\\b({pattern})\\b',
+                                          ignore_case=True)
 
-        if regex is None:
+        if source is None:
             raise ValueError('Could not find that pattern.')
         else:
-            patterns = ctx.bot.patterns
-            patterns.remove(regex)
-            await ctx.bot.set_pattern_list(patterns)
+            await ctx.bot.remove_pattern(source)
             util.confirm_operation(ctx)
 
     @remove_group.command(
@@ -475,21 +533,10 @@ class Admin:
         if channel is None:
             channel = ctx.channel
 
-        guild_id = str(ctx.guild.id)
-        chan_id = channel.id
-
-        blacklist = ctx.bot.dont_react_in.get()
-
-        if guild_id not in blacklist:
-            if chan_id not in blacklist[guild_id]:
-                raise ValueError(f'{channel.name} is not blacklisted on '
-                                 'this server anyway.')
-            else:
-                blacklist[guild_id].remove(chan_id)
-        else:
-            blacklist.pop(guild_id)
+        if not await ctx.bot.dont_react_in.remove(ctx.guild.id, channel.id):
+            raise ValueError(f'{channel.name} is not blacklisted on '
+                             'this server anyway.')
 
-        await ctx.bot.dont_react_in.set(blacklist)
         util.confirm_operation(ctx)
 
     @util.command(
@@ -7,19 +7,32 @@ work-around class to implement globally in the class in client.py
 """
 import concurrent.futures as futures
 import copy
+import hashlib
 import io
 import json
 import os
 import time
+import types
 
 import asyncio
 import traceback
 import typing
 
+import kat18.metrics as metrics
+
 
 io_tpe = futures.ThreadPoolExecutor(max_workers=2,
                                     thread_name_prefix='IO worker')
 
+io_wait_seconds = metrics.Histogram(
+    'kat18_io_wait_seconds',
+    'Time file operations spent waiting for the file lock and an IO thread.',
+    ['file'])
+io_seconds = metrics.Histogram(
+    'kat18_io_seconds',
+    'Time file operations spent doing IO on an IO thread.',
+    ['file'])
+
 
 class AsyncFile:
     """Provides an interface to read and write to/from the file."""
@@ -54,23 +67,26 @@ class AsyncFile:
                 use the default loop.
         :return: the result of executing the function that was passed.
         """
-        with await self._lock:
+        submitted = time.perf_counter()
+
+        async with self._lock:
             # We ensure to open the file on the same thread we are
             # executing the function on, as I am unsure if the open()
             # method provides any kind of thread safety.
             def do_io(_func, file_name, _mode):
+                started = time.perf_counter()
                 # noinspection PyBroadException
                 try:
                     with open(file_name, mode=_mode) as fp:
-                        return _func(fp)
+                        return _func(fp), started
                 except BaseException:
                     traceback.print_exc()
-                    return None
+                    return None, started
 
             if loop is None:
                 loop = asyncio.get_event_loop()
 
-            return await loop.run_in_executor(
+            result, started = await loop.run_in_executor(
                 io_tpe,
                 do_io,
                 func,
@@ -78,6 +94,330 @@ class AsyncFile:
                 mode
             )
 
+        label = os.path.basename(self.file_name)
+        io_wait_seconds.observe(started - submitted, file=label)
+        io_seconds.observe(time.perf_counter() - started, file=label)
+        return result
+
+
+def freeze(value):
+    """
+    Converts a JSON-like value into an immutable equivalent. Lists become
+    tuples, sets become frozensets and dicts become read-only mappings.
+    """
+    if isinstance(value, dict):
+        return types.MappingProxyType({k: freeze(v) for k, v in value.items()})
+    elif isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(freeze(v) for v in value)
+    else:
+        return value
+
+def diff(old, new, unique=False) -> typing.List[list]:
+    """
+    Works out a list of delta records that turn the old value into the new
+    value when given to :func:`patch`. Records are JSON lists of the form:
+
+    - ``['put', key, value]`` and ``['pop', key]`` for changes to a dict.
+    - ``['append', item]`` and ``['remove', item]`` for changes to a list.
+      Removal removes the first equal item.
+    - ``['add', item]`` instead of append for lists used as sets, which only
+      appends the item if an equal one is not there already.
+    - ``['replace', value]`` for anything else.
+
+    :param unique: True if the value is a list that never holds the same
+        item twice. Applying the records to a value someone else has added
+        the same item to then leaves one copy of it, not two.
+    """
+    if old == new:
+        return []
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        records = [['pop', k] for k in old if k not in new]
+        records.extend(['put', k, v] for k, v in new.items()
+                       if k not in old or old[k] != v)
+        return records
+
+    if isinstance(old, list) and isinstance(new, list):
+        # Assume the new list is what is left of the old list after removing
+        # some items, with some more appended to the end. This covers every
+        # edit we make. If it does not hold, then we just replace the list.
+        records, j = [], 0
+        for item in old:
+            if j < len(new) and new[j] == item:
+                j += 1
+            else:
+                records.append(['remove', item])
+        records.extend(['add' if unique else 'append', item]
+                       for item in new[j:])
+
+        if len(records) <= len(new) and patch(old, records) == new:
+            return records
+
+    return [['replace', new]]
+
+
+def patch(value, records: typing.Iterable[list]):
+    """
+    Applies delta records made by :func:`diff` to a copy of the value, and
+    returns the result.
+    """
+    value = copy.deepcopy(value)
+    for op, *args in records:
+        if op == 'put':
+            value[args[0]] = args[1]
+        elif op == 'pop':
+            value.pop(args[0], None)
+        elif op == 'append':
+            value.append(args[0])
+        elif op == 'add':
+            if args[0] not in value:
+                value.append(args[0])
+        elif op == 'remove':
+            if args[0] in value:
+                value.remove(args[0])
+        elif op == 'replace':
+            value = args[0]
+        else:
+            raise ValueError(f'Unknown journal record {op!r}')
+    return value
+
+
+class JsonFileStorage:
+    """
+    Stores a value as a single JSON document that is completely rewritten
+    every time the value changes.
+    """
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._async_file = AsyncFile(file_name)
+        self._stamp = None
+
+    @property
+    def file_name(self):
+        """Gets the file name."""
+        return self._file_name
+
+    @staticmethod
+    def _stat_file(file_name):
+        try:
+            st = os.stat(file_name)
+            return st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            return None
+
+    def _stat(self):
+        """Gets something that changes whenever the file does."""
+        return self._stat_file(self.file_name)
+
+    def modified(self) -> bool:
+        """
+        True if something other than us has changed the file since we last
+        read or wrote it.
+        """
+        return self._stat() != self._stamp
+
+    def load(self, default_value):
+        """
+        Loads the value, creating the file with the default value first if it
+        does not exist. Yes, this blocks.
+        """
+        if not os.path.exists(self.file_name):
+            with open(self.file_name, 'w') as f:
+                json.dump(obj=default_value, fp=f, indent=' ' * 4)
+
+        with open(self.file_name) as f:
+            self._stamp = self._stat()
+            return json.load(f)
+
+    async def read(self):
+        """Rereads the value from the file."""
+        def read(fp):
+            self._stamp = self._stat()
+            return json.load(fp=fp)
+        return await self._async_file.execute(func=read, mode='r')
+
+    async def write(self, old_value, new_value, unique=False):
+        """Serializes the given value to the JSON file by overwriting."""
+        sfp = io.StringIO()
+        json.dump(obj=new_value, fp=sfp, indent=' ' * 4)
+        # Seek to the start of the stringio fp.
+        sfp.seek(0)
+
+        def write(fp):
+            fp.write(sfp.read())
+
+        await self._async_file.execute(func=write, mode='w')
+        self._stamp = self._stat()
+
+
+class JournaledStorage(JsonFileStorage):
+    """
+    Stores a value as a JSON snapshot, plus an append-only journal of delta
+    records next to it. Each change only appends the records that describe
+    it, so the cost of a write depends on the size of the change rather than
+    the size of the value. Once the journal grows past ``compact_after`` bytes,
+    it is folded back into the snapshot in the background.
+
+    The snapshot is the same JSON file :class:`JsonFileStorage` uses, so the
+    two are interchangeable. The first line of the journal holds a digest of
+    the snapshot it applies to. The new snapshot is swapped in before the
+    journal is reset, and both swaps are atomic renames. If we crash in
+    between, then the digest of the old journal no longer matches, and it is
+    ignored rather than being applied twice. This also means editing the
+    snapshot by hand discards any journal left behind.
+    """
+    def __init__(self, file_name, compact_after=64 * 1024):
+        super().__init__(file_name)
+        self._journal_name = file_name + '.journal'
+        self._journal = AsyncFile(self._journal_name)
+        self.compact_after = compact_after
+        self._digest = None
+        self._journal_size = 0
+        self._compaction = None
+
+    @property
+    def journal_name(self):
+        """Gets the journal file name."""
+        return self._journal_name
+
+    @staticmethod
+    def _digest_of(data: bytes) -> str:
+        return hashlib.sha1(data).hexdigest()
+
+    def _stat(self):
+        return super()._stat(), self._stat_file(self.journal_name)
+
+    @staticmethod
+    def _parse_line(line: bytes):
+        """Parses a journal line, or gets None if it is torn or corrupt."""
+        if not line.endswith(b'\n'):
+            return None
+        try:
+            return json.loads(line.decode())
+        except ValueError:
+            return None
+
+    def _load_blocking(self):
+        """
+        Reads the snapshot and replays the journal. Returns the value, the
+        snapshot digest, and the number of valid journal bytes.
+        """
+        with open(self.file_name, 'rb') as f:
+            data = f.read()
+        digest = self._digest_of(data)
+        value = json.loads(data.decode())
+
+        try:
+            with open(self.journal_name, 'rb') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return value, digest, 0
+
+        if not lines or self._parse_line(lines[0]) != {'snapshot': digest}:
+            # Stale journal for a snapshot that was since replaced.
+            return value, digest, 0
+
+        size = len(lines[0])
+        records = []
+        for line in lines[1:]:
+            # A torn write at the end of the journal has no newline. Anything
+            # from the first bad line on is ignored, and overwritten by the
+            # next write.
+            record = self._parse_line(line)
+            if record is None:
+                break
+            records.append(record)
+            size += len(line)
+
+        return patch(value, records), digest, size
+
+    def load(self, default_value):
+        super().load(default_value)
+        value, self._digest, self._journal_size = self._load_blocking()
+        self._stamp = self._stat()
+        return value
+
+    async def read(self):
+        # Hold the journal lock so we never see a half-finished compaction.
+        async with self._journal._lock:
+            value, self._digest, self._journal_size = (
+                await asyncio.get_event_loop().run_in_executor(
+                    io_tpe, self._load_blocking))
+            self._stamp = self._stat()
+        return value
+
+    async def write(self, old_value, new_value, unique=False):
+        """Appends the changes between the two values to the journal."""
+        records = diff(old_value, new_value, unique)
+        if not records:
+            return
+
+        lines = ''.join(json.dumps(r, separators=(',', ':')) + '\n'
+                        for r in records).encode()
+
+        def append(fp):
+            # This runs under the journal lock, so the size and digest are
+            # those left by any compaction we had to wait for.
+            offset = self._journal_size
+            data = lines
+            if offset == 0:
+                # New journal, so it needs to say which snapshot it applies
+                # to.
+                header = json.dumps({'snapshot': self._digest}) + '\n'
+                data = header.encode() + lines
+
+            # Anything after the records we know are good is left over from
+            # a torn write, so cut it off. The file is opened for appending,
+            # so the records then go straight after the good ones.
+            fp.truncate(offset)
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+            self._journal_size = offset + len(data)
+            return True
+
+        if not await self._journal.execute(func=append, mode='ab'):
+            # The records were not written, so the caller must not treat
+            # them as persisted, or later ones would be journaled against
+            # a value the file does not have.
+            raise OSError(f'Could not append to {self.journal_name}')
+        self._stamp = self._stat()
+
+        if (self._journal_size > self.compact_after
+                and self._compaction is None):
+            self._compaction = asyncio.ensure_future(self.compact())
+
+    async def compact(self):
+        """
+        Folds the journal into a new snapshot. This holds the journal lock,
+        so any writes made in the meantime wait for it to finish.
+        """
+        def do_compact(_):
+            value, *_ = self._load_blocking()
+            data = json.dumps(value, indent=' ' * 4).encode()
+            digest = self._digest_of(data)
+            header = (json.dumps({'snapshot': digest}) + '\n').encode()
+
+            for name, content in ((self.file_name, data),
+                                  (self.journal_name, header)):
+                with open(name + '.tmp', 'wb') as f:
+                    f.write(content)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(name + '.tmp', name)
+
+            # Still under the lock, so writes waiting on us see these.
+            self._digest, self._journal_size = digest, len(header)
+            return True
+
+        try:
+            if await self._journal.execute(func=do_compact, mode='rb'):
+                self._stamp = self._stat()
+        finally:
+            self._compaction = None
+
 
 class AsyncJsonValue:
     """
@@ -88,25 +428,121 @@ class AsyncJsonValue:
     reads the file in without dispatching to any thread pool executor. This is
     done primarily because if defined in a constructor, event loops may not
     yet be initialised.
+
+    How the value is laid out on disk is down to the ``storage_type``, which
+    is called with the file name. By default, this is :class:`JsonFileStorage`.
+
+    If ``flush_delay`` is given, then the value is written behind: setting it
+    takes effect in memory straight away, and every change made within the
+    next ``flush_delay`` seconds is written out together in one go. Call
+    :meth:`flush` if you need the value on disk before carrying on.
+
+    If ``defer_load`` is True, then nothing is read until :meth:`load` is
+    awaited, and until then the value is the default value.
     """
-    def __init__(self, file_name, default_value):
-        self.__async_file = AsyncFile(file_name)
+    #: True if the value is a list that never holds the same item twice.
+    #: Storage that merges changes then merges items added at once by two
+    #: writers as one item.
+    unique_items = False
 
-        # Yes, this blocks.
-        if not os.path.exists(file_name):
-            with open(file_name, 'w') as f:
-                json.dump(obj=default_value, fp=f, indent=' ' * 4)
+    def __init__(self, file_name, default_value,
+                 storage_type=JsonFileStorage, flush_delay=None,
+                 defer_load=False):
+        self.__storage = storage_type(file_name)
+        self.__default_value = default_value
+        self.flush_delay = flush_delay
+        self.__flush_lock = asyncio.Lock()
+        self.__pending_flush = None
+        self.__loaded = not defer_load
+        if defer_load:
+            self.__update_cache(default_value)
+        else:
+            self.__update_cache(self.__storage.load(default_value))
+        # The value as it last was written out.
+        self.__persisted = self.__cached
+
+    @property
+    def loaded(self):
+        """False until the value has been read, if loading was deferred."""
+        return self.__loaded
+
+    async def load(self):
+        """
+        Reads the value on an IO thread, if loading was deferred and it has
+        not been read yet.
+        """
+        if self.__loaded:
+            return
+
+        value = await asyncio.get_event_loop().run_in_executor(
+            io_tpe, self.__storage.load, self.__default_value)
+        self.__persisted = value
+        self.__update_cache(value)
+        self.__loaded = True
 
-        with open(file_name) as f:
-            self.__cached = json.load(f)
+    def __update_cache(self, value):
+        self.__cached = value
+        # Frozen once per change, then shared between every reader.
+        self.__frozen = freeze(value)
+        # Built lazily for membership tests.
+        self.__members = None
+        self._reindex(self.__frozen)
+
+    def _reindex(self, snapshot):
+        """
+        Called with the new snapshot whenever the value changes. Subclasses
+        can override this to maintain their own indexes over the value.
+        """
+        pass
 
     def get(self):
-        """Gets the value."""
+        """
+        Gets a mutable deep copy of the value. Only use this if you intend
+        to edit the value and then set it again, otherwise use
+        :meth:`snapshot`.
+        """
         return copy.deepcopy(self.__cached)
 
+    def snapshot(self):
+        """
+        Gets an immutable snapshot of the value. This is shared between all
+        callers, so costs nothing to get regardless of the size of the value.
+        """
+        return self.__frozen
+
     async def set(self, value):
-        """Sets the value."""
-        self.__cached = await self.__serialize(value)
+        """
+        Sets the value. If we are writing behind, this only schedules the
+        write, otherwise this waits for the write to finish.
+        """
+        if self.flush_delay is None:
+            self.__update_cache(await self.__serialize(value))
+        else:
+            self.__update_cache(value)
+            self.__schedule_flush()
+
+    @property
+    def dirty(self):
+        """True if there are changes that have not been written out yet."""
+        return self.__cached is not self.__persisted
+
+    async def flush(self):
+        """Writes out any changes that have not been written yet."""
+        if self.__pending_flush is not None:
+            self.__pending_flush.cancel()
+            self.__pending_flush = None
+
+        if self.dirty:
+            await self.__serialize(self.__cached)
+
+    def __schedule_flush(self):
+        # There is only ever one write pending per value. Anything set before
+        # it fires just gets included in it.
+        if self.__pending_flush is None:
+            self.__pending_flush = asyncio.get_event_loop().call_later(
+                self.flush_delay,
+                lambda: asyncio.ensure_future(self.flush())
+            )
 
     def set_blocking(self, value):
         """Sets the value, but blocks until it is complete."""
@@ -129,32 +565,60 @@ class AsyncJsonValue:
         return self.__cached
 
     def __iter__(self):
-        return self.get().__iter__()
+        return self.__frozen.__iter__()
 
     def __contains__(self, item):
-        return self.get().__contains__(item)
+        if self.__members is None:
+            try:
+                self.__members = frozenset(self.__frozen)
+            except TypeError:
+                # Not hashable, so we cannot index it.
+                return self.__frozen.__contains__(item)
+        return self.__members.__contains__(item)
 
     def __eq__(self, other):
-        return self.get().__eq__(other)
+        if isinstance(other, AsyncJsonValue):
+            other = other.cached_value
+        return self.__cached.__eq__(other)
+
+    @property
+    def storage(self):
+        """Gets the storage the value is persisted with."""
+        return self.__storage
 
     async def __serialize(self, value):
-        """Serializes the given value to the JSON file by overwriting."""
-        sfp = io.StringIO()
-        json.dump(obj=value, fp=sfp, indent=' ' * 4)
-        # Seek to the start of the stringio fp.
-        sfp.seek(0)
+        """Persists the given value."""
+        # Storage may write the difference from what was last written, so
+        # only let one write work that out at once.
+        async with self.__flush_lock:
+            await self.__storage.write(self.__persisted, value,
+                                       unique=self.unique_items)
+            self.__persisted = value
+        return value
 
-        def write(fp):
-            fp.write(sfp.read())
+    async def reload(self) -> bool:
+        """
+        Rereads the value if something else has changed it since we last
+        read or wrote it. Changes that have not been flushed yet take
+        priority, so nothing is reread while there are any.
 
-        await self.__async_file.execute(func=write, mode='w')
-        return value
+        :return: True if the value was reread.
+        """
+        if self.dirty or not self.__storage.modified():
+            return False
+
+        async with self.__flush_lock:
+            value = await self.__storage.read()
+            if value is None:
+                # The read failed. The traceback has already been printed.
+                return False
+            self.__persisted = value
+            self.__update_cache(value)
+        return True
 
     def read_from_file(self) -> typing.Coroutine:
         """
         Rereads from the file. This returns a coroutine that must be
         awaited or ensured as a future.
         """
-        def read(fp):
-            return json.load(fp=fp)
-        return self.__async_file.execute(func=read, mode='r')
+        return self.__storage.read()
@@ -1,38 +1,127 @@
 """
 Class that implements the Bot class.
 """
+import collections
 import copy
 import json
 import os
-import re
+import time
 
 import asyncio
 
-import discord.utils as dutils
 import discord.ext.commands as commands
+import discord.http
 
 import kat18.aio as asyncjson
+import kat18.emojis as emojis
+import kat18.guildstats as guildstats
+import kat18.metrics as metrics
+import kat18.outbox as outbox
+import kat18.paging as paging
+import kat18.pipeline as pipeline
+import kat18.resolver as resolver
+import kat18.state as state
+import kat18.triggers as triggers
 import kat18.util as util
 
+# kat18.sqlite, kat18.ipc and kat18.watch are only imported where they are
+# chosen, so that starting up does not pay for the ones that go unused.
+
 
 extensions = {
     'kat18.talk',
     'kat18.presence',
-    'kat18.admin',
     'kat18.reacting',
     'kat18.version'
 }
 
+# Rarely used, so these are only loaded the first time a command is not
+# found, or help is asked for.
+lazy_extensions = {
+    'kat18.admin',
+}
+
+
+rest_requests = metrics.Counter(
+    'kat18_rest_requests_total',
+    'REST calls made to Discord, and whether they succeeded.',
+    ['method', 'route', 'status'])
+startup_seconds = metrics.Gauge(
+    'kat18_startup_seconds',
+    'How long each phase of starting up took.',
+    ['phase'])
+rest_seconds = metrics.Histogram(
+    'kat18_rest_request_seconds',
+    'Time REST calls to Discord took, including waiting on rate limits.',
+    ['method', 'route'])
+
+
+# How state is laid out in the config directory. Chosen by the "storage" key
+# in config.json, which can also be "sqlite"; see state_storage.
+storage_types = {
+    # Each file is rewritten completely on each change.
+    'json': asyncjson.JsonFileStorage,
+    # Each change is appended to a journal that is periodically compacted.
+    'journal': asyncjson.JournaledStorage,
+}
 
-class KatBot(commands.Bot, util.Loggable):
-    """Kat bot client."""
 
-    def __init__(self, config_location):
+def state_storage(config, config_location):
+    """
+    Gets the storage type that state should be persisted with, as chosen by
+    "storage" in config.json, and the SQLite database if there is one.
+
+    :raises ValueError: if the storage type is not one we know.
+    """
+    storage = config.get('storage', 'json')
+    if storage == 'sqlite':
+        import kat18.sqlite as sqlite
+
+        # Existing JSON files get imported the first time they load.
+        database = sqlite.SqliteDatabase(
+            os.path.join(config_location, 'state.sqlite3'))
+        return database.storage, database
+    elif storage in storage_types:
+        return storage_types[storage], None
+    else:
+        raise ValueError(
+            f'Unknown storage {storage!r} in config.json. Expected sqlite, '
+            f'{", ".join(sorted(storage_types))}.')
+
+
+class KatBotMixin(util.Loggable):
+    """
+    Kat bot client, whichever way it connects to the gateway. This is mixed
+    into a discord.py bot class; see :class:`KatBot` and
+    :class:`ShardedKatBot`, and :func:`make_bot` to pick between them.
+    """
+    #: True if the guilds are split between several gateway connections.
+    sharded = False
+
+    def _client_options(self, config):
+        """Gets any extra options to pass to the discord.py client."""
+        return {}
+
+    def __init__(self, config_location, api_base=None, started_at=None,
+                 state_address=None):
         """
-        Init the client.
+        Init the client. State is not read until the bot is started.
 
         :param config_location:
+        :param api_base: the REST API to use rather than Discord's, such as
+            one served by tools.bench.fakediscord. Overrides "api_base" in
+            config.json.
+        :param started_at: the time.perf_counter() from before kat18 was
+            imported, to include the imports in the startup report.
+        :param state_address: where a kat18.ipc.StateServer is serving the
+            state, if this is one of several worker processes.
         """
+        # How long each phase of starting up took, in seconds.
+        self.startup_times = collections.OrderedDict()
+        self._phase_started = time.perf_counter()
+        if started_at is not None:
+            self.startup_times['import'] = self._phase_started - started_at
+
         self.config_location = config_location
 
         with open(os.path.join(config_location, 'config.json')) as fp:
@@ -40,67 +129,442 @@ class KatBot(commands.Bot, util.Loggable):
 
         self.config = config
 
+        api_base = api_base or config.get('api_base')
+        if api_base:
+            # The gateway URL is fetched from the API, so this moves both.
+            discord.http.Route.BASE = api_base.rstrip('/')
+
         super().__init__(command_prefix=self.when_mentioned,
-                         owner_id=config['owner_id'])
+                         owner_id=config['owner_id'],
+                         **self._client_options(config))
 
         self.logger.info(f'Add me to a guild at: {self.invite}')
 
-        self.commanders = asyncjson.AsyncJsonValue(
+        # Runs anything we want to do later, such as deleting messages.
+        self.scheduler = util.Scheduler()
+        util.scheduler_depth.func = lambda: self.scheduler.depth
+
+        self._instrument_http()
+
+        # Fire and forget REST calls, such as reactions and deletes, are
+        # queued here so that they do not hold up replies. Tune it with
+        # "outbox" in config.json.
+        self.outbox = outbox.Outbox(self, **config.get('outbox', {}))
+
+        @self.listen('on_message_delete')
+        async def forget_deleted_message(message):
+            self.outbox.message_gone(message.id)
+
+        # Serves the metrics at http://host:port/metrics if "metrics" is
+        # enabled in config.json.
+        metrics_config = config.get('metrics', {})
+        if metrics_config.get('enabled', False):
+            self.metrics_server = metrics.MetricsServer(
+                host=metrics_config.get('host', '127.0.0.1'),
+                port=metrics_config.get('port', 9418))
+            asyncio.ensure_future(self.metrics_server.start())
+        else:
+            self.metrics_server = None
+
+        # Messages that can be closed by reacting to them.
+        self.closeables = util.CloseDispatcher(self)
+        # Messages whose pages can be turned by reacting to them.
+        self.pages = paging.PageDispatcher(self)
+
+        # Cogs add their message handlers to this, rather than each
+        # listening to every message. See on_message.
+        self.messages = pipeline.MessagePipeline()
+        self.talk_prefix = f'{self.name.casefold()}:'
+        # Built once we know who we are. See command_prefixes.
+        self._command_prefixes = []
+        self._command_prefixes_for = None
+
+        # How each piece of state is persisted. If "flush_delay" is set, then
+        # changes are written behind, that many seconds later.
+        if state_address is None:
+            self.state_client = None
+            storage_type, self.database = state_storage(config,
+                                                        config_location)
+            flush_delay = config.get('flush_delay')
+        else:
+            # The state server persists the state, and tells us when another
+            # worker changes it. Our values are just a cache of it, and any
+            # write behind happens on the server.
+            import kat18.ipc as ipc
+
+            self.state_client = ipc.StateClient(state_address)
+            self.database = None
+            storage_type = self.state_client.storage
+            flush_delay = None
+
+            self._state_refresh = util.Coalescer(
+                self.scheduler, self.refresh_state, delay=0.1, max_delay=1)
+            self.state_client.add_listener(
+                lambda _: self._state_refresh.request())
+
+        # Watches the state files, so that changes made to them by hand are
+        # picked up without restarting. Started by load_state, and only if
+        # the state is kept in those files. Set "enabled" to false under
+        # "hot_reload" in config.json to turn this off.
+        self.hot_reload = {
+            'enabled': True,
+            'delay': 0.5,
+            'poll_interval': 2.0,
+            **config.get('hot_reload', {})
+        }
+        self.state_watcher = None
+
+        # Everything is read concurrently in load_state.
+        state_options = {
+            'storage_type': storage_type,
+            'flush_delay': flush_delay,
+            'defer_load': True,
+        }
+
+        self.commanders = state.CommanderSet(
             os.path.join(config_location, 'authorized_commanders.json'),
-            []
+            **state_options
         )
 
-        if self.owner_id not in self.commanders.cached_value:
-            new_list = self.commanders.get()
-            new_list.append(self.owner_id)
-            asyncio.wait(asyncio.gather(self.commanders.set(new_list)))
-
         # We write a wrapper around this.
         self._loaded_emojis_raw = asyncjson.AsyncJsonValue(
             os.path.join(config_location, 'react_emojis.json'),
-            []
+            [],
+            **state_options
         )
 
-        # On any chance that emojis that are available change, we recache
-        # the entire list asynchronously.
+        # Every emoji we can see, indexed so we can resolve the configured
+        # emojis quickly. This is updated a guild at a time from the events
+        # below, then we re-resolve the configured emojis against it.
         # Don't do it on_ready, as when guilds become available, they should
-        # trigger this event anyway.
-        # @self.listen('on_ready')
+        # trigger these events anyway.
+        #
+        # When we connect, every guild becomes available at once, so rather
+        # than recaching for each one, we wait for things to go quiet for a
+        # moment and then recache once.
+        self.emoji_index = emojis.EmojiIndex()
+
         @self.listen('on_guild_join')
         @self.listen('on_guild_available')
+        async def index_guild_emojis(guild):
+            self.emoji_index.add_guild(guild)
+            self._emoji_recache.request()
+
+        @self.listen('on_guild_remove')
         @self.listen('on_guild_unavailable')
+        async def unindex_guild_emojis(guild):
+            self.emoji_index.remove_guild(guild)
+            self._emoji_recache.request()
+
+        # Each shard that connects makes its guilds available, so this is
+        # just in case a shard comes back with none that changed.
+        @self.listen('on_shard_ready')
+        async def shard_ready(shard_id):
+            self.logger.info(f'Shard {shard_id} is ready')
+            self._emoji_recache.request()
+
         @self.listen('on_guild_emojis_update')
-        async def re_cache_emojis(*_, **__):
-            self.logger.info('Some event has triggered an emoji recache...')
+        async def update_guild_emojis(guild, before, after):
+            self.emoji_index.update_guild(guild, before, after)
+            self._emoji_recache.request()
+
+        # The numbers shown for each guild, kept up to date from the events
+        # rather than being worked out from the guild each time.
+        self.guild_stats = guildstats.GuildStats()
+        guildstats.guilds_total.func = lambda: len(self.guild_stats)
+        guildstats.members_total.func = (
+            lambda: self.guild_stats.totals()['members'])
+        guildstats.text_channels_total.func = (
+            lambda: self.guild_stats.totals()['text_channels'])
+        guildstats.voice_channels_total.func = (
+            lambda: self.guild_stats.totals()['voice_channels'])
+
+        # Guilds and channels by ID and name, for the admin commands. Guilds
+        # that go unavailable in an outage are dropped until they come back,
+        # as discord.py will hand us new objects for them when they do.
+        self.resolver = resolver.Resolver()
+
+        @self.listen('on_guild_join')
+        @self.listen('on_guild_available')
+        async def add_guild(guild):
+            self.guild_stats.add_guild(guild)
+            self.resolver.add_guild(guild)
+
+        @self.listen('on_guild_remove')
+        @self.listen('on_guild_unavailable')
+        async def remove_guild(guild):
+            self.guild_stats.remove_guild(guild)
+            self.resolver.remove_guild(guild)
+
+        @self.listen('on_guild_update')
+        async def update_guild(before, after):
+            self.guild_stats.update_guild(before, after)
+            self.resolver.update_guild(before, after)
+
+        @self.listen('on_member_join')
+        async def count_member_join(member):
+            self.guild_stats.member_joined(member)
+
+        @self.listen('on_member_remove')
+        async def count_member_remove(member):
+            self.guild_stats.member_removed(member)
+
+        @self.listen('on_guild_channel_create')
+        async def add_channel(channel):
+            self.guild_stats.channel_created(channel)
+            self.resolver.add_channel(channel)
+
+        @self.listen('on_guild_channel_update')
+        async def update_channel(before, after):
+            self.resolver.add_channel(after)
+
+        @self.listen('on_guild_channel_delete')
+        async def remove_channel(channel):
+            self.guild_stats.channel_deleted(channel)
+            self.resolver.remove_channel(channel)
+
+        async def re_cache_emojis():
             await self.reload_emoji_cache()
             emoji_count = len(self._loaded_emoji_cache)
             self.logger.info(
                 f'Recaching has finished. I have {emoji_count} emojis'
             )
 
+        self._emoji_recache = util.Coalescer(
+            self.scheduler,
+            re_cache_emojis,
+            delay=config.get('emoji_recache_delay', 1),
+            max_delay=10
+        )
+
         self._loaded_emoji_cache = []
 
         # We write a wrapper around this.
         self._patterns_raw = asyncjson.AsyncJsonValue(
             os.path.join(config_location, 'react_triggers.json'),
-            ['Kat']
+            ['Kat'],
+            **state_options
         )
 
-        # Load the pattern cache
-        asyncio.wait(asyncio.gather(self.recompile_patterns()))
+        # Patterns that took too long to match, so are not being used.
+        self._quarantined_raw = asyncjson.AsyncJsonValue(
+            os.path.join(config_location, 'quarantined_triggers.json'),
+            [],
+            **state_options
+        )
 
-        self._patterns_cache = []
+        # Sample messages that new regex patterns are timed against.
+        self._trigger_corpus = asyncjson.AsyncJsonValue(
+            os.path.join(config_location, 'trigger_corpus.json'),
+            triggers.DEFAULT_CORPUS,
+            **state_options
+        )
+
+        # The compiled patterns, keyed by their source. This also keeps a
+        # matcher for every pattern at once, which is rebuilt whenever the
+        # patterns change.
+        # This is filled in by load_state.
+        self.triggers = triggers.TriggerRegistry()
+        # Screens raw expressions that were loaded rather than added.
+        self._screening = None
+
+        # Keeps matching to a time budget for each message, and quarantines
+        # patterns that keep going over it. Tune with "trigger_limits" in
+        # config.json. Times are in seconds.
+        self.trigger_limits = {
+            'message_budget': 0.005,
+            'slow_match': 0.001,
+            'strikes': 3,
+            'strike_window': 60.0,
+            'screen_timeout': 2.0,
+            'screen_max': 0.01,
+            **config.get('trigger_limits', {})
+        }
+        self.trigger_guard = triggers.TriggerGuard(
+            self._quarantine_pattern,
+            budget=self.trigger_limits['message_budget'],
+            slow=self.trigger_limits['slow_match'],
+            strikes=self.trigger_limits['strikes'],
+            window=self.trigger_limits['strike_window']
+        )
 
         # Guild channels to not react in.
-        self.dont_react_in = asyncjson.AsyncJsonValue(
+        self.dont_react_in = state.ChannelBlacklist(
             os.path.join(config_location, 'blacklisted_channels.json'),
-            {}
+            **state_options
         )
 
+        self._state_values = [
+            self.commanders,
+            self._loaded_emojis_raw,
+            self._patterns_raw,
+            self._quarantined_raw,
+            self._trigger_corpus,
+            self.dont_react_in,
+        ]
+
         # Load the cogs.
         for ext in extensions:
             self.load_extension(ext)
 
+        self._lazy_extensions = set(lazy_extensions)
+        self.before_invoke(self._before_command)
+
+        self._end_phase('init')
+
+    def _end_phase(self, phase):
+        """Records how long the phase that just finished took."""
+        now = time.perf_counter()
+        took = now - self._phase_started
+        self._phase_started = now
+        self.startup_times[phase] = took
+        startup_seconds.set(took, phase=phase)
+
+    def startup_report(self):
+        """Summarises how long starting up took."""
+        total = sum(self.startup_times.values())
+        phases = ', '.join(f'{phase} {took:.2f}s'
+                           for phase, took in self.startup_times.items())
+        return f'Started up in {total:.2f}s: {phases}'
+
+    async def load_state(self):
+        """Reads all of the state at once, then builds what depends on it."""
+        if self.state_client is not None:
+            await self.state_client.connect()
+
+        await asyncio.gather(*(value.load() for value in self._state_values))
+
+        self.triggers = triggers.TriggerRegistry(
+            self._patterns_raw.snapshot(),
+            self._quarantined_raw.snapshot())
+        self.screen_loaded_patterns()
+
+        await self.commanders.add(self.owner_id)
+
+        if (self.hot_reload['enabled'] and self.state_client is None
+                and self.database is None and self.state_watcher is None):
+            import kat18.watch as watch
+
+            self.state_watcher = watch.DirectoryWatcher(
+                self.config_location,
+                set().union(*(watch.storage_files(value.storage)
+                              for value in self._state_values)),
+                self.refresh_state,
+                delay=self.hot_reload['delay'],
+                poll_interval=self.hot_reload['poll_interval'],
+                scheduler=self.scheduler)
+            self.state_watcher.start()
+
+    async def refresh_state(self, names=None):
+        """
+        Rereads any state that something else has changed, and rebuilds
+        only whatever depends on the values that changed.
+
+        :param names: the names of the files that changed, if we know. If
+            None, then every value is checked.
+        """
+        if names is None:
+            values = self._state_values
+        else:
+            import kat18.watch as watch
+
+            values = [value for value in self._state_values
+                      if watch.storage_files(value.storage) & names]
+        reloaded = await asyncio.gather(*(value.reload() for value in values))
+        # Values compare by their contents, so go by identity.
+        changed = {id(value): value
+                   for value, was_reloaded in zip(values, reloaded)
+                   if was_reloaded}
+        if not changed:
+            return
+
+        if (id(self._patterns_raw) in changed
+                or id(self._quarantined_raw) in changed):
+            failed = self.triggers.sync(self._patterns_raw.snapshot(),
+                                        self._quarantined_raw.snapshot())
+            for source in failed:
+                self.logger.warning(f'Could not compile pattern {source!r}')
+            self.logger.info(f'Loaded {len(self.triggers)} patterns')
+            self.screen_loaded_patterns()
+
+        if id(self._loaded_emojis_raw) in changed:
+            await self.reload_emoji_cache()
+
+        self.logger.info('Reloaded ' + ', '.join(
+            os.path.basename(value.storage.file_name)
+            for value in changed.values()))
+
+    async def start(self, *args, **kwargs):
+        """Loads the state, then logs in and connects."""
+        await self.load_state()
+        self._end_phase('state')
+
+        await self.login(*args, bot=kwargs.pop('bot', True))
+        self._end_phase('login')
+
+        await self.connect(reconnect=kwargs.pop('reconnect', True))
+
+    async def on_ready(self):
+        # We get this again whenever we reconnect.
+        if 'ready' not in self.startup_times:
+            self._end_phase('ready')
+            self.logger.info(self.startup_report())
+
+    def load_lazy_extensions(self) -> bool:
+        """
+        Loads the extensions that were put off at startup.
+
+        :return: True if there were any to load.
+        """
+        if not self._lazy_extensions:
+            return False
+
+        start = time.perf_counter()
+        loading = sorted(self._lazy_extensions)
+        self._lazy_extensions.clear()
+        for ext in loading:
+            self.load_extension(ext)
+
+        took = time.perf_counter() - start
+        self.logger.info(f'Loaded {", ".join(loading)} in {took:.2f}s')
+        return True
+
+    async def _before_command(self, ctx):
+        # Help should list the commands we have not loaded yet, too.
+        if ctx.command.name == 'help':
+            self.load_lazy_extensions()
+
+    async def on_command_error(self, ctx, error):
+        if (isinstance(error, commands.CommandNotFound)
+                and self.load_lazy_extensions()):
+            # It may be one of the commands we just loaded.
+            await self.process_commands(ctx.message)
+        else:
+            await super().on_command_error(ctx, error)
+
+    def _instrument_http(self):
+        """
+        Counts and times every REST call we make, by method and route. The
+        route path is the template, such as ``/channels/{channel_id}``, so
+        IDs don't end up in the labels.
+        """
+        request = self.http.request
+
+        async def timed_request(route, **kwargs):
+            start = time.perf_counter()
+            status = 'error'
+            try:
+                result = await request(route, **kwargs)
+                status = 'ok'
+                return result
+            finally:
+                rest_requests.inc(method=route.method, route=route.path,
+                                  status=status)
+                rest_seconds.observe(time.perf_counter() - start,
+                                     method=route.method, route=route.path)
+
+        self.http.request = timed_request
+
     @property
     def invite(self):
         """Gets a bot invite link."""
@@ -126,32 +590,38 @@ class KatBot(commands.Bot, util.Loggable):
         """Runs the bot."""
         super().run(self.__token)
 
+    async def close(self):
+        """Writes out any state that is pending, then closes the bot."""
+        if self.state_watcher is not None:
+            self.state_watcher.close()
+        if self._screening is not None:
+            self._screening.cancel()
+        await asyncio.gather(*(value.flush() for value in self._state_values))
+        self.scheduler.close()
+        self.outbox.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        await super().close()
+
+        if self.database is not None:
+            self.database.close()
+        if self.state_client is not None:
+            self.state_client.close()
+
     async def reload_emoji_cache(self):
         """
         Reloads emoji cache by looking up the emoji objects from the cached
-        strings...
-        """
-        await self._loaded_emojis_raw.read_from_file()
-        self._loaded_emoji_cache.clear()
-        for emoji in self._loaded_emojis_raw.get():
-            actual = dutils.find(
-                lambda e: str(e) == emoji or e.name == emoji, self.emojis)
-            if actual is None:
-                self.logger.warning(f'Could not find emoji {emoji}')
-            else:
-                self.logger.info(f'Found emoji {emoji} as {str(actual)}')
-                self._loaded_emoji_cache.append(actual)
-
-    async def recompile_patterns(self):
-        """
-        Reloads and compiles the patterns.
-        """
-        await self._patterns_raw.read_from_file()
-        self._patterns_cache.clear()
-        for pattern in self._patterns_raw.get():
-            regex = re.compile(pattern, flags=re.I | re.U | re.M)
-            self.logger.info(f'Loaded pattern {pattern}')
-            self._patterns_cache.append(regex)
+        strings in the emoji index. The strings are only reread if they
+        were changed by something other than us.
+        """
+        await self._loaded_emojis_raw.reload()
+        found, missing = self.emoji_index.resolve_all(
+            self._loaded_emojis_raw.snapshot())
+
+        for emoji in missing:
+            self.logger.warning(f'Could not find emoji {emoji}')
+
+        self._loaded_emoji_cache = found
 
     @property
     def loaded_emojis(self):
@@ -174,19 +644,198 @@ class KatBot(commands.Bot, util.Loggable):
     @property
     def patterns(self):
         """Gets a list of regex patterns to react to on match."""
-        return copy.copy(self._patterns_cache)
+        return self.triggers.patterns
+
+    @property
+    def trigger_matcher(self):
+        """Gets the matcher for all of the patterns."""
+        return self.triggers.matcher
 
-    async def set_pattern_list(self, patterns):
-        """Sets the list of patterns."""
-        # Get the regex patterns.
-        patterns = [pattern.pattern for pattern in patterns]
-        await self._patterns_raw.set(patterns)
-        await self.recompile_patterns()
+    async def add_pattern(self, source):
+        """
+        Adds a pattern from its source. Returns False if we already had it.
+        Unless the pattern is a plain phrase, it is screened against the
+        sample messages first.
+
+        :raises re.error: if the source does not compile.
+        :raises ValueError: if the pattern is too slow.
+        """
+        if source in self.triggers:
+            return False
+
+        if triggers.word_phrase(triggers.compile_trigger(source)) is None:
+            await self.screen_pattern(source)
+
+        if not self.triggers.add(source):
+            return False
+        await self._patterns_raw.set(self.triggers.sources)
+        self.logger.info(f'Loaded pattern {source}')
+        return True
+
+    async def screen_pattern(self, source):
+        """
+        Times a pattern against the sample messages.
+
+        :raises ValueError: if the pattern is too slow.
+        """
+        limit = self.trigger_limits['screen_max']
+        try:
+            worst = await triggers.screen(
+                source,
+                self._trigger_corpus.snapshot(),
+                timeout=self.trigger_limits['screen_timeout'])
+        except (TimeoutError, RuntimeError) as ex:
+            raise ValueError(f'That pattern is too slow. {ex}') from None
+
+        if worst > limit:
+            raise ValueError(
+                f'That pattern is too slow. It took {worst * 1000:.2f}ms on '
+                f'a sample message, but I only allow {limit * 1000:.2f}ms.')
+
+    def screen_loaded_patterns(self) -> asyncio.Future:
+        """
+        Screens the raw expressions that were loaded from the state rather
+        than added, in the background. Those that pass start being matched,
+        and the rest are quarantined.
+
+        :return: a future that is done once there are none left to screen.
+        """
+        if self._screening is None or self._screening.done():
+            self._screening = asyncio.ensure_future(self._screen_unscreened())
+        return self._screening
+
+    async def _screen_unscreened(self):
+        tried = set()
+        while True:
+            # More may turn up while we are screening these.
+            sources = [source for source in self.triggers.unscreened
+                       if source not in tried
+                       and source not in self.triggers.quarantined]
+            if not sources:
+                return
+
+            passed = []
+            for source in sources:
+                tried.add(source)
+                try:
+                    await self.screen_pattern(source)
+                except ValueError as ex:
+                    self.logger.warning(f'Quarantining pattern {source}: '
+                                        f'{ex}')
+                    self._quarantine_pattern(source)
+                else:
+                    passed.append(source)
+
+            self.triggers.passed(passed)
+            self.logger.info(f'Screened {len(sources)} loaded pattern(s), '
+                             f'{len(passed)} passed')
+
+    async def remove_pattern(self, source):
+        """
+        Removes a pattern by its source. Returns False if we did not have it.
+        """
+        was_quarantined = source in self.triggers.quarantined
+        if not self.triggers.remove(source):
+            return False
+
+        self.trigger_guard.forget(source)
+        await self._patterns_raw.set(self.triggers.sources)
+        if was_quarantined:
+            await self._quarantined_raw.set(sorted(self.triggers.quarantined))
+        return True
+
+    def _quarantine_pattern(self, source):
+        """Stops matching a pattern that keeps going over budget."""
+        if self.triggers.quarantine(source):
+            asyncio.ensure_future(
+                self._quarantined_raw.set(sorted(self.triggers.quarantined)))
+
+    @property
+    def command_prefixes(self):
+        """
+        Gets the command prefixes. These only depend on our user ID, so
+        they are only built again if that changes.
+        """
+        user = self.user
+        if user is None:
+            return []
+        if self._command_prefixes_for != user.id:
+            self._command_prefixes = [
+                user.mention + ' ',         # Mention (nick-based)
+                '<@!%s> ' % user.id,        # User-account mention
+                self.name + ' do: '         # "Kat do:"
+            ]
+            self._command_prefixes_for = user.id
+        return self._command_prefixes
 
     async def when_mentioned(self, bot, _):
         """Handles generating the appropriate command prefix."""
-        return [
-            bot.user.mention + ' ',    # Mention (nick-based)
-            '<@!%s> ' % bot.user.id,   # User-account mention
-            self.name + ' do: '        # "Kat do:"
-        ]
\ No newline at end of file
+        return bot.command_prefixes
+
+    async def on_message(self, message):
+        """
+        Works out what we need to know about the message once, then passes
+        it to the handlers that want it. Commands are only looked for if the
+        message starts with a command prefix.
+
+        :return: the futures for the handlers that were started.
+        """
+        view = self.view(message)
+        futures = self.messages.dispatch(view)
+
+        if view.command_prefix is not None and not view.from_bot:
+            await self.process_commands(message)
+        return futures
+
+    def view(self, message):
+        """Makes the view of a message that the handlers are given."""
+        return pipeline.MessageView(
+            message, self.talk_prefix, self.command_prefixes)
+
+
+class KatBot(KatBotMixin, commands.Bot):
+    """Kat bot client, on a single gateway connection."""
+
+
+class ShardedKatBot(KatBotMixin, commands.AutoShardedBot):
+    """
+    Kat bot client, with the guilds split between several gateway
+    connections, or shards. Enable this with "sharding" in config.json:
+
+        "sharding": {"enabled": true, "shard_count": 4, "shard_ids": [0, 1]}
+
+    Without a shard count, Discord says how many to use. Without shard IDs,
+    this process runs every shard. See kat18.workers to run the shards in
+    several processes.
+
+    :param shard_ids: the shards to run, overriding config.json.
+    """
+    sharded = True
+
+    def __init__(self, config_location, shard_ids=None, **kwargs):
+        self._shard_ids = shard_ids
+        super().__init__(config_location, **kwargs)
+
+    def _client_options(self, config):
+        sharding = config.get('sharding', {})
+        shard_ids = self._shard_ids
+        if shard_ids is None:
+            shard_ids = sharding.get('shard_ids')
+        return {
+            'shard_count': sharding.get('shard_count'),
+            'shard_ids': shard_ids,
+        }
+
+
+def make_bot(config_location, **kwargs) -> KatBotMixin:
+    """
+    Makes the bot, sharded or not depending on "sharding" in config.json.
+    Any keyword arguments are passed to the bot.
+    """
+    with open(os.path.join(config_location, 'config.json')) as fp:
+        sharding = json.load(fp).get('sharding', {})
+
+    if sharding.get('enabled', False):
+        return ShardedKatBot(config_location, **kwargs)
+    else:
+        return KatBot(config_location, **kwargs)
@@ -0,0 +1,105 @@
+"""
+Index of the custom emojis the bot can see, so configured emojis can be
+resolved without scanning every emoji in every guild.
+"""
+import typing
+
+
+__all__ = ['EmojiIndex']
+
+
+class EmojiIndex:
+    """
+    Indexes emojis by ID, by ``str(emoji)`` and by name. It is kept up to
+    date a guild at a time from the guild events, rather than being rebuilt.
+    """
+    def __init__(self):
+        self._by_id = {}
+        self._by_str = {}
+        # Name -> {ID: emoji}, as names are only unique within a guild.
+        self._by_name = {}
+        # Guild ID -> IDs of the emojis we indexed for it.
+        self._by_guild = {}
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, emoji):
+        return getattr(emoji, 'id', None) in self._by_id
+
+    def _add(self, emoji):
+        self._remove(emoji.id)
+        self._by_id[emoji.id] = emoji
+        self._by_str[str(emoji)] = emoji
+        self._by_name.setdefault(emoji.name, {})[emoji.id] = emoji
+
+    def _remove(self, emoji_id):
+        emoji = self._by_id.pop(emoji_id, None)
+        if emoji is None:
+            return
+
+        self._by_str.pop(str(emoji), None)
+        named = self._by_name.get(emoji.name)
+        if named is not None:
+            named.pop(emoji_id, None)
+            if not named:
+                del self._by_name[emoji.name]
+
+    def add_guild(self, guild):
+        """Indexes all emojis in the guild, replacing any we had for it."""
+        self.update_guild(guild, (), guild.emojis)
+
+    def remove_guild(self, guild):
+        """Forgets all emojis we indexed for the guild."""
+        for emoji_id in self._by_guild.pop(guild.id, ()):
+            self._remove(emoji_id)
+
+    def update_guild(self, guild, before, after):
+        """
+        Updates the guild's emojis from the before and after lists given by
+        ``on_guild_emojis_update``.
+        """
+        old_ids = self._by_guild.get(guild.id, set())
+        old_ids.update(e.id for e in before)
+        new_ids = {e.id for e in after}
+
+        for emoji_id in old_ids - new_ids:
+            self._remove(emoji_id)
+        for emoji in after:
+            # Re-adding handles renames too.
+            self._add(emoji)
+
+        if new_ids:
+            self._by_guild[guild.id] = new_ids
+        else:
+            self._by_guild.pop(guild.id, None)
+
+    def get(self, emoji_id: int):
+        """Gets the emoji with the given ID, or None."""
+        return self._by_id.get(emoji_id)
+
+    def resolve(self, key: str):
+        """
+        Gets the emoji that ``str(emoji)`` gives the key, or failing that, an
+        emoji with the key as its name. Returns None if neither exist.
+        """
+        emoji = self._by_str.get(key)
+        if emoji is None:
+            named = self._by_name.get(key)
+            if named:
+                emoji = next(iter(named.values()))
+        return emoji
+
+    def resolve_all(self, keys: typing.Iterable[str]):
+        """
+        Resolves each key. Returns a list of the emojis found, and a list of
+        the keys that could not be found.
+        """
+        found, missing = [], []
+        for key in keys:
+            emoji = self.resolve(key)
+            if emoji is None:
+                missing.append(key)
+            else:
+                found.append(emoji)
+        return found, missing
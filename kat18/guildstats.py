@@ -0,0 +1,179 @@
+"""
+Statistics for each guild the bot is in, so that they can be shown without
+walking discord.py's caches every time they are asked for.
+"""
+import typing
+
+import discord
+
+import kat18.metrics as metrics
+
+
+__all__ = ['GuildSummary', 'GuildStats']
+
+
+guilds_total = metrics.Gauge(
+    'kat18_guilds',
+    'Guilds the bot is in.')
+members_total = metrics.Gauge(
+    'kat18_members',
+    'Members across every guild the bot is in.')
+text_channels_total = metrics.Gauge(
+    'kat18_text_channels',
+    'Text channels across every guild the bot is in.')
+voice_channels_total = metrics.Gauge(
+    'kat18_voice_channels',
+    'Voice channels across every guild the bot is in.')
+
+
+# The counts kept for each guild, which are also totalled across guilds.
+_COUNTS = ('members', 'text_channels', 'voice_channels', 'categories')
+
+
+class GuildSummary:
+    """The statistics for one guild."""
+    __slots__ = ['id', 'name', 'icon_url', 'shard_id', 'owner_id',
+                 'mfa_level', 'verification_level', 'explicit_content_filter',
+                 'members', 'text_channels', 'voice_channels', 'categories']
+
+    def __init__(self, guild):
+        self.id = guild.id
+        self.shard_id = guild.shard_id
+        self.update(guild)
+
+        self.members = guild.member_count
+        self.text_channels = 0
+        self.voice_channels = 0
+        self.categories = 0
+        for channel in guild.channels:
+            self.count_channel(channel, 1)
+
+    def update(self, guild):
+        """Updates the details that on_guild_update tells us about."""
+        self.name = guild.name
+        self.icon_url = guild.icon_url
+        self.owner_id = guild.owner_id
+        self.mfa_level = guild.mfa_level
+        self.verification_level = guild.verification_level
+        self.explicit_content_filter = guild.explicit_content_filter
+
+    def count_channel(self, channel, delta) -> typing.Optional[str]:
+        """
+        Adds delta to the count for the channel's type.
+
+        :return: the name of the count that changed, if any did.
+        """
+        if isinstance(channel, discord.TextChannel):
+            self.text_channels += delta
+            return 'text_channels'
+        elif isinstance(channel, discord.VoiceChannel):
+            self.voice_channels += delta
+            return 'voice_channels'
+        elif isinstance(channel, discord.CategoryChannel):
+            self.categories += delta
+            return 'categories'
+        return None
+
+
+class GuildStats:
+    """
+    A :class:`GuildSummary` for each guild, worked out once when the guild
+    becomes available and then kept up to date from the member and channel
+    events, along with totals across every guild. Looking up a guild, or
+    the totals, costs the same however big the guilds are.
+    """
+    def __init__(self):
+        # Guild ID -> GuildSummary
+        self._guilds = {}
+        # Count name -> total across guilds.
+        self._totals = dict.fromkeys(_COUNTS, 0)
+        # Shard ID -> [guilds, members]
+        self._shards = {}
+
+    def __len__(self):
+        return len(self._guilds)
+
+    def __contains__(self, guild_id):
+        return guild_id in self._guilds
+
+    def _adjust(self, summary, sign):
+        for name in _COUNTS:
+            self._totals[name] += sign * getattr(summary, name)
+        shard = self._shards.setdefault(summary.shard_id, [0, 0])
+        shard[0] += sign
+        shard[1] += sign * summary.members
+        if not shard[0]:
+            del self._shards[summary.shard_id]
+
+    def add_guild(self, guild) -> GuildSummary:
+        """Works out the guild's statistics, replacing any we had for it."""
+        self.remove_guild(guild)
+        summary = GuildSummary(guild)
+        self._guilds[guild.id] = summary
+        self._adjust(summary, 1)
+        return summary
+
+    def remove_guild(self, guild):
+        """Forgets the guild's statistics."""
+        summary = self._guilds.pop(guild.id, None)
+        if summary is not None:
+            self._adjust(summary, -1)
+
+    def update_guild(self, before, after):
+        """Updates the guild's details from on_guild_update."""
+        summary = self._guilds.get(after.id)
+        if summary is not None:
+            summary.update(after)
+
+    def member_joined(self, member):
+        self._count_member(member, 1)
+
+    def member_removed(self, member):
+        self._count_member(member, -1)
+
+    def _count_member(self, member, delta):
+        summary = self._guilds.get(member.guild.id)
+        if summary is not None:
+            summary.members += delta
+            self._totals['members'] += delta
+            self._shards[summary.shard_id][1] += delta
+
+    def channel_created(self, channel):
+        self._count_channel(channel, 1)
+
+    def channel_deleted(self, channel):
+        self._count_channel(channel, -1)
+
+    def _count_channel(self, channel, delta):
+        summary = self._guilds.get(channel.guild.id)
+        if summary is not None:
+            name = summary.count_channel(channel, delta)
+            if name is not None:
+                self._totals[name] += delta
+
+    def get(self, guild_id) -> typing.Optional[GuildSummary]:
+        """Gets the statistics for the guild with the given ID, or None."""
+        return self._guilds.get(guild_id)
+
+    def summary(self, guild) -> GuildSummary:
+        """
+        Gets the statistics for the guild, working them out if we do not have
+        them yet.
+        """
+        summary = self._guilds.get(guild.id)
+        if summary is None:
+            summary = self.add_guild(guild)
+        return summary
+
+    def totals(self) -> typing.Dict[str, int]:
+        """Gets the number of guilds, and each count across every guild."""
+        return {'guilds': len(self._guilds), **self._totals}
+
+    def shard_totals(self) -> typing.Dict[typing.Optional[int],
+                                          typing.Tuple[int, int]]:
+        """
+        Gets the number of guilds and members on each shard, keyed by shard
+        ID. Guilds on no shard are under None.
+        """
+        return {shard_id: tuple(counts)
+                for shard_id, counts in self._shards.items()}
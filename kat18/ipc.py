@@ -0,0 +1,371 @@
+"""
+Shares the bot state between worker processes on one machine.
+
+One process runs a :class:`StateServer`, which owns the state and persists
+it however the config says to. Each worker connects a :class:`StateClient`,
+and uses :meth:`StateClient.storage` as the ``storage_type`` of its values,
+so each :class:`kat18.aio.AsyncJsonValue` in a worker is a local read cache
+of the value held by the server.
+
+Changes are sent to the server as delta records (see
+:func:`kat18.aio.diff`), so changes made at the same time by two workers
+are merged rather than one overwriting the other. The server then pushes
+the new value to every worker. A worker's value reports itself as modified
+until it is reloaded, and the client calls its change listeners so that
+the worker can reload and rebuild anything derived from the value.
+
+Messages are JSON objects, one per line, over a Unix socket, or over TCP
+on the loopback interface where there are no Unix sockets.
+"""
+import asyncio
+import json
+import os
+import socket
+import threading
+import typing
+
+import kat18.aio as aio
+import kat18.util as util
+import kat18.watch as watch
+
+
+__all__ = ['StateServer', 'StateClient', 'RemoteStorage', 'default_address']
+
+
+# Values such as the trigger list can get big.
+_LINE_LIMIT = 2 ** 24
+
+
+def default_address(config_location):
+    """
+    Gets where to serve the state for the given config directory: a Unix
+    socket in it if we can, otherwise a free port on the loopback interface.
+    """
+    if hasattr(socket, 'AF_UNIX'):
+        return os.path.join(config_location, 'state.sock')
+    else:
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()
+
+
+def _encode(message) -> bytes:
+    return json.dumps(message, separators=(',', ':')).encode() + b'\n'
+
+
+class StateServer(util.Loggable):
+    """
+    Owns the state, and serves it to the workers.
+
+    :param config_location: where the state files are.
+    :param address: a Unix socket path, or a (host, port) tuple.
+    :param value_options: passed to each AsyncJsonValue, such as the
+        storage type and flush delay.
+    """
+    def __init__(self, config_location, address, **value_options):
+        self.config_location = config_location
+        self.address = address
+        self.value_options = value_options
+        # Name -> (value, version, lock)
+        self._values = {}
+        self._writers = set()
+        self._server = None
+        self._watcher = None
+
+    async def start(self):
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            self._server = await asyncio.start_unix_server(
+                self._handle, self.address, limit=_LINE_LIMIT)
+        else:
+            host, port = self.address
+            self._server = await asyncio.start_server(
+                self._handle, host, port, limit=_LINE_LIMIT)
+        self.logger.info(f'Serving state on {self.address}')
+
+    def watch(self, **options):
+        """
+        Watches the files the state is kept in, so that changes made to them
+        by hand are pushed to the workers.
+
+        :param options: passed to :class:`kat18.watch.DirectoryWatcher`.
+        """
+        self._watcher = watch.DirectoryWatcher(
+            self.config_location,
+            set().union(*(watch.storage_files(value.storage)
+                          for value, *_ in self._values.values())),
+            self.reload,
+            **options)
+        self._watcher.start()
+
+    async def reload(self, names=None):
+        """
+        Rereads any values kept in the given files that something else has
+        changed, and pushes them to every worker.
+        """
+        for name, entry in list(self._values.items()):
+            value, _, lock = entry
+            if names is not None and not watch.storage_files(
+                    value.storage) & names:
+                continue
+            async with lock:
+                if not await value.reload():
+                    continue
+                entry[1] += 1
+                version = entry[1]
+            self.logger.info(f'Reloaded {name}')
+            self._broadcast({'op': 'changed', 'name': name,
+                             'value': value.cached_value,
+                             'version': version})
+
+    async def close(self):
+        """Stops serving, and writes out anything that is pending."""
+        if self._watcher is not None:
+            self._watcher.close()
+        if self._server is not None:
+            self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        await asyncio.gather(*(value.flush()
+                               for value, *_ in self._values.values()))
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def _value(self, name, default):
+        entry = self._values.get(name)
+        if entry is None:
+            # Only ever a file in the config directory.
+            file_name = os.path.join(self.config_location,
+                                     os.path.basename(name))
+            value = aio.AsyncJsonValue(file_name, default,
+                                       **self.value_options)
+            entry = [value, 0, asyncio.Lock()]
+            self._values[name] = entry
+            if self._watcher is not None:
+                self._watcher.add(watch.storage_files(value.storage))
+        return entry
+
+    async def _handle(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                response = await self._respond(request, writer)
+                response['id'] = request.get('id')
+                writer.write(_encode(response))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            self.logger.exception('Dropping a worker after a bad request')
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _respond(self, request, writer):
+        op = request.get('op')
+        name = request.get('name')
+
+        if op == 'get':
+            value, version, _ = self._value(name, request.get('default'))
+            return {'name': name, 'value': value.cached_value,
+                    'version': version}
+
+        elif op == 'patch':
+            entry = self._value(name, request.get('default'))
+            value, _, lock = entry
+            async with lock:
+                await value.set(aio.patch(value.cached_value,
+                                          request['records']))
+                entry[1] += 1
+                version = entry[1]
+            # The worker that made the change gets the response instead.
+            self._broadcast({'op': 'changed', 'name': name,
+                             'value': value.cached_value,
+                             'version': version}, exclude=writer)
+            return {'name': name, 'value': value.cached_value,
+                    'version': version}
+
+        return {'error': f'Unknown op {op!r}'}
+
+    def _broadcast(self, message, exclude=None):
+        data = _encode(message)
+        for writer in self._writers:
+            if writer is not exclude:
+                writer.write(data)
+
+
+class StateClient(util.Loggable):
+    """
+    A worker's connection to the :class:`StateServer`.
+
+    :param address: a Unix socket path, or a (host, port) tuple.
+    """
+    def __init__(self, address):
+        self.address = address
+        self.loop = None
+        self._reader = None
+        self._writer = None
+        self._ids = 0
+        self._pending = {}
+        # Name -> RemoteStorage
+        self._storages = {}
+        self._listeners = []
+        self._task = None
+        self._closing = False
+
+    def storage(self, file_name) -> 'RemoteStorage':
+        """
+        Gets the storage for the value that would otherwise be kept in the
+        given file. Pass this as the ``storage_type`` of a value, which must
+        also be given ``defer_load=True``.
+        """
+        storage = RemoteStorage(self, file_name)
+        self._storages[storage.name] = storage
+        return storage
+
+    def add_listener(self, callback: typing.Callable[[str], None]) -> None:
+        """Calls callback(name) whenever another change comes in."""
+        self._listeners.append(callback)
+
+    async def connect(self):
+        self.loop = asyncio.get_event_loop()
+        if isinstance(self.address, str):
+            self._reader, self._writer = await asyncio.open_unix_connection(
+                self.address, limit=_LINE_LIMIT)
+        else:
+            host, port = self.address
+            self._reader, self._writer = await asyncio.open_connection(
+                host, port, limit=_LINE_LIMIT)
+        self._task = asyncio.ensure_future(self._read())
+        self.logger.info(f'Connected to the state server on {self.address}')
+
+    def close(self):
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+    async def request(self, op, **kwargs):
+        """Makes a request, and waits for the response."""
+        self._ids += 1
+        future = self.loop.create_future()
+        self._pending[self._ids] = future
+        self._writer.write(_encode({'id': self._ids, 'op': op, **kwargs}))
+        await self._writer.drain()
+        response = await future
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    async def _read(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if message.get('op') == 'changed':
+                    self._changed(message)
+                else:
+                    storage = self._storages.get(message.get('name'))
+                    if storage is not None and 'version' in message:
+                        storage.update(message['value'], message['version'])
+                    future = self._pending.pop(message.get('id'), None)
+                    if future is not None and not future.done():
+                        future.set_result(message)
+        finally:
+            error = ConnectionError('Lost the state server')
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self._pending.clear()
+            if not self._closing:
+                self.logger.error('Lost the state server')
+
+    def _changed(self, message):
+        storage = self._storages.get(message['name'])
+        if storage is not None and storage.update(message['value'],
+                                                  message['version']):
+            self._notify(storage.name)
+
+    def _notify(self, name):
+        for callback in self._listeners:
+            callback(name)
+
+
+class RemoteStorage:
+    """
+    Storage for a value held by a :class:`StateServer`. This remembers the
+    latest value pushed to us, so rereading it costs nothing.
+    """
+    def __init__(self, client, file_name):
+        self.client = client
+        self.file_name = file_name
+        self.name = os.path.basename(file_name)
+        self._default = None
+        self._latest = None
+        self._latest_version = -1
+        # The version our value was last read or written at.
+        self._seen_version = -1
+
+    def update(self, value, version) -> bool:
+        """
+        Remembers a value pushed to us. Returns False if we already had this
+        version or a later one.
+        """
+        if version <= self._latest_version:
+            return False
+        self._latest = value
+        self._latest_version = version
+        return True
+
+    def load(self, default_value):
+        """
+        Fetches the value. This blocks, so has to be called on another
+        thread to the event loop, which is what deferred loading does.
+        """
+        if threading.current_thread() is threading.main_thread():
+            raise RuntimeError('Remote values must be loaded with '
+                               'defer_load=True')
+        self._default = default_value
+        response = asyncio.run_coroutine_threadsafe(
+            self.client.request('get', name=self.name,
+                                default=default_value),
+            self.client.loop
+        ).result()
+        self.update(response['value'], response['version'])
+        self._seen_version = response['version']
+        return response['value']
+
+    def modified(self):
+        """True if a newer value has been pushed to us since we last read."""
+        return self._latest_version > self._seen_version
+
+    async def read(self):
+        """Gets the latest value pushed to us."""
+        self._seen_version = self._latest_version
+        return self._latest
+
+    async def write(self, old_value, new_value, unique=False):
+        """Sends the changes to the server."""
+        records = aio.diff(old_value, new_value, unique)
+        if not records:
+            return
+        response = await self.client.request(
+            'patch', name=self.name, records=records, default=self._default)
+        version = response['version']
+        self.update(response['value'], version)
+        # If someone else changed the value at the same time, then the
+        # server merged our changes into theirs, and we are out of date.
+        if response['value'] == new_value:
+            self._seen_version = version
+        elif version > self._seen_version + 1:
+            # Their change may be pushed to us after this response, in which
+            # case it is dropped as old news, so let the listeners know now.
+            self.client._notify(self.name)
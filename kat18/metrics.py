@@ -0,0 +1,290 @@
+"""
+Counters, gauges and latency histograms, exported in the Prometheus text
+format over a small local HTTP endpoint.
+
+Metrics are declared at module level in the module that records them, and
+register themselves with the default :data:`registry`. The endpoint is off
+unless it is turned on in config.json, for example:
+
+    "metrics": {"enabled": true, "host": "127.0.0.1", "port": 9418}
+"""
+import abc
+import functools
+import logging
+import math
+import threading
+import time
+import typing
+
+import asyncio
+
+
+__all__ = ['Registry', 'Counter', 'Gauge', 'Histogram', 'MetricsServer',
+           'registry']
+
+
+DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05,
+                   .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return (str(value).replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _format_value(value) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Registry:
+    """A collection of metrics that can be rendered together."""
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """
+        Registers a metric. If the same metric is already registered, as
+        happens when the module that declares it is reloaded, then that one
+        is returned instead.
+
+        :raises ValueError: if a different metric has the same name.
+        """
+        existing = self._metrics.get(metric.name)
+        if existing is None:
+            self._metrics[metric.name] = metric
+            return metric
+        elif (existing.type != metric.type
+              or existing.labelnames != metric.labelnames
+              or getattr(existing, 'buckets', None)
+              != getattr(metric, 'buckets', None)):
+            raise ValueError(f'{metric.name} is already registered')
+        return existing
+
+    def __iter__(self):
+        return iter(self._metrics.values())
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics.values():
+            help_text = metric.help.replace('\\', '\\\\').replace('\n', '\\n')
+            lines.append(f'# HELP {metric.name} {help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class _Metric(abc.ABC):
+    type = 'untyped'
+
+    def __init__(self, name, help, labelnames=(), registry=registry):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # Samples can be recorded from IO threads.
+        self._lock = threading.Lock()
+        if registry is not None:
+            existing = registry.register(self)
+            if existing is not self:
+                # Record into the samples that are already being rendered.
+                self._lock = existing._lock
+                self._values = existing._values
+
+    def _key(self, labels) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}')
+        return tuple(labels[name] for name in self.labelnames)
+
+    @abc.abstractmethod
+    def samples(self) -> typing.Iterable[str]:
+        pass
+
+
+class Counter(_Metric):
+    """A value that only goes up."""
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        self._values = {}
+        super().__init__(*args, **kwargs)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield (f'{self.name}{_format_labels(self.labelnames, key)} '
+                   f'{_format_value(value)}')
+
+
+class Gauge(_Metric):
+    """
+    A value that can go up and down. Rather than being set, it can also be
+    given a function that is called to get the value when rendering.
+    """
+    type = 'gauge'
+
+    def __init__(self, *args, func=None, **kwargs):
+        self._values = {}
+        self.func = func
+        super().__init__(*args, **kwargs)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.func is not None:
+            values = [((), self.func())]
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        for key, value in values:
+            yield (f'{self.name}{_format_labels(self.labelnames, key)} '
+                   f'{_format_value(value)}')
+
+
+class Histogram(_Metric):
+    """Counts observations, usually durations in seconds, into buckets."""
+    type = 'histogram'
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> [count per bucket..., count over, sum, count]
+        self._values = {}
+        super().__init__(*args, **kwargs)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 3)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            else:
+                entry[len(self.buckets)] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def count(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return 0 if entry is None else entry[-1]
+
+    def time(self, **labels):
+        """
+        Decorates a coroutine function, or a function, so that each call is
+        timed.
+        """
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self.observe(time.perf_counter() - start, **labels)
+            else:
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        self.observe(time.perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+    def samples(self):
+        with self._lock:
+            values = [(k, list(entry)) for k, entry in self._values.items()]
+
+        for key, entry in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), entry):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key,
+                                        [('le', _format_value(bound))])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(entry[-2])}'
+            yield f'{self.name}_count{labels} {entry[-1]}'
+
+
+class MetricsServer:
+    """
+    A tiny HTTP server that serves the registry at ``/metrics``. This is
+    only meant to be scraped from the local machine.
+    """
+    logger = logging.getLogger('MetricsServer')
+
+    def __init__(self, host='127.0.0.1', port=9418, registry=registry):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port)
+        self.logger.info(
+            f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # Skip the headers.
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and (
+                    parts[1].split('?')[0] == '/metrics'):
+                status = '200 OK'
+                body = self.registry.render().encode()
+            else:
+                status = '404 Not Found'
+                body = b'Not found. Try /metrics\n'
+
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
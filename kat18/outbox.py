@@ -0,0 +1,327 @@
+"""
+Queues the REST calls we make that nobody is waiting on, such as reactions
+and cleaning up messages, so that they do not hold up replies.
+
+Each call is queued on its route and channel, which is how Discord rate
+limits them, and the calls on each are made one at a time, most important
+first. Calls from every route then share a limited number of slots, again
+handed out most important first. Cosmetic calls only get some of the slots,
+so a backlog of them that is stuck waiting on a rate limit cannot hold up
+replies.
+
+Work that would be wasted is dropped: the same reaction or delete queued
+twice, or anything queued for a message that has since been deleted.
+"""
+import asyncio
+import collections
+import functools
+import heapq
+import itertools
+import time
+import typing
+
+import discord
+
+import kat18.metrics as metrics
+import kat18.util as util
+
+
+__all__ = ['Outbox', 'REPLY', 'ACTION', 'COSMETIC']
+
+
+#: Messages someone is waiting on.
+REPLY = 0
+#: Things that matter, but nobody is waiting on.
+ACTION = 1
+#: Reactions, and cleaning up after ourselves.
+COSMETIC = 2
+
+_PRIORITY_NAMES = {REPLY: 'reply', ACTION: 'action', COSMETIC: 'cosmetic'}
+
+
+outbox_backlog = metrics.Gauge(
+    'kat18_outbox_backlog',
+    'REST calls queued and not yet started, by route.',
+    ['route'])
+outbox_dropped = metrics.Counter(
+    'kat18_outbox_dropped_total',
+    'Queued REST calls that were dropped as they would be wasted.',
+    ['route', 'reason'])
+outbox_wait_seconds = metrics.Histogram(
+    'kat18_outbox_wait_seconds',
+    'Time REST calls spent queued before being made.',
+    ['route', 'priority'])
+
+
+class _Action:
+    __slots__ = ['priority', 'seq', 'route', 'channel_id', 'message_id',
+                 'key', 'func', 'quiet', 'future', 'queued_at']
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _Slots:
+    """A semaphore that lets waiters in by priority, then by arrival."""
+    def __init__(self, size):
+        self.free = size
+        self._waiters = []
+        self._seq = itertools.count()
+
+    async def acquire(self, priority):
+        if self.free > 0 and not self._waiters:
+            self.free -= 1
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # We were handed a slot just as we were cancelled.
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            *_, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # Hand our slot straight on.
+                future.set_result(None)
+                return
+        self.free += 1
+
+
+class Outbox(util.Loggable):
+    """
+    The queue of REST calls.
+
+    :param bot: the bot to make the calls with.
+    :param max_in_flight: how many calls can be made at once.
+    :param cosmetic_in_flight: how many of those can be cosmetic.
+    :param remember_gone: how many deleted messages to remember, so that we
+        do not bother doing anything else to them.
+    """
+    def __init__(self, bot, max_in_flight=4, cosmetic_in_flight=2,
+                 remember_gone=4096):
+        self.bot = bot
+        self._slots = _Slots(max_in_flight)
+        self._cosmetic = asyncio.Semaphore(cosmetic_in_flight)
+        self._seq = itertools.count()
+        # (route, channel ID) -> heap of actions
+        self._buckets = {}
+        self._tasks = {}
+        # Key -> the queued action, for dropping duplicates.
+        self._queued = {}
+        # Route -> queued actions
+        self._backlog = collections.Counter()
+        # IDs of messages that have been deleted, oldest first.
+        self._gone = collections.OrderedDict()
+        self._remember_gone = remember_gone
+
+    def backlog(self) -> typing.Dict[str, int]:
+        """Gets how many calls are queued on each route."""
+        return {route: count for route, count in self._backlog.items()
+                if count}
+
+    def __len__(self):
+        return sum(self._backlog.values())
+
+    def message_gone(self, message_id):
+        """
+        Remembers that a message was deleted, so anything queued for it is
+        dropped.
+        """
+        self._gone[message_id] = None
+        self._gone.move_to_end(message_id)
+        while len(self._gone) > self._remember_gone:
+            self._gone.popitem(last=False)
+
+    def submit(self, route, channel_id, func, priority=COSMETIC,
+               for_message=None, key=None, quiet=True) -> asyncio.Future:
+        """
+        Queues a call.
+
+        :param func: the coroutine function to call, without arguments.
+            Use functools.partial to give it some.
+
+        :param route: the name of the route, such as "add_reaction". Calls
+            on the same route and channel are made one at a time.
+        :param channel_id: the channel the call is for.
+        :param priority: :data:`REPLY`, :data:`ACTION` or :data:`COSMETIC`.
+        :param for_message: the ID of the message the call is for, if any.
+            If that message is deleted, the call is dropped.
+        :param key: identifies the call. If a call with the same key is
+            already queued, then this one is dropped.
+        :param quiet: if True, then errors are logged and the future's
+            result is None, so nobody has to wait on it.
+        :return: a future for the result, which is None if it was dropped.
+        """
+        loop = asyncio.get_event_loop()
+
+        if for_message is not None and for_message in self._gone:
+            outbox_dropped.inc(route=route, reason='gone')
+            future = loop.create_future()
+            future.set_result(None)
+            return future
+
+        if key is not None and key in self._queued:
+            outbox_dropped.inc(route=route, reason='duplicate')
+            queued = self._queued[key]
+            # Anything more important should not wait on the queued one.
+            if priority < queued.priority:
+                queued.priority = priority
+                heapq.heapify(self._buckets[queued.route,
+                                            queued.channel_id])
+            return queued.future
+
+        action = _Action()
+        action.priority = priority
+        action.seq = next(self._seq)
+        action.route = route
+        action.channel_id = channel_id
+        action.message_id = for_message
+        action.key = key
+        action.func = func
+        action.quiet = quiet
+        action.future = loop.create_future()
+        action.queued_at = time.perf_counter()
+
+        bucket = route, channel_id
+        heapq.heappush(self._buckets.setdefault(bucket, []), action)
+        if key is not None:
+            self._queued[key] = action
+        self._count(route, 1)
+
+        if bucket not in self._tasks:
+            self._tasks[bucket] = asyncio.ensure_future(self._drain(bucket))
+        return action.future
+
+    async def run(self, route, channel_id, func, priority=REPLY, **kwargs):
+        """
+        Queues the call, and waits for its result or error. This takes the
+        same arguments as :meth:`submit`.
+        """
+        return await self.submit(route, channel_id, func, priority=priority,
+                                 quiet=False, **kwargs)
+
+    def add_reaction(self, channel_id, message_id, emoji,
+                     priority=COSMETIC) -> asyncio.Future:
+        """Queues a reaction to the message with the given IDs."""
+        emoji = util.reaction_emoji(emoji)
+        func = functools.partial(self.bot.http.add_reaction,
+                                 channel_id=channel_id,
+                                 message_id=message_id,
+                                 emoji=emoji)
+        return self.submit('add_reaction', channel_id, func,
+                           priority=priority, for_message=message_id,
+                           key=('add_reaction', message_id, emoji))
+
+    def delete_message(self, channel_id, message_id,
+                       priority=COSMETIC) -> asyncio.Future:
+        """Queues deleting the message with the given IDs."""
+        func = functools.partial(self.bot.http.delete_message,
+                                 channel_id=channel_id,
+                                 message_id=message_id)
+        return self.submit('delete_message', channel_id, func,
+                           priority=priority, for_message=message_id,
+                           key=('delete_message', message_id))
+
+    async def send(self, channel, *args, priority=REPLY, **kwargs):
+        """Sends a message to the channel, and waits for it to be sent."""
+        func = functools.partial(channel.send, *args, **kwargs)
+        return await self.run('send_message', channel.id, func,
+                              priority=priority)
+
+    def close(self):
+        """Drops everything queued."""
+        for task in self._tasks.values():
+            task.cancel()
+        for queue in self._buckets.values():
+            for action in queue:
+                self._count(action.route, -1)
+                action.future.cancel()
+            queue.clear()
+        self._tasks.clear()
+        self._buckets.clear()
+        self._queued.clear()
+
+    def _count(self, route, delta):
+        self._backlog[route] += delta
+        outbox_backlog.set(self._backlog[route], route=route)
+
+    async def _drain(self, bucket):
+        queue = self._buckets[bucket]
+        try:
+            while queue:
+                action = heapq.heappop(queue)
+                self._count(action.route, -1)
+                if action.key is not None:
+                    self._queued.pop(action.key, None)
+
+                if action.future.done():
+                    # Whoever was waiting on it gave up.
+                    continue
+                elif action.message_id in self._gone:
+                    outbox_dropped.inc(route=action.route, reason='gone')
+                    action.future.set_result(None)
+                    continue
+
+                await self._perform(action)
+        finally:
+            for action in queue:
+                self._count(action.route, -1)
+                if action.key is not None:
+                    self._queued.pop(action.key, None)
+                action.future.cancel()
+            self._buckets.pop(bucket, None)
+            self._tasks.pop(bucket, None)
+
+    async def _call(self, action):
+        """Waits for a slot, then makes the call."""
+        cosmetic = action.priority == COSMETIC
+        if cosmetic:
+            await self._cosmetic.acquire()
+        try:
+            await self._slots.acquire(action.priority)
+            try:
+                outbox_wait_seconds.observe(
+                    time.perf_counter() - action.queued_at,
+                    route=action.route,
+                    priority=_PRIORITY_NAMES[action.priority])
+                return await action.func()
+            finally:
+                self._slots.release()
+        finally:
+            if cosmetic:
+                self._cosmetic.release()
+
+    async def _perform(self, action):
+        try:
+            result = await self._call(action)
+        except asyncio.CancelledError:
+            action.future.cancel()
+            raise
+        except discord.NotFound as ex:
+            if action.message_id is not None:
+                self.message_gone(action.message_id)
+            self._fail(action, ex)
+        except Exception as ex:
+            self._fail(action, ex)
+        else:
+            if action.route == 'delete_message':
+                self.message_gone(action.message_id)
+            if not action.future.done():
+                action.future.set_result(result)
+
+    def _fail(self, action, ex):
+        if action.future.done():
+            return
+        elif action.quiet:
+            if not isinstance(ex, discord.NotFound):
+                self.logger.warning(
+                    f'{action.route} failed: {type(ex).__name__}: {ex}')
+            action.future.set_result(None)
+        else:
+            action.future.set_exception(ex)
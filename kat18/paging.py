@@ -0,0 +1,188 @@
+"""
+Long listings, split into pages that are navigated by reacting to them.
+
+Pages are only rendered when someone asks for them, and items are only taken
+from the iterable the pages are built over as far as the pages that have been
+asked for need them, so the cost of showing a page does not depend on how
+long the listing is.
+"""
+import itertools
+import typing
+
+import discord
+
+import kat18.util as util
+
+
+__all__ = ['LazyPages', 'PageDispatcher', 'send_pages']
+
+
+class LazyPages:
+    """
+    Pages over an iterable of items, which is only consumed as far as the
+    pages asked for need.
+
+    :param items: the items. This is consumed lazily, so may be a generator.
+    :param per_page: how many items to show on each page.
+    :param render: called with the items on a page, the index of the page,
+        and the number of pages if that is known yet (otherwise None), and
+        returns the embed to show for it.
+    """
+    def __init__(self, items: typing.Iterable, per_page: int,
+                 render: typing.Callable[[list, int, typing.Optional[int]],
+                                         discord.Embed]):
+        self._items = iter(items)
+        self.per_page = per_page
+        self._render = render
+        # The items taken so far.
+        self._seen = []
+        self._exhausted = False
+
+    def _fill(self, count=None):
+        """
+        Takes items until we have ``count`` of them, or run out. If count is
+        None, then every item is taken.
+        """
+        if self._exhausted:
+            return
+        elif count is None:
+            self._seen.extend(self._items)
+            self._exhausted = True
+        elif len(self._seen) < count:
+            wanted = count - len(self._seen)
+            self._seen.extend(itertools.islice(self._items, wanted))
+            if len(self._seen) < count:
+                self._exhausted = True
+
+    @property
+    def page_count(self) -> typing.Optional[int]:
+        """The number of pages, or None if we do not know yet."""
+        if not self._exhausted:
+            return None
+        return max(1, -(-len(self._seen) // self.per_page))
+
+    def last_page(self) -> int:
+        """Gets the index of the last page. This consumes every item."""
+        self._fill()
+        return self.page_count - 1
+
+    def has_page(self, index) -> bool:
+        """
+        True if there is a page with the given index. This only takes the
+        first item of that page, if there is one.
+        """
+        if index < 0:
+            return False
+        self._fill(index * self.per_page + 1)
+        return index == 0 or index * self.per_page < len(self._seen)
+
+    def render(self, index) -> discord.Embed:
+        """Renders the page with the given index."""
+        start = index * self.per_page
+        # One more item than the page shows, so that we know whether this is
+        # the last page. It is only taken, not rendered.
+        self._fill(start + self.per_page + 1)
+        return self._render(self._seen[start:start + self.per_page],
+                            index, self.page_count)
+
+
+class PageDispatcher:
+    """
+    Turns the pages of messages when they are reacted to. Like
+    :class:`kat18.util.CloseDispatcher`, there is a single listener that
+    looks the message up by ID.
+
+    Both adding and removing a reaction turn the page, so that users can
+    keep pressing the same button without us having to remove their
+    reactions, which needs permissions we may not have.
+    """
+    first = '\N{BLACK LEFT-POINTING DOUBLE TRIANGLE WITH VERTICAL BAR}'
+    previous = '\N{BLACK LEFT-POINTING TRIANGLE}'
+    next = '\N{BLACK RIGHT-POINTING TRIANGLE}'
+    last = '\N{BLACK RIGHT-POINTING DOUBLE TRIANGLE WITH VERTICAL BAR}'
+
+    def __init__(self, bot, timeout=60):
+        self.bot = bot
+        self.timeout = timeout
+        # Message ID -> [message, pages, current page, user ID, expiry timer]
+        self._open = {}
+        bot.add_listener(self.on_reaction_add)
+        bot.add_listener(self.on_reaction_remove)
+
+    def __len__(self):
+        return len(self._open)
+
+    def add(self, msg, pages: LazyPages, user_id):
+        """
+        Lets the user with the given ID turn the pages of the message, which
+        is showing the first page, until they stop for ``timeout`` seconds.
+        """
+        timer = self.bot.scheduler.call_later(
+            self.timeout, self.remove, msg.id)
+        self._open[msg.id] = [msg, pages, 0, user_id, timer]
+
+        # These are queued on the same route, so are added in order.
+        for emote in (self.first, self.previous, self.next, self.last):
+            self.bot.outbox.add_reaction(msg.channel.id, msg.id, emote)
+
+    def remove(self, message_id):
+        """Stops turning the pages of the message."""
+        entry = self._open.pop(message_id, None)
+        if entry is not None:
+            entry[-1].cancel()
+
+    async def on_reaction_add(self, reaction, user):
+        await self._turn(reaction, user)
+
+    async def on_reaction_remove(self, reaction, user):
+        await self._turn(reaction, user)
+
+    async def _turn(self, reaction, user):
+        entry = self._open.get(reaction.message.id)
+        if entry is None:
+            return
+
+        msg, pages, current, user_id, timer = entry
+        if user.id != user_id:
+            return
+
+        if reaction.emoji == self.first:
+            index = 0
+        elif reaction.emoji == self.previous:
+            index = current - 1
+        elif reaction.emoji == self.next:
+            index = current + 1
+        elif reaction.emoji == self.last:
+            index = pages.last_page()
+        else:
+            return
+
+        if index == current or not pages.has_page(index):
+            return
+
+        timer.cancel()
+        entry[2] = index
+        entry[-1] = self.bot.scheduler.call_later(
+            self.timeout, self.remove, msg.id)
+        self.bot.closeables.touch(msg.id)
+
+        try:
+            await msg.edit(embed=pages.render(index))
+        except discord.NotFound:
+            # It was closed.
+            self.remove(msg.id)
+
+
+async def send_pages(ctx, pages: LazyPages):
+    """
+    Sends the first page, and lets the ctx sender turn the pages if there are
+    more, and close the message.
+
+    :param ctx: the original command invocation ctx.
+    :param pages: the pages to send.
+    """
+    msg = await ctx.send(embed=pages.render(0))
+    if pages.has_page(1):
+        ctx.bot.pages.add(msg, pages, ctx.author.id)
+    util.make_closeable(ctx, msg)
+    return msg
@@ -0,0 +1,128 @@
+"""
+Routes each message to the handlers that want it.
+
+Rather than every cog listening to ``on_message`` and redoing the same work,
+the bot normalises each message once into a :class:`MessageView`, and only
+passes it to the handlers whose predicates match it. Predicates should be
+cheap, as they are run for every message.
+"""
+import asyncio
+import typing
+
+import kat18.util as util
+
+
+__all__ = ['MessageView', 'MessagePipeline']
+
+
+class MessageView:
+    """
+    A message, with the things that handlers check worked out once.
+
+    :param message: the message.
+    :param talk_prefix: the casefolded prefix for talking to the bot.
+    :param command_prefixes: the prefixes for commands. These are
+        case-sensitive, like they are for the commands framework.
+    """
+    __slots__ = ['message', 'stripped', 'folded', 'guild_id', 'shard_id',
+                 'channel_id', 'author_id', 'from_bot', 'talk_prefix',
+                 '_talk_prefix_end', 'command_prefix']
+
+    def __init__(self, message, talk_prefix: str,
+                 command_prefixes: typing.Sequence[str]):
+        self.message = message
+
+        content = message.content
+        #: The content without leading whitespace.
+        self.stripped = content.lstrip()
+        #: The stripped content, casefolded.
+        self.folded = self.stripped.casefold()
+
+        guild = message.guild
+        self.guild_id = guild.id if guild is not None else None
+        #: The shard the guild is on. None if not sharded, or not in a guild.
+        self.shard_id = guild.shard_id if guild is not None else None
+        self.channel_id = message.channel.id
+        self.author_id = message.author.id
+        self.from_bot = message.author.bot
+
+        #: The talk prefix if the message starts with it, otherwise None.
+        self.talk_prefix = (talk_prefix if self.folded.startswith(talk_prefix)
+                            else None)
+        self._talk_prefix_end = (self._unfolded_length(talk_prefix)
+                                 if self.talk_prefix is not None else 0)
+        #: The command prefix the message starts with, otherwise None.
+        self.command_prefix = None
+        for prefix in command_prefixes:
+            if content.startswith(prefix):
+                self.command_prefix = prefix
+                break
+
+    @property
+    def in_guild(self) -> bool:
+        return self.guild_id is not None
+
+    def _unfolded_length(self, prefix) -> int:
+        """
+        Gets how much of the stripped content the given prefix of the
+        folded content came from. Casefolding can change the length of the
+        text, as 'ß' becomes 'ss', so the two do not line up.
+        """
+        folded_length = 0
+        for i, char in enumerate(self.stripped):
+            if folded_length >= len(prefix):
+                return i
+            folded_length += len(char.casefold())
+        return len(self.stripped)
+
+    def after_talk_prefix(self) -> str:
+        """Gets the content after the talk prefix, without leading spaces."""
+        return self.stripped[self._talk_prefix_end:].lstrip()
+
+
+class MessagePipeline(util.Loggable):
+    """
+    Handlers, each with a predicate that decides which messages it gets.
+    Each handler is a coroutine function taking a :class:`MessageView`, and
+    is run as its own task, as listeners are.
+    """
+    def __init__(self):
+        self._handlers = []
+
+    def __len__(self):
+        return len(self._handlers)
+
+    def add(self, handler, predicate=None) -> None:
+        """
+        Adds a handler.
+
+        :param handler: the coroutine function to call.
+        :param predicate: a function taking a view, that returns True if the
+            handler wants the message. If None, then it gets every message.
+        """
+        self._handlers.append((predicate, handler))
+
+    def remove(self, handler) -> None:
+        """Removes every registration of the handler."""
+        self._handlers = [(p, h) for p, h in self._handlers if h != handler]
+
+    def matching(self, view: MessageView) -> typing.List:
+        """Gets the handlers that want the message."""
+        return [handler for predicate, handler in self._handlers
+                if predicate is None or predicate(view)]
+
+    def dispatch(self, view: MessageView) -> typing.List[asyncio.Future]:
+        """
+        Starts each handler that wants the message.
+
+        :return: the futures for the handlers that were started.
+        """
+        return [asyncio.ensure_future(self._run(handler, view))
+                for handler in self.matching(view)]
+
+    async def _run(self, handler, view):
+        try:
+            await handler(view)
+        except Exception:
+            self.logger.exception(
+                f'Handler {getattr(handler, "__qualname__", handler)} failed')
@@ -0,0 +1,100 @@
+"""
+Token bucket rate limiting. Buckets refill lazily from timestamps when they
+are looked at, so nothing has to sleep while waiting for them to refill.
+"""
+import time
+import typing
+
+
+__all__ = ['TokenBucket', 'KeyedLimiter']
+
+
+class TokenBucket:
+    """
+    Holds up to ``capacity`` tokens, and gains ``rate`` tokens a second
+    until it is full again.
+    """
+    __slots__ = ['capacity', 'rate', 'tokens', 'stamp']
+
+    def __init__(self, capacity: float, rate: float, now: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.stamp = now
+
+    def refill(self, now: float) -> float:
+        """Tops up the bucket for the time passed, and gets the tokens."""
+        if now > self.stamp:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+        return self.tokens
+
+
+class KeyedLimiter:
+    """
+    Keeps a token bucket per key. Buckets are only made when a key is first
+    used, and are forgotten again once they have refilled, as a full bucket
+    is no different to a new one.
+
+    :param capacity: the most tokens a key can bank.
+    :param per: how many seconds it takes to gain one token.
+    """
+    # How many lookups to make between forgetting full buckets.
+    prune_every = 1024
+
+    def __init__(self, capacity: float, per: float,
+                 clock: typing.Callable[[], float] = time.monotonic):
+        self.capacity = capacity
+        self.rate = 1 / per
+        self.clock = clock
+        self._buckets = {}
+        self._until_prune = self.prune_every
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def tokens(self, key, now: float = None) -> float:
+        """Gets how many tokens the key has available right now."""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.capacity
+        return bucket.refill(self.clock() if now is None else now)
+
+    def take(self, key, now: float = None, tokens: float = 1) -> None:
+        """Takes tokens from the key, even if it leaves the bucket negative."""
+        if now is None:
+            now = self.clock()
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.capacity, self.rate, now)
+            self._buckets[key] = bucket
+        else:
+            bucket.refill(now)
+        bucket.tokens -= tokens
+
+        self._until_prune -= 1
+        if self._until_prune <= 0:
+            self.prune(now)
+
+    def acquire(self, key, now: float = None, tokens: float = 1) -> bool:
+        """Takes tokens from the key if it has enough, and says if it did."""
+        if now is None:
+            now = self.clock()
+
+        if self.tokens(key, now) < tokens:
+            return False
+        self.take(key, now, tokens)
+        return True
+
+    def prune(self, now: float = None) -> None:
+        """Forgets every bucket that has refilled."""
+        if now is None:
+            now = self.clock()
+
+        self._until_prune = self.prune_every
+        full = [key for key, bucket in self._buckets.items()
+                if bucket.refill(now) >= self.capacity]
+        for key in full:
+            del self._buckets[key]
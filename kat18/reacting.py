@@ -1,43 +1,73 @@
-import asyncio
 import random
+import time
 
-import discord
+import kat18.ratelimit as ratelimit
+import kat18.util as util
 
 
 class Reacting:
     """Reacts to messages containing certain words or patterns"""
     def __init__(self, bot):
         self.bot = bot
-        self.buckets = 0
 
-    async def on_message(self, message):
-        # Do not run in DMs, if we are on timeout, or if the author is a bot.
-        if not message.guild or self.buckets > 0 or message.author.bot:
-            return
+        # Each guild, and each channel within it, gets its own allowance of
+        # reactions. By default, that is one every five minutes. Override this
+        # with "reaction_limits" in config.json, for example:
+        # {"guild": {"capacity": 3, "per": 300}, "channel": {...}}
+        self.limits = bot.config.get('reaction_limits', {})
+        # Shard ID -> (guild limiter, channel limiter). Each shard keeps its
+        # own, as a guild and its channels are only ever on one shard. The
+        # shard ID is None if we are not sharded.
+        self._limiters = {}
+
+        # Only messages in guilds that are not from bots.
+        bot.messages.add(self.handle_message,
+                         lambda view: view.in_guild and not view.from_bot)
+
+    def __unload(self):
+        self.bot.messages.remove(self.handle_message)
+
+    @staticmethod
+    def _make_limiter(limit):
+        return ratelimit.KeyedLimiter(
+            capacity=limit.get('capacity', 1),
+            per=limit.get('per', 5 * 60)
+        )
 
-        contains_pattern = False
+    def limiters(self, shard_id):
+        """Gets the guild and channel limiters for the given shard."""
+        limiters = self._limiters.get(shard_id)
+        if limiters is None:
+            limiters = (self._make_limiter(self.limits.get('guild', {})),
+                        self._make_limiter(self.limits.get('channel', {})))
+            self._limiters[shard_id] = limiters
+        return limiters
+
+    @util.handler_seconds.time(handler='reacting')
+    async def handle_message(self, view):
+        message = view.message
+        g_id = view.guild_id
+        c_id = view.channel_id
+        now = time.monotonic()
+        guild_limiter, channel_limiter = self.limiters(view.shard_id)
+
+        # Do not run if this guild or channel is on timeout.
+        if (guild_limiter.tokens(g_id, now) < 1
+                or channel_limiter.tokens(c_id, now) < 1):
+            return
 
-        for pattern in self.bot.patterns:
-            if pattern.match(message.content):
-                contains_pattern = True
-                break
+        matched = self.bot.trigger_matcher.match(
+            message.content, self.bot.trigger_guard)
 
-        if not contains_pattern:
+        if matched is None:
             return
 
         # Get a random emoji, if we have any.
         emojis = self.bot.loaded_emojis
 
-        blacklist = self.bot.dont_react_in.get()
-        c_id = message.channel.id
-        g_id = message.guild.id
+        blacklisted = self.bot.dont_react_in.is_blacklisted(g_id, c_id)
 
-        chan_match = discord.utils.find(
-            lambda c: c == c_id,
-            blacklist.get(str(g_id), {})
-        )
-
-        if chan_match:
+        if blacklisted:
             # We are in a blacklisted channel/server. Skip.
             self.bot.logger.info('Not reacting. Blacklisted channel.')
             return
@@ -48,19 +78,15 @@ class Reacting:
 
         emoji = random.choice(emojis)
 
-        async def react():
-            """Reacts at some point in the next 30 seconds."""
-            await asyncio.sleep(random.randint(0, 30))
-            await message.add_reaction(emoji)
-
-        asyncio.ensure_future(react())
-        asyncio.ensure_future(self.timeout())
+        # React at some point in the next 30 seconds.
+        self.bot.scheduler.call_later(
+            random.randint(0, 30), self.react, c_id, message.id, emoji)
+        guild_limiter.take(g_id, now)
+        channel_limiter.take(c_id, now)
 
-    async def timeout(self):
-        self.buckets += 1
-        # Timeout of 5 minutes
-        await asyncio.sleep(5 * 60)
-        self.buckets -= 1
+    async def react(self, channel_id, message_id, emoji):
+        """Reacts to the message with the given IDs."""
+        await self.bot.outbox.add_reaction(channel_id, message_id, emoji)
 
 
 def setup(bot):
@@ -0,0 +1,119 @@
+"""
+Looks up guilds and channels by ID or name without scanning every guild the
+bot is in.
+"""
+import typing
+
+
+__all__ = ['Resolver']
+
+
+class Resolver:
+    """
+    Indexes guilds by ID and by casefolded name, and guild channels by ID.
+    Like :class:`kat18.emojis.EmojiIndex`, this is kept up to date from the
+    guild and channel events rather than being rebuilt.
+
+    Members are not indexed here, as discord.py already keeps each guild's
+    members in a dictionary, and mirroring them would double the memory the
+    largest guilds take.
+    """
+    def __init__(self):
+        # Guild ID -> guild
+        self._guilds = {}
+        # Casefolded name -> {guild ID: guild}, as names are not unique.
+        self._by_name = {}
+        # Channel ID -> channel
+        self._channels = {}
+        # Guild ID -> IDs of the channels we indexed for it.
+        self._by_guild = {}
+
+    def __len__(self):
+        return len(self._guilds)
+
+    def _add_name(self, guild):
+        self._by_name.setdefault(guild.name.casefold(), {})[guild.id] = guild
+
+    def _remove_name(self, name, guild_id):
+        named = self._by_name.get(name.casefold())
+        if named is not None:
+            named.pop(guild_id, None)
+            if not named:
+                del self._by_name[name.casefold()]
+
+    def add_guild(self, guild):
+        """Indexes the guild and its channels, replacing what we had."""
+        self.remove_guild(guild)
+        self._guilds[guild.id] = guild
+        self._add_name(guild)
+        channel_ids = set()
+        for channel in guild.channels:
+            self._channels[channel.id] = channel
+            channel_ids.add(channel.id)
+        self._by_guild[guild.id] = channel_ids
+
+    def remove_guild(self, guild):
+        """Forgets the guild and its channels."""
+        old = self._guilds.pop(guild.id, None)
+        if old is not None:
+            self._remove_name(old.name, old.id)
+        for channel_id in self._by_guild.pop(guild.id, ()):
+            self._channels.pop(channel_id, None)
+
+    def update_guild(self, before, after):
+        """Reindexes the guild's name from on_guild_update."""
+        if after.id in self._guilds:
+            self._remove_name(before.name, before.id)
+            self._guilds[after.id] = after
+            self._add_name(after)
+
+    def add_channel(self, channel):
+        """Indexes a new channel, or replaces an updated one."""
+        channel_ids = self._by_guild.get(channel.guild.id)
+        if channel_ids is not None:
+            channel_ids.add(channel.id)
+            self._channels[channel.id] = channel
+
+    def remove_channel(self, channel):
+        """Forgets a deleted channel."""
+        self._channels.pop(channel.id, None)
+        self._by_guild.get(channel.guild.id, set()).discard(channel.id)
+
+    def guild(self, guild_id: int):
+        """Gets the guild with the given ID, or None."""
+        return self._guilds.get(guild_id)
+
+    def guilds_named(self, name: str) -> typing.List:
+        """Gets the guilds with the given name, ignoring case."""
+        return list(self._by_name.get(name.casefold(), {}).values())
+
+    def find_guild(self, query: str):
+        """
+        Gets the guild with the given ID or name, or None if there is no
+        such guild.
+
+        :raises ValueError: if several guilds have that name.
+        """
+        if query.isdigit():
+            guild = self.guild(int(query))
+            if guild is not None:
+                return guild
+
+        guilds = self.guilds_named(query)
+        if len(guilds) > 1:
+            raise ValueError(f'{len(guilds)} guilds are called {query}. '
+                             'Use the ID instead.')
+        return guilds[0] if guilds else None
+
+    def channel(self, channel_id: int):
+        """Gets the guild channel with the given ID, or None."""
+        return self._channels.get(channel_id)
+
+    def member(self, guild_id: int, user_id: int):
+        """Gets the member of the given guild, or None."""
+        guild = self._guilds.get(guild_id)
+        return guild.get_member(user_id) if guild is not None else None
+
+    def is_member(self, guild_id: int, user_id: int) -> bool:
+        """True if the user is in the given guild."""
+        return self.member(guild_id, user_id) is not None
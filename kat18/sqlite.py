@@ -0,0 +1,266 @@
+"""
+Stores the bot state in a single SQLite database rather than in a JSON file
+per value. Each value is a document made of rows, so changing one element of
+a list or dict only inserts or deletes the rows for that element.
+
+The connection lives on its own thread, so all access to it goes through a
+single-threaded executor. Use :meth:`SqliteDatabase.storage` as the
+``storage_type`` for :class:`kat18.aio.AsyncJsonValue`.
+
+Run this module with a config directory and a list of JSON files to import
+them into the database ahead of time. Otherwise, each JSON file is imported
+the first time its value is loaded and is not found in the database.
+"""
+import concurrent.futures as futures
+import json
+import os
+import sqlite3
+import sys
+
+import asyncio
+
+import kat18.aio as aio
+import kat18.util as util
+
+
+__all__ = ['SqliteDatabase', 'SqliteStorage']
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS documents (
+    name    TEXT PRIMARY KEY,
+    kind    TEXT NOT NULL,
+    value   TEXT
+);
+CREATE TABLE IF NOT EXISTS items (
+    name    TEXT NOT NULL,
+    key     TEXT,
+    value   TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_by_name ON items (name, key);
+'''
+
+
+def _dumps(value):
+    # Canonical, so that equal values always have equal text and we can
+    # find list items by value.
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def _kind_of(value):
+    if isinstance(value, list):
+        return 'list'
+    elif isinstance(value, dict):
+        return 'dict'
+    else:
+        return 'scalar'
+
+
+class SqliteDatabase(util.Loggable):
+    """A SQLite database in WAL mode that is only touched from one thread."""
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='SQLite worker')
+        self._connection = None
+        self._executor.submit(self._connect).result()
+
+    def _connect(self):
+        self._connection = sqlite3.connect(self.file_name)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode this is still safe against corruption; we can only
+        # lose the last transactions on power loss.
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(_SCHEMA)
+        self.logger.info(f'Opened {self.file_name}')
+
+    def run_blocking(self, func, *args):
+        """Calls func(connection, *args) on the database thread and waits."""
+        return self._executor.submit(self._call, func, *args).result()
+
+    async def run(self, func, *args):
+        """Calls func(connection, *args) on the database thread."""
+        return await asyncio.get_event_loop().run_in_executor(
+            self._executor, self._call, func, *args)
+
+    def _call(self, func, *args):
+        return func(self._connection, *args)
+
+    def close(self):
+        """Closes the connection and waits for the thread to finish."""
+        def close(connection):
+            connection.close()
+        self.run_blocking(close)
+        self._executor.shutdown()
+
+    def storage(self, file_name):
+        """
+        Gets the storage for the value that would otherwise be kept in the
+        given JSON file. Pass this as the ``storage_type`` of a value.
+        """
+        return SqliteStorage(self, file_name)
+
+    def import_json(self, file_name, replace=False):
+        """
+        Imports a JSON file into the database. Unless replace is True, then
+        this does nothing if the value is already in the database.
+
+        :return: True if the file was imported.
+        """
+        storage = self.storage(file_name)
+        if not replace and storage.exists():
+            return False
+        with open(file_name) as fp:
+            value = json.load(fp)
+        self.run_blocking(storage.store, value)
+        self.logger.info(f'Imported {file_name} into {self.file_name}')
+        return True
+
+
+class SqliteStorage(util.Loggable):
+    """
+    Stores one value in a :class:`SqliteDatabase`. The value is named after
+    the JSON file it would otherwise be stored in, minus the extension.
+    """
+    def __init__(self, database, file_name):
+        self.database = database
+        self.file_name = file_name
+        self.name = os.path.splitext(os.path.basename(file_name))[0]
+
+    def exists(self):
+        """True if the value is in the database."""
+        def exists(connection):
+            row = connection.execute(
+                'SELECT 1 FROM documents WHERE name = ?', (self.name,)
+            ).fetchone()
+            return row is not None
+        return self.database.run_blocking(exists)
+
+    def _fetch(self, connection):
+        row = connection.execute(
+            'SELECT kind, value FROM documents WHERE name = ?', (self.name,)
+        ).fetchone()
+
+        if row is None:
+            raise KeyError(self.name)
+
+        kind, value = row
+        if kind == 'scalar':
+            return json.loads(value)
+
+        rows = connection.execute(
+            'SELECT key, value FROM items WHERE name = ? ORDER BY rowid',
+            (self.name,)
+        )
+        if kind == 'list':
+            return [json.loads(v) for _, v in rows]
+        else:
+            return {k: json.loads(v) for k, v in rows}
+
+    def _replace(self, connection, value):
+        kind = _kind_of(value)
+        connection.execute(
+            'INSERT OR REPLACE INTO documents (name, kind, value) '
+            'VALUES (?, ?, ?)',
+            (self.name, kind, _dumps(value) if kind == 'scalar' else None))
+        connection.execute('DELETE FROM items WHERE name = ?', (self.name,))
+
+        if kind == 'list':
+            items = ((self.name, None, _dumps(v)) for v in value)
+        elif kind == 'dict':
+            items = ((self.name, k, _dumps(v)) for k, v in value.items())
+        else:
+            return
+
+        connection.executemany(
+            'INSERT INTO items (name, key, value) VALUES (?, ?, ?)', items)
+
+    def store(self, connection, value):
+        """Replaces the whole value in one transaction."""
+        with connection:
+            self._replace(connection, value)
+
+    def load(self, default_value):
+        """
+        Loads the value. If it is not in the database yet, then the JSON file
+        is imported if it exists, otherwise the default value is stored.
+        """
+        try:
+            return self.database.run_blocking(self._fetch)
+        except KeyError:
+            pass
+
+        if os.path.exists(self.file_name):
+            self.database.import_json(self.file_name)
+        else:
+            self.database.run_blocking(self.store, default_value)
+        return self.database.run_blocking(self._fetch)
+
+    def modified(self):
+        """Nothing else writes to the database, so this is always False."""
+        return False
+
+    async def read(self):
+        """Rereads the value from the database."""
+        return await self.database.run(self._fetch)
+
+    async def write(self, old_value, new_value, unique=False):
+        """Applies the changes between the two values as row changes."""
+        records = aio.diff(old_value, new_value, unique)
+        if records:
+            await self.database.run(self._apply, records)
+
+    def _apply(self, connection, records):
+        with connection:
+            for op, *args in records:
+                if op == 'put':
+                    key, value = args
+                    cursor = connection.execute(
+                        'UPDATE items SET value = ? '
+                        'WHERE name = ? AND key = ?',
+                        (_dumps(value), self.name, key))
+                    if cursor.rowcount == 0:
+                        connection.execute(
+                            'INSERT INTO items (name, key, value) '
+                            'VALUES (?, ?, ?)',
+                            (self.name, key, _dumps(value)))
+                elif op == 'pop':
+                    connection.execute(
+                        'DELETE FROM items WHERE name = ? AND key = ?',
+                        (self.name, args[0]))
+                elif op == 'append':
+                    connection.execute(
+                        'INSERT INTO items (name, key, value) '
+                        'VALUES (?, NULL, ?)',
+                        (self.name, _dumps(args[0])))
+                elif op == 'add':
+                    connection.execute(
+                        'INSERT INTO items (name, key, value) '
+                        'SELECT ?, NULL, ? WHERE NOT EXISTS ('
+                        '    SELECT 1 FROM items'
+                        '    WHERE name = ? AND value = ?)',
+                        (self.name, _dumps(args[0]),
+                         self.name, _dumps(args[0])))
+                elif op == 'remove':
+                    connection.execute(
+                        'DELETE FROM items WHERE rowid = ('
+                        '    SELECT rowid FROM items'
+                        '    WHERE name = ? AND value = ?'
+                        '    ORDER BY rowid LIMIT 1)',
+                        (self.name, _dumps(args[0])))
+                elif op == 'replace':
+                    self._replace(connection, args[0])
+                else:
+                    raise ValueError(f'Unknown record {op!r}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(f'USAGE: {sys.argv[0]} config-path json-file...')
+        exit(1)
+
+    db = SqliteDatabase(os.path.join(sys.argv[1], 'state.sqlite3'))
+    for json_file in sys.argv[2:]:
+        db.import_json(os.path.join(sys.argv[1], json_file), replace=True)
+    db.close()
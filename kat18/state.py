@@ -0,0 +1,119 @@
+"""
+Typed state containers built on top of :class:`kat18.aio.AsyncJsonValue`.
+
+These keep the same JSON representation on disk as before, but maintain
+indexes in memory so that the checks made for every message are O(1).
+"""
+import typing
+
+import kat18.aio as aio
+
+
+__all__ = ['CommanderSet', 'ChannelBlacklist']
+
+
+class CommanderSet(aio.AsyncJsonValue):
+    """
+    The IDs of users authorized to command the bot. Stored as a JSON list of
+    user IDs.
+    """
+    unique_items = True
+
+    def __init__(self, file_name, **kwargs):
+        self._ids = frozenset()
+        super().__init__(file_name, [], **kwargs)
+
+    def _reindex(self, snapshot):
+        self._ids = frozenset(snapshot)
+
+    def __contains__(self, user_id):
+        return user_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    async def add(self, user_id: int) -> bool:
+        """
+        Authorizes the given user ID. Returns False if it was already
+        authorized.
+        """
+        if user_id in self._ids:
+            return False
+        await self.set([*self.snapshot(), user_id])
+        return True
+
+    async def remove(self, user_id: int) -> bool:
+        """
+        De-authorizes the given user ID. Returns False if it was not
+        authorized in the first place.
+        """
+        if user_id not in self._ids:
+            return False
+        await self.set([i for i in self.snapshot() if i != user_id])
+        return True
+
+
+class ChannelBlacklist(aio.AsyncJsonValue):
+    """
+    Channels that the bot should not react in, grouped by guild. Stored as a
+    JSON object mapping the guild ID as a string to a list of channel IDs,
+    as JSON does not allow integer keys.
+    """
+    def __init__(self, file_name, **kwargs):
+        self._index = {}
+        super().__init__(file_name, {}, **kwargs)
+
+    def _reindex(self, snapshot):
+        self._index = {
+            int(guild_id): frozenset(channels)
+            for guild_id, channels in snapshot.items()
+            if channels
+        }
+
+    def is_blacklisted(self, guild_id: int, channel_id: int) -> bool:
+        """Determines if the given channel in the given guild is blacklisted."""
+        channels = self._index.get(guild_id)
+        return channels is not None and channel_id in channels
+
+    def channels(self, guild_id: int) -> typing.FrozenSet[int]:
+        """Gets the blacklisted channel IDs for the given guild ID."""
+        return self._index.get(guild_id, frozenset())
+
+    def items(self) -> typing.ItemsView[int, typing.FrozenSet[int]]:
+        """Gets the guild IDs and blacklisted channel IDs for each guild."""
+        return self._index.items()
+
+    def __len__(self):
+        return len(self._index)
+
+    async def add(self, guild_id: int, channel_id: int) -> bool:
+        """
+        Blacklists the given channel. Returns False if it was already
+        blacklisted.
+        """
+        if self.is_blacklisted(guild_id, channel_id):
+            return False
+        index = dict(self._index)
+        index[guild_id] = index.get(guild_id, frozenset()) | {channel_id}
+        await self.set(self._to_json(index))
+        return True
+
+    async def remove(self, guild_id: int, channel_id: int) -> bool:
+        """
+        Un-blacklists the given channel. Returns False if it was not
+        blacklisted in the first place.
+        """
+        if not self.is_blacklisted(guild_id, channel_id):
+            return False
+        index = dict(self._index)
+        index[guild_id] = index[guild_id] - {channel_id}
+        await self.set(self._to_json(index))
+        return True
+
+    @staticmethod
+    def _to_json(index):
+        return {
+            str(guild_id): sorted(channels)
+            for guild_id, channels in index.items()
+            if channels
+        }
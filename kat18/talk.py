@@ -2,11 +2,23 @@
 Handles talking.
 """
 import asyncio
+import time
 import traceback
 import random
 
 import discord
 
+import kat18.metrics as metrics
+import kat18.outbox as outbox
+import kat18.util as util
+
+
+# The delay is on purpose, so it is kept out of the handler's timing.
+talk_typing_seconds = metrics.Histogram(
+    'kat18_talk_typing_seconds',
+    'Time spent pretending to type before replying.',
+    buckets=(1, 2, 3, 5, 10, 20, 30))
+
 
 def talk_time(msg):
     """Formulae for calculating how long to type for."""
@@ -18,32 +30,44 @@ class Talk:
     def __init__(self, bot):
         self.bot = bot
 
-    async def on_message(self, message):
-        """Handles replying to users."""
+        # Only messages that start with the prefix, such as "kat:"
+        bot.messages.add(self.handle_message,
+                         lambda view: view.talk_prefix is not None)
 
-        try:
-            expected_pre = f'{self.bot.name.lower()}:'
+    def __unload(self):
+        self.bot.messages.remove(self.handle_message)
 
-            # Return if we don't start with the prefix.
-            if not message.content.lstrip().lower().startswith(expected_pre):
-                return
+    async def handle_message(self, view):
+        """Handles replying to users."""
+        message = view.message
+        start = time.perf_counter()
+        typing_time = 0
 
+        try:
             # If the user is unauthorised, reply with an angry face.
-            if message.author.id not in self.bot.commanders:
-                await message.add_reaction('\N{ANGRY FACE}')
+            if view.author_id not in self.bot.commanders:
+                self.bot.outbox.add_reaction(view.channel_id, message.id,
+                                             '\N{ANGRY FACE}')
                 return
             async with message.channel.typing():
-                await message.delete()
+                self.bot.outbox.delete_message(view.channel_id, message.id,
+                                               priority=outbox.ACTION)
 
                 # Remove the prefix from the message content
-                message.content = message.content[len(expected_pre):].lstrip()
+                message.content = view.after_talk_prefix()
 
-                await asyncio.sleep(talk_time(message))
-                await message.channel.send(message.content)
+                typing_time = talk_time(message)
+                talk_typing_seconds.observe(typing_time)
+                await asyncio.sleep(typing_time)
+                await self.bot.outbox.send(message.channel, message.content)
 
         except discord.DiscordException as ex:
             traceback.print_exc()
-            await message.channel.send(f'`{type(ex).__name__}: {str(ex)}.`')
+            await self.bot.outbox.send(message.channel,
+                                       f'`{type(ex).__name__}: {str(ex)}.`')
+        finally:
+            took = time.perf_counter() - start - typing_time
+            util.handler_seconds.observe(max(0, took), handler='talk')
 
 
 def setup(bot):
@@ -0,0 +1,622 @@
+"""
+Single-pass trigger matching.
+
+Each message used to be run past every compiled trigger one after the other.
+Instead, we now build a matcher once whenever the patterns change. All of the
+literal words added with "add word" get merged into a single trie that is
+rendered as one regular expression, and any raw regular expressions get
+indexed by a literal string they cannot match without. Those literals are
+merged into a second trie, so one pass over the message tells us which of the
+raw expressions are even worth running.
+
+Raw expressions can be slow, and once the regex engine is running it cannot
+be interrupted. So new expressions are screened against a corpus of sample
+messages in a separate process that can be killed, and while matching we
+keep to a time budget per message, quarantining expressions that keep going
+over it.
+"""
+import functools
+import logging
+import multiprocessing
+import re
+import time
+import typing
+
+import asyncio
+
+import kat18.metrics as metrics
+
+try:
+    import re._parser as sre_parse
+except ImportError:
+    # Python < 3.11
+    import sre_parse
+
+
+__all__ = ['TriggerMatcher', 'TriggerRegistry', 'TriggerGuard',
+           'compile_trigger', 'word_phrase', 'screen', 'DEFAULT_CORPUS']
+
+
+# Flags every trigger is compiled with.
+FLAGS = re.I | re.U | re.M
+
+# The only ASCII characters that match something other than their lowercase
+# self under re.I | re.U are 'i' and 's' (dotted capital I, dotless i, and
+# the long s). Folding these means that str.lower() agrees with the regex
+# engine for any ASCII literal we extract. This has to be done before
+# lowering, as 'İ'.lower() is two code points, 'i' and a combining dot.
+_ASCII_FOLD = {0x130: 'i', 0x131: 'i', 0x17f: 's'}
+
+# Literals shorter than this are too common to be worth prefiltering on.
+_MIN_LITERAL = 2
+
+# Sample messages to screen new triggers with. These are mostly long runs of
+# the same few characters, which is what sets off catastrophic backtracking.
+DEFAULT_CORPUS = [
+    'Kat',
+    'hello there, how are you doing today?',
+    'a' * 64,
+    'a' * 64 + '!',
+    'a' * 2000,
+    'a' * 1999 + '!',
+    'ab' * 1000,
+    ' ' * 2000,
+    'x ' * 1000,
+    '.' * 2000,
+    '1' * 2000,
+    'aA1 ' * 500,
+    '<:kat:1234567890> ' * 100,
+    'the quick brown fox jumps over the lazy dog ' * 45,
+]
+
+trigger_matches = metrics.Counter(
+    'kat18_trigger_matches_total',
+    'Messages each trigger matched.',
+    ['pattern'])
+trigger_seconds = metrics.Histogram(
+    'kat18_trigger_seconds',
+    'Time each raw regex trigger took to run on a message.',
+    ['pattern'])
+
+# How many compiled triggers, and what we worked out about them, to remember.
+# This is kept across reloads, so only new triggers ever need compiling.
+_CACHE_SIZE = 4096
+
+
+def fold(text: str) -> str:
+    """Case-folds text the same way the prefilter literals are folded."""
+    return text.translate(_ASCII_FOLD).lower()
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def compile_trigger(source: str) -> typing.Pattern:
+    """Compiles the source of a trigger."""
+    return re.compile(source, flags=FLAGS)
+
+
+def _parse(pattern: typing.Pattern):
+    # noinspection PyBroadException
+    try:
+        return sre_parse.parse(pattern.pattern, pattern.flags)
+    except BaseException:
+        return None
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def word_phrase(pattern: typing.Pattern) -> typing.Optional[str]:
+    """
+    If the pattern is a plain-text phrase added with "add word", that is
+    ``\\b(phrase)\\b``, then return the phrase. Otherwise, return None.
+    """
+    parsed = _parse(pattern)
+    if parsed is None or len(parsed) != 3:
+        return None
+
+    (lop, lav), (mop, mav), (rop, rav) = parsed
+    if not (lop is rop is sre_parse.AT
+            and lav is rav is sre_parse.AT_BOUNDARY
+            and mop is sre_parse.SUBPATTERN):
+        return None
+
+    body = mav[-1]
+    if not body or any(op is not sre_parse.LITERAL for op, _ in body):
+        return None
+    return ''.join(chr(av) for _, av in body)
+
+
+def _literal_runs(parsed, runs=None):
+    """
+    Collects runs of consecutive literal characters that any match of the
+    parsed expression must contain, in folded form. Anything we do not
+    understand just ends the current run.
+    """
+    if runs is None:
+        runs = ['']
+
+    for op, av in parsed:
+        if op is sre_parse.LITERAL and av < 0x80:
+            runs[-1] += chr(av).lower()
+        elif op is sre_parse.SUBPATTERN:
+            # Groups are just sequences. Keep extending the current run.
+            _literal_runs(av[-1], runs)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] > 0:
+            # The body must occur at least once, but it is not contiguous with
+            # what surrounds it.
+            runs.append('')
+            _literal_runs(av[-1], runs)
+            runs.append('')
+        elif op is sre_parse.AT:
+            # Zero-width assertions do not break a run.
+            continue
+        else:
+            runs.append('')
+    return runs
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def required_literal(pattern: typing.Pattern) -> typing.Optional[str]:
+    """
+    Gets the longest folded literal that must occur in any string the pattern
+    matches, or None if we could not find a useful one.
+    """
+    parsed = _parse(pattern)
+    if parsed is None:
+        return None
+    literal = max(_literal_runs(parsed), key=len)
+    return literal if len(literal) >= _MIN_LITERAL else None
+
+
+class _Trie:
+    """A character trie that renders to an equivalent regular expression."""
+    __slots__ = ['root']
+
+    def __init__(self, words=()):
+        self.root = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        node = self.root
+        for ch in word:
+            node = node.setdefault(ch, {})
+        # The empty string never clashes with a character, so use it to mark
+        # the end of a word.
+        node[''] = True
+
+    def pattern(self) -> str:
+        """
+        Renders the trie as a regular expression. Branches are greedy, so the
+        longest word at a given position is preferred.
+        """
+        return self._render(self.root)
+
+    @classmethod
+    def _render(cls, node) -> str:
+        parts = []
+        # Collapse chains of single characters without recursing, otherwise
+        # one long phrase would blow the stack.
+        while len(node) == 1 and '' not in node:
+            (ch, node), = node.items()
+            parts.append(re.escape(ch))
+
+        branches = [re.escape(ch) + cls._render(child)
+                    for ch, child in node.items() if ch]
+
+        if branches:
+            group = '(?:' + '|'.join(branches) + ')'
+            parts.append(group + '?' if '' in node else group)
+
+        return ''.join(parts)
+
+
+class TriggerMatcher:
+    """
+    Immutable matcher built from a list of compiled trigger patterns. Rebuild
+    it whenever the patterns change; never per message.
+
+    Matching keeps the semantics of calling ``pattern.match(content)`` on each
+    pattern in turn. Word triggers are tried first, then raw expressions in
+    the order they were given.
+    """
+    __slots__ = ['patterns', '_words', '_word_regex', '_unfiltered',
+                 '_candidates', '_literal_regex']
+
+    def __init__(self, patterns: typing.Iterable[typing.Pattern]):
+        self.patterns = tuple(patterns)
+
+        # Folded phrase -> pattern for each "add word" trigger.
+        self._words = {}
+        # Patterns that have no usable literal, so always have to be run.
+        self._unfiltered = []
+        # Literal -> patterns that require that literal.
+        by_literal = {}
+        phrases = []
+
+        for index, pattern in enumerate(self.patterns):
+            phrase = word_phrase(pattern)
+            if phrase is not None:
+                self._words.setdefault(fold(phrase), pattern)
+                phrases.append(phrase)
+                continue
+
+            literal = required_literal(pattern)
+            if literal is None:
+                self._unfiltered.append((index, pattern))
+            else:
+                by_literal.setdefault(literal, []).append((index, pattern))
+
+        if phrases:
+            trie = _Trie(phrases)
+            self._word_regex = re.compile(
+                '\\b(' + trie.pattern() + ')\\b', flags=FLAGS)
+        else:
+            self._word_regex = None
+
+        # The literal regex reports the longest literal starting at each
+        # position. Any shorter literal that is a prefix of it also occurs
+        # there, so pre-compute that closure now rather than per message.
+        self._candidates = {}
+        for literal in by_literal:
+            self._candidates[literal] = [
+                entry
+                for i in range(_MIN_LITERAL, len(literal) + 1)
+                for entry in by_literal.get(literal[:i], ())
+            ]
+
+        if by_literal:
+            trie = _Trie(by_literal)
+            self._literal_regex = re.compile('(?=(' + trie.pattern() + '))')
+        else:
+            self._literal_regex = None
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def candidates(self, content: str) -> typing.List[typing.Pattern]:
+        """
+        Gets the raw regular expressions that may match the content, in the
+        order they were given.
+        """
+        found = dict(self._unfiltered)
+
+        if self._literal_regex is not None:
+            for match in self._literal_regex.finditer(fold(content)):
+                found.update(self._candidates[match.group(1)])
+
+        return [found[index] for index in sorted(found)]
+
+    def match(self, content: str,
+              guard: 'TriggerGuard' = None) -> typing.Optional[typing.Pattern]:
+        """
+        Gets the first trigger pattern that matches the content, or None if
+        nothing matches.
+
+        If a guard is given, then each raw expression is timed and reported
+        to it, and we give up once the guard's budget for the message is
+        spent.
+        """
+        if self._word_regex is not None:
+            match = self._word_regex.match(content)
+            if match is not None:
+                pattern = self._words.get(fold(match.group(1)))
+                if pattern is None:
+                    # Case-folding disagreed with the regex engine somewhere.
+                    pattern = next((p for p in self._words.values()
+                                    if p.match(content)), None)
+                if pattern is not None:
+                    if guard is not None:
+                        guard.matched(pattern)
+                    return pattern
+
+        if guard is None:
+            for pattern in self.candidates(content):
+                if pattern.match(content):
+                    return pattern
+            return None
+
+        spent = 0.0
+        for pattern in self.candidates(content):
+            start = time.perf_counter()
+            matched = pattern.match(content)
+            took = time.perf_counter() - start
+
+            guard.record(pattern, took)
+            if matched:
+                guard.matched(pattern)
+                return pattern
+
+            spent += took
+            if spent > guard.budget:
+                guard.over_budget(content)
+                return None
+
+        return None
+
+
+class TriggerRegistry:
+    """
+    The current triggers, keyed by their source, in the order they were
+    added. Adding or removing a trigger only compiles that trigger, then
+    rebuilds the matcher once.
+
+    Raw expressions that are loaded, rather than added, have not been
+    screened, so they are left out of the matcher until they have been
+    (see :func:`screen` and :meth:`passed`).
+    """
+    def __init__(self, sources: typing.Iterable[str] = (),
+                 quarantined: typing.Iterable[str] = ()):
+        # Source -> compiled pattern.
+        self._compiled = {}
+        # Lowercase source -> sources, for case-insensitive lookups.
+        self._folded = {}
+        # Sources that are too slow to run. The matcher leaves these out.
+        self.quarantined = set(quarantined)
+        # Raw expressions that still need screening. The matcher leaves
+        # these out too.
+        self.unscreened = set()
+        self.matcher = TriggerMatcher(())
+        self.load(sources)
+
+    def __len__(self):
+        return len(self._compiled)
+
+    def __contains__(self, source):
+        return source in self._compiled
+
+    @property
+    def sources(self) -> typing.List[str]:
+        """Gets the source of each trigger."""
+        return list(self._compiled)
+
+    @property
+    def patterns(self) -> typing.List[typing.Pattern]:
+        """Gets each compiled trigger."""
+        return list(self._compiled.values())
+
+    def _add(self, source, screened=True):
+        pattern = compile_trigger(source)
+        self._compiled[source] = pattern
+        self._folded.setdefault(source.lower(), []).append(source)
+        if not screened and word_phrase(pattern) is None:
+            self.unscreened.add(source)
+
+    def _rebuild(self):
+        self.matcher = TriggerMatcher(
+            pattern for source, pattern in self._compiled.items()
+            if source not in self.quarantined
+            and source not in self.unscreened)
+
+    def load(self, sources: typing.Iterable[str]) -> None:
+        """
+        Replaces all triggers with the given ones. Any raw expressions need
+        screening before they are matched.
+        """
+        self._compiled.clear()
+        self._folded.clear()
+        self.unscreened.clear()
+        for source in sources:
+            if source not in self._compiled:
+                self._add(source, screened=False)
+        self._rebuild()
+
+    def sync(self, sources: typing.Iterable[str],
+             quarantined: typing.Iterable[str]) -> typing.List[str]:
+        """
+        Replaces all triggers with the given ones, only compiling those that
+        are new, then rebuilds the matcher once. Sources that do not compile
+        are left out, and new raw expressions need screening before they are
+        matched.
+
+        :return: the sources that did not compile.
+        """
+        compiled, self._compiled = self._compiled, {}
+        self._folded.clear()
+        failed = []
+        for source in sources:
+            if source in self._compiled:
+                continue
+            elif source in compiled:
+                self._compiled[source] = compiled[source]
+                self._folded.setdefault(source.lower(), []).append(source)
+            else:
+                try:
+                    self._add(source, screened=False)
+                except re.error:
+                    failed.append(source)
+
+        self.unscreened.intersection_update(self._compiled)
+        self.quarantined = set(quarantined)
+        self._rebuild()
+        return failed
+
+    def get(self, source: str, ignore_case=False) -> typing.Optional[str]:
+        """
+        Gets the source of the trigger that matches the given source, or None
+        if there is no such trigger.
+        """
+        if source in self._compiled:
+            return source
+        elif ignore_case:
+            matches = self._folded.get(source.lower())
+            return matches[0] if matches else None
+        else:
+            return None
+
+    def add(self, source: str) -> bool:
+        """
+        Adds a trigger. Returns False if it already existed.
+
+        :raises re.error: if the source does not compile.
+        """
+        if source in self._compiled:
+            return False
+        self._add(source)
+        self._rebuild()
+        return True
+
+    def remove(self, source: str) -> bool:
+        """Removes a trigger. Returns False if it did not exist."""
+        if self._compiled.pop(source, None) is None:
+            return False
+
+        folded = self._folded[source.lower()]
+        folded.remove(source)
+        if not folded:
+            del self._folded[source.lower()]
+
+        self.quarantined.discard(source)
+        self.unscreened.discard(source)
+        self._rebuild()
+        return True
+
+    def passed(self, sources: typing.Iterable[str]) -> None:
+        """
+        Starts matching the given raw expressions, now that they have passed
+        screening.
+        """
+        self.unscreened.difference_update(sources)
+        self._rebuild()
+
+    def quarantine(self, source: str) -> bool:
+        """
+        Stops matching a trigger, without removing it. Returns False if it
+        was not a trigger, or was already quarantined.
+        """
+        if source not in self._compiled or source in self.quarantined:
+            return False
+        self.quarantined.add(source)
+        self._rebuild()
+        return True
+
+    def release(self, source: str) -> bool:
+        """
+        Starts matching a quarantined trigger again. Returns False if it was
+        not quarantined.
+        """
+        if source not in self.quarantined:
+            return False
+        self.quarantined.discard(source)
+        self._rebuild()
+        return True
+
+
+class TriggerGuard:
+    """
+    Keeps track of how long raw expressions take to run. Each time one takes
+    longer than ``slow`` seconds on a message, it gets a strike, and once it
+    has ``strikes`` strikes within ``window`` seconds, ``on_quarantine`` is
+    called with its source. Older strikes are forgotten, so the odd slow run
+    from a GC pause or a busy host never adds up to a quarantine.
+
+    :param budget: seconds of raw expression matching to allow per message.
+    """
+    logger = logging.getLogger('TriggerGuard')
+
+    def __init__(self, on_quarantine: typing.Callable[[str], None],
+                 budget=0.005, slow=0.001, strikes=3, window=60.0):
+        self.on_quarantine = on_quarantine
+        self.budget = budget
+        self.slow = slow
+        self.strikes = strikes
+        self.window = window
+        # Source -> times of the strikes within the window.
+        self._strikes = {}
+        self.messages_over_budget = 0
+
+    def record(self, pattern: typing.Pattern, took: float) -> None:
+        """Records how long a pattern took to run on a message."""
+        trigger_seconds.observe(took, pattern=pattern.pattern)
+        if took <= self.slow:
+            return
+
+        source = pattern.pattern
+        now = time.monotonic()
+        times = [t for t in self._strikes.get(source, ())
+                 if now - t < self.window]
+        times.append(now)
+        self.logger.warning(f'Pattern {source} took {took * 1000:.2f}ms '
+                            f'(strike {len(times)} of {self.strikes})')
+
+        if len(times) >= self.strikes:
+            self._strikes.pop(source, None)
+            self.logger.warning(f'Quarantining pattern {source}')
+            self.on_quarantine(source)
+        else:
+            self._strikes[source] = times
+
+    @staticmethod
+    def matched(pattern: typing.Pattern) -> None:
+        """Records that a pattern matched a message."""
+        trigger_matches.inc(pattern=pattern.pattern)
+
+    def over_budget(self, content: str) -> None:
+        """Records that we gave up on a message."""
+        self.messages_over_budget += 1
+        self.logger.warning(
+            f'Gave up matching after {self.budget * 1000:.2f}ms on a message '
+            f'{len(content)} characters long')
+
+    def forget(self, source: str) -> None:
+        """Clears the strikes for a pattern."""
+        self._strikes.pop(source, None)
+
+
+def _time_pattern(source, samples, connection):
+    """Runs in a child process. Sends back the slowest time for a sample."""
+    pattern = re.compile(source, flags=FLAGS)
+    worst = 0.0
+    for sample in samples:
+        start = time.perf_counter()
+        pattern.match(sample)
+        worst = max(worst, time.perf_counter() - start)
+    connection.send(worst)
+    connection.close()
+
+
+async def screen(source: str, samples: typing.Sequence[str],
+                 timeout=2.0) -> float:
+    """
+    Times a pattern against each sample message in a child process, which
+    is killed if it takes longer than the timeout.
+
+    :return: the slowest time for a single sample, in seconds.
+    :raises TimeoutError: if the timeout ran out.
+    :raises re.error: if the pattern does not compile.
+    """
+    compile_trigger(source)
+
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_time_pattern,
+        args=(source, list(samples), sender),
+        daemon=True)
+    process.start()
+    sender.close()
+
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+
+    try:
+        while not receiver.poll():
+            if not process.is_alive():
+                if receiver.poll():
+                    break
+                raise RuntimeError('The screening process died.')
+            if loop.time() > deadline:
+                raise TimeoutError(
+                    f'Pattern took more than {timeout}s on the sample '
+                    'messages.')
+            await asyncio.sleep(0.01)
+
+        try:
+            return receiver.recv()
+        except EOFError:
+            raise RuntimeError('The screening process died.') from None
+    finally:
+        receiver.close()
+        if process.is_alive():
+            process.terminate()
+        # Reaping the process can block, so keep it off the event loop.
+        await loop.run_in_executor(None, functools.partial(
+            process.join, timeout=1))
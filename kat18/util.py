@@ -4,13 +4,33 @@ Utility classes and methods.
 
 import abc
 import asyncio
+import heapq
+import itertools
 import logging
+import time
 import traceback
 
 import discord
 import discord.ext.commands as commands
 
-__all__ = ['Loggable', 'KatCommand', 'command', 'group', 'confirm_operation']
+import kat18.metrics as metrics
+
+__all__ = ['Loggable', 'KatCommand', 'command', 'group', 'confirm_operation',
+           'Scheduler', 'Coalescer', 'reaction_emoji', 'delete_message',
+           'handler_seconds']
+
+
+# Cogs time their message handlers with this, labelled by cog.
+handler_seconds = metrics.Histogram(
+    'kat18_message_handler_seconds',
+    'Time message handlers took, including any awaiting they did.',
+    ['handler'])
+
+# The bot points this at its scheduler.
+scheduler_depth = metrics.Gauge(
+    'kat18_scheduler_depth',
+    'Delayed callbacks waiting to run.',
+    func=lambda: 0)
 
 
 class Loggable(abc.ABC):
@@ -89,20 +109,254 @@ def group(**kwargs):
 check = commands.check
 
 
+class Timer:
+    """A callback waiting in a :class:`Scheduler`."""
+    __slots__ = ['when', 'seq', 'callback', 'args', 'cancelled', '_scheduler']
+
+    def __init__(self, when, seq, callback, args, scheduler):
+        self.when = when
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self._scheduler = scheduler
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self):
+        """Stops the callback from being run, if it has not run yet."""
+        if not self.cancelled:
+            self.cancelled = True
+            self._scheduler._cancelled(self)
+
+
+class Scheduler(Loggable):
+    """
+    Runs delayed callbacks from a single task, rather than having a sleeping
+    task per callback. Pending callbacks are kept in a heap ordered by when
+    they are due.
+
+    Callbacks should only hold onto what they need (for example, IDs rather
+    than whole messages), as they may wait around for a while. If a callback
+    returns an awaitable, then it is run as a future.
+    """
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._depth = 0
+        self._task = None
+        self._wakeup = None
+
+    @property
+    def depth(self):
+        """The number of callbacks still waiting to run."""
+        return self._depth
+
+    def call_later(self, delay, callback, *args) -> Timer:
+        """
+        Runs callback(*args) after delay seconds.
+
+        :return: a timer that can be used to cancel the callback.
+        """
+        loop = asyncio.get_event_loop()
+        timer = Timer(loop.time() + delay, next(self._seq), callback, args,
+                      self)
+        heapq.heappush(self._heap, timer)
+        self._depth += 1
+
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        elif self._heap[0] is timer:
+            # Due sooner than whatever we were waiting for.
+            self._wakeup.set()
+
+        return timer
+
+    def _cancelled(self, _timer):
+        # Cancelled timers are left in the heap and skipped when they are
+        # popped, but they no longer count.
+        self._depth -= 1
+
+    def close(self):
+        """Cancels everything, and stops the task."""
+        for timer in self._heap:
+            timer.cancelled = True
+        self._heap.clear()
+        self._depth = 0
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            while self._heap and self._heap[0].cancelled:
+                heapq.heappop(self._heap)
+
+            if not self._heap:
+                # Nothing left. call_later starts a new task when needed.
+                return
+
+            delay = self._heap[0].when - loop.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            timer = heapq.heappop(self._heap)
+            timer.cancelled = True
+            self._depth -= 1
+
+            # noinspection PyBroadException
+            try:
+                result = timer.callback(*timer.args)
+                if asyncio.iscoroutine(result) or isinstance(
+                        result, asyncio.Future):
+                    asyncio.ensure_future(result)
+            except BaseException:
+                self.logger.exception(f'Error in {timer.callback}')
+
+
+class Coalescer(Loggable):
+    """
+    Merges requests to run a coroutine function into one run, once no more
+    requests have come in for ``delay`` seconds. So that a constant stream of
+    requests cannot put it off forever, it runs at most ``max_delay`` seconds
+    after the first request it is merging.
+    """
+    def __init__(self, scheduler, coro_func, delay, max_delay=None):
+        self.scheduler = scheduler
+        self.coro_func = coro_func
+        self.delay = delay
+        self.max_delay = max_delay
+        self.pending = 0
+        self._first = None
+        self._timer = None
+        # Stats for the last run.
+        self.last_merged = 0
+        self.last_duration = 0.0
+
+    def request(self):
+        """Asks for a run, merging it with any other pending requests."""
+        now = asyncio.get_event_loop().time()
+        if self._timer is None:
+            self._first = now
+        else:
+            self._timer.cancel()
+
+        delay = self.delay
+        if self.max_delay is not None:
+            delay = max(0, min(delay, self._first + self.max_delay - now))
+
+        self.pending += 1
+        self._timer = self.scheduler.call_later(delay, self._run)
+
+    async def _run(self):
+        merged, self.pending = self.pending, 0
+        self._timer = None
+
+        start = time.perf_counter()
+        try:
+            await self.coro_func()
+        finally:
+            self.last_merged = merged
+            self.last_duration = time.perf_counter() - start
+            self.logger.info(
+                f'Ran {self.coro_func.__name__} in '
+                f'{self.last_duration * 1000:.1f}ms for {merged} request(s)')
+
+
+def reaction_emoji(emoji):
+    """
+    Gets the form of an emoji that the HTTP API takes, so that we can react
+    to a message from just its ID.
+    """
+    if isinstance(emoji, str):
+        return emoji.strip('<>')
+    else:
+        return f'{emoji.name}:{emoji.id}'
+
+
+async def delete_message(bot, channel_id, message_id):
+    """
+    Deletes a message given its IDs. This is queued behind anything more
+    important in the bot's outbox. If the message is already gone, then this
+    does nothing.
+    """
+    await bot.outbox.delete_message(channel_id, message_id)
+
+
 def confirm_operation(ctx):
     """
     Confirms an operation's success by replying to a ctx and deleting
     after a few seconds.
     """
-    async def coro():
-        asyncio.ensure_future(ctx.message.add_reaction('\N{OK HAND SIGN}'))
-        await asyncio.sleep(5)
-        # noinspection PyBroadException
-        try:
-            await ctx.message.delete()
-        except BaseException:
-            pass
-    asyncio.ensure_future(coro())
+    ctx.bot.outbox.add_reaction(ctx.channel.id, ctx.message.id,
+                                '\N{OK HAND SIGN}')
+    ctx.bot.scheduler.call_later(
+        5, delete_message, ctx.bot, ctx.channel.id, ctx.message.id)
+
+
+class CloseDispatcher:
+    """
+    Lets users close messages by reacting to them. Rather than each message
+    waiting on its own check for every reaction, there is a single listener
+    that looks the message up by ID. Messages that nobody closes expire
+    through the bot's scheduler.
+    """
+    emote = '\N{REGIONAL INDICATOR SYMBOL LETTER X}'
+
+    def __init__(self, bot, timeout=60):
+        self.bot = bot
+        self.timeout = timeout
+        # Message ID -> (channel ID, ID of who may close it, expiry timer)
+        self._open = {}
+        bot.add_listener(self.on_reaction_add)
+
+    def __len__(self):
+        return len(self._open)
+
+    def add(self, msg, closer_id):
+        """
+        Makes the message closeable by the user with the given ID. It will be
+        deleted when they close it, or when it times out.
+        """
+        timer = self.bot.scheduler.call_later(
+            self.timeout, self.close, msg.id)
+        self._open[msg.id] = msg.channel.id, closer_id, timer
+        self.bot.outbox.add_reaction(msg.channel.id, msg.id, self.emote)
+
+    def touch(self, message_id):
+        """Restarts the timeout of a message that is still open."""
+        entry = self._open.get(message_id)
+        if entry is not None:
+            channel_id, closer_id, timer = entry
+            timer.cancel()
+            timer = self.bot.scheduler.call_later(
+                self.timeout, self.close, message_id)
+            self._open[message_id] = channel_id, closer_id, timer
+
+    def close(self, message_id):
+        """Deletes the message if it is still open."""
+        entry = self._open.pop(message_id, None)
+        if entry is not None:
+            channel_id, _, timer = entry
+            timer.cancel()
+            self.bot.outbox.delete_message(channel_id, message_id)
+
+    async def on_reaction_add(self, reaction, user):
+        entry = self._open.get(reaction.message.id)
+        if entry is None:
+            return
+
+        _, closer_id, _ = entry
+        if user.id == closer_id and reaction.emoji == self.emote:
+            self.close(reaction.message.id)
 
 
 def make_closeable(ctx, msg):
@@ -115,27 +369,4 @@ def make_closeable(ctx, msg):
     :param ctx: the original command invocation ctx.
     :param msg: the message to destroy.
     """
-    # noInspection PyBroadException
-    try:
-        emote = '\N{REGIONAL INDICATOR SYMBOL LETTER X}'
-        asyncio.ensure_future(msg.add_reaction(emote))
-
-        async def callback():
-            nonlocal emote
-            nonlocal ctx
-            nonlocal msg
-            try:
-                await ctx.bot.wait_for(
-                    'reaction_add',
-                    timeout=60,
-                    check=lambda r, u: u.id == ctx.author.id
-                                       and r.message.id == msg.id
-                                       and r.emoji == emote
-                )
-            except asyncio.TimeoutError:
-                pass
-            finally:
-                asyncio.ensure_future(msg.delete())
-        asyncio.ensure_future(callback())
-    except BaseException:
-        pass
+    ctx.bot.closeables.add(msg, ctx.author.id)
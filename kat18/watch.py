@@ -0,0 +1,236 @@
+"""
+Watches the config directory for state files that something other than the
+bot changes, such as someone editing them by hand, so that they can be
+reloaded without restarting.
+
+On Linux this uses inotify, so nothing happens until a file changes.
+Anywhere else, or if inotify is unavailable, the files are polled instead.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import typing
+
+import asyncio
+
+import kat18.util as util
+
+
+__all__ = ['DirectoryWatcher', 'InotifyWatch', 'PollingWatch',
+           'storage_files']
+
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+
+# Writes are only looked at once the file is closed, so we do not read
+# half-written files. Editors that save by renaming a new file over the old
+# one give us IN_MOVED_TO instead.
+_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE
+
+# struct inotify_event, without the name that follows it.
+_EVENT = struct.Struct('iIII')
+
+
+class InotifyWatch(util.Loggable):
+    """
+    Watches a directory with inotify, calling ``callback(name)`` with the
+    name of each file that changes in it, or None if events were lost.
+
+    :raises OSError: if inotify is not available.
+    """
+    def __init__(self, directory, callback: typing.Callable):
+        self.directory = directory
+        self.callback = callback
+
+        library = ctypes.util.find_library('c')
+        if library is None:
+            raise OSError(errno.ENOSYS, 'Could not find libc')
+        libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        wd = libc.inotify_add_watch(self._fd, os.fsencode(directory), _MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, os.strerror(error), directory)
+
+        self._loop = asyncio.get_event_loop()
+        self._loop.add_reader(self._fd, self._read)
+
+    def close(self):
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+    def _read(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            _, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.callback(None)
+            elif name:
+                self.callback(os.fsdecode(name))
+
+
+class PollingWatch(util.Loggable):
+    """
+    Checks each of the given files in a directory every ``interval``
+    seconds, calling ``callback(name)`` with the name of each one that has
+    changed since the last check.
+    """
+    def __init__(self, directory, names: typing.Iterable[str],
+                 callback: typing.Callable, interval=2.0):
+        self.directory = directory
+        self.callback = callback
+        self.interval = interval
+        self._stamps = {}
+        self.add(names)
+        self._task = asyncio.ensure_future(self._poll())
+
+    def add(self, names: typing.Iterable[str]):
+        """Starts checking some more files."""
+        for name in names:
+            if name not in self._stamps:
+                self._stamps[name] = self._stat(name)
+
+    def close(self):
+        self._task.cancel()
+
+    def _stat(self, name):
+        try:
+            st = os.stat(os.path.join(self.directory, name))
+            return st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            return None
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for name in list(self._stamps):
+                stamp = self._stat(name)
+                if stamp != self._stamps[name]:
+                    self._stamps[name] = stamp
+                    self.callback(name)
+
+
+class DirectoryWatcher(util.Loggable):
+    """
+    Watches some files in a directory, and once they stop changing for
+    ``delay`` seconds, awaits ``callback(names)`` with the set of names of
+    the files that changed. Saving a file often takes several writes, so
+    this waits for them all rather than reacting to each, but for no more
+    than ``max_delay`` seconds.
+
+    :param directory: the directory the files are in.
+    :param names: the names of the files to watch, without the directory.
+    :param callback: a coroutine function taking a set of file names.
+    :param delay: how long to wait for things to go quiet, in seconds.
+    :param max_delay: the longest to wait after the first change, in seconds.
+    :param poll_interval: how often to check the files, if inotify is not
+        available.
+    :param scheduler: the :class:`kat18.util.Scheduler` to wait on. If not
+        given, then the watcher runs its own.
+    """
+    def __init__(self, directory, names: typing.Iterable[str], callback,
+                 delay=0.5, max_delay=5.0, poll_interval=2.0,
+                 scheduler=None):
+        self.directory = directory
+        self.names = set(names)
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self._watch = None
+        self._changed = set()
+        self._own_scheduler = scheduler is None
+        if scheduler is None:
+            scheduler = util.Scheduler()
+        self._scheduler = scheduler
+        self._reloader = util.Coalescer(scheduler, self._run, delay,
+                                        max_delay)
+
+    @property
+    def method(self) -> typing.Optional[str]:
+        """How the files are being watched, or None if they are not."""
+        if isinstance(self._watch, InotifyWatch):
+            return 'inotify'
+        elif isinstance(self._watch, PollingWatch):
+            return 'polling'
+        return None
+
+    def start(self):
+        try:
+            self._watch = InotifyWatch(self.directory, self._on_change)
+        except (OSError, AttributeError, NotImplementedError) as ex:
+            self.logger.info(f'Polling {self.directory} for changes, as '
+                             f'inotify is not available: {ex}')
+            self._watch = PollingWatch(self.directory, self.names,
+                                       self._on_change, self.poll_interval)
+        else:
+            self.logger.info(f'Watching {self.directory} with inotify')
+
+    def add(self, names: typing.Iterable[str]):
+        """Starts watching some more files."""
+        names = set(names)
+        self.names.update(names)
+        if isinstance(self._watch, PollingWatch):
+            self._watch.add(names)
+
+    def close(self):
+        if self._watch is not None:
+            self._watch.close()
+            self._watch = None
+        if self._own_scheduler:
+            self._scheduler.close()
+
+    def _on_change(self, name):
+        if name is None:
+            # We missed some events, so assume everything changed.
+            self._changed.update(self.names)
+        elif name in self.names:
+            self._changed.add(name)
+        else:
+            return
+
+        self._reloader.request()
+
+    async def _run(self):
+        changed, self._changed = self._changed, set()
+        try:
+            await self.callback(changed)
+        except Exception:
+            self.logger.exception(f'Could not reload {", ".join(changed)}')
+
+
+def storage_files(storage) -> typing.Set[str]:
+    """
+    Gets the names of the files in the config directory that the given
+    state storage keeps a value in.
+    """
+    names = {os.path.basename(storage.file_name)}
+    journal_name = getattr(storage, 'journal_name', None)
+    if journal_name is not None:
+        names.add(os.path.basename(journal_name))
+    return names
@@ -0,0 +1,134 @@
+"""
+Runs the shards of the bot in several worker processes, so that they are
+not all stuck on one core. Enable this with "workers" under "sharding" in
+config.json. A shard count has to be given, so that the shards can be split
+up before any worker connects:
+
+    "sharding": {"enabled": true, "shard_count": 8, "workers": 4}
+
+This process serves the state to the workers (see kat18.ipc) and waits on
+them. If any worker stops, for example because of the stop command, then
+the rest are stopped too and this process exits with its exit code, so that
+whatever restarts the bot restarts everything.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import typing
+
+import asyncio
+
+import kat18.client as client
+import kat18.util as util
+
+
+__all__ = ['Supervisor', 'shard_groups', 'worker_count', 'run']
+
+
+def worker_count(config_location) -> int:
+    """Gets how many worker processes config.json asks for."""
+    with open(os.path.join(config_location, 'config.json')) as fp:
+        sharding = json.load(fp).get('sharding', {})
+    if not sharding.get('enabled', False):
+        return 1
+    return sharding.get('workers', 1)
+
+
+def shard_groups(shard_count, workers) -> typing.List[typing.List[int]]:
+    """Splits the shards between the workers as evenly as possible."""
+    workers = min(workers, shard_count)
+    return [list(range(i, shard_count, workers)) for i in range(workers)]
+
+
+def _worker(config_location, api_base, shard_ids, state_address):
+    logging.basicConfig(
+        level='INFO',
+        format=f'[shards {shard_ids}] %(levelname)s:%(name)s:%(message)s')
+    client.ShardedKatBot(config_location,
+                         api_base=api_base,
+                         shard_ids=shard_ids,
+                         state_address=state_address).run()
+
+
+class Supervisor(util.Loggable):
+    """Starts the state server and the workers, then waits on the workers."""
+    # How often to check on the workers, in seconds.
+    poll_interval = 1.0
+
+    def __init__(self, config_location, api_base=None):
+        self.config_location = config_location
+        self.api_base = api_base
+
+        with open(os.path.join(config_location, 'config.json')) as fp:
+            self.config = json.load(fp)
+
+        sharding = self.config.get('sharding', {})
+        if sharding.get('shard_count') is None:
+            raise ValueError('"shard_count" must be set under "sharding" to '
+                             'run several workers')
+        self.groups = shard_groups(sharding['shard_count'],
+                                   sharding.get('workers', 1))
+        self.processes = []
+
+    async def run(self) -> int:
+        """Runs until a worker stops, and gets its exit code."""
+        # Only the supervisor serves the state, so the bot does not import
+        # this when it runs in one process.
+        import kat18.ipc as ipc
+
+        storage_type, database = client.state_storage(
+            self.config, self.config_location)
+        address = ipc.default_address(self.config_location)
+        server = ipc.StateServer(self.config_location, address,
+                                 storage_type=storage_type,
+                                 flush_delay=self.config.get('flush_delay'))
+        await server.start()
+
+        hot_reload = {'enabled': True, 'delay': 0.5, 'poll_interval': 2.0,
+                      **self.config.get('hot_reload', {})}
+        if hot_reload.pop('enabled') and database is None:
+            server.watch(**hot_reload)
+
+        context = multiprocessing.get_context('spawn')
+        try:
+            for shard_ids in self.groups:
+                process = context.Process(
+                    target=_worker,
+                    args=(self.config_location, self.api_base, shard_ids,
+                          address),
+                    name=f'kat18 shards {shard_ids}')
+                process.start()
+                self.processes.append(process)
+                self.logger.info(f'Started shards {shard_ids} in process '
+                                 f'{process.pid}')
+
+            while all(p.is_alive() for p in self.processes):
+                await asyncio.sleep(self.poll_interval)
+
+            stopped = next(p for p in self.processes if not p.is_alive())
+            self.logger.info(f'{stopped.name} stopped with exit code '
+                             f'{stopped.exitcode}. Stopping the rest.')
+            return stopped.exitcode
+        finally:
+            self.stop()
+            await server.close()
+            if database is not None:
+                database.close()
+
+    def stop(self):
+        """Stops every worker that is still running."""
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join(10)
+
+
+def run(config_location, api_base=None) -> int:
+    """Runs the workers, and gets the exit code to exit with."""
+    supervisor = Supervisor(config_location, api_base)
+    try:
+        return asyncio.get_event_loop().run_until_complete(supervisor.run())
+    except KeyboardInterrupt:
+        return 0
@@ -0,0 +1,3 @@
+"""
+Development tools that are not part of the bot.
+"""
@@ -0,0 +1,7 @@
+"""
+Benchmarks and load testing for the bot, with stand-ins for Discord. Run
+these from the root of the repository, for example:
+
+    python -m tools.bench.benchmark --triggers 200
+    python -m tools.bench.fakediscord --guilds 500 --rate 200
+"""
@@ -0,0 +1,405 @@
+"""
+Offline benchmarks for the message path.
+
+Builds a real bot from a throwaway config directory, gives it fake guilds,
+channels, authors and an HTTP client that only records calls, and then
+drives each message handler with a corpus of messages. Nothing connects
+to Discord. The ``pipeline`` handler is the whole path, from
+KatBot.on_message until every handler it starts has finished.
+
+For each handler this reports the throughput and the p50/p99 latency of a
+single call. Results can be saved as a baseline, and a later run can be
+compared against it to spot regressions between versions:
+
+    python -m tools.bench.benchmark --triggers 200 --save baseline.json
+    python -m tools.bench.benchmark --triggers 200 --compare baseline.json
+
+The corpus is generated unless ``--corpus`` is given a JSON list of
+strings, or a text file with a message per line.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import asyncio
+
+import kat18
+import kat18.client as client
+import kat18.talk as talk
+import tools.bench.fakes as fakes
+
+
+__all__ = ['Benchmark', 'compare', 'percentile']
+
+
+HANDLERS = ('reacting', 'talk', 'prefix', 'pipeline')
+
+_VOCABULARY = (
+    'the a an and but or so if then what when where why how is are was '
+    'it this that these those i you we they me us them my your our their '
+    'cat dog bird fish kat meow purr hiss nap food play game chat server '
+    'hello hi hey yes no maybe ok lol good bad nice cool great love hate'
+).split()
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1,
+                      round(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def load_corpus(file_name):
+    """Loads a JSON list of strings, or a text file with a line each."""
+    with open(file_name) as fp:
+        text = fp.read()
+    try:
+        corpus = json.loads(text)
+    except ValueError:
+        return [line for line in text.splitlines() if line.strip()]
+    if not isinstance(corpus, list):
+        raise ValueError(f'{file_name} is not a list of messages')
+    return [str(message) for message in corpus]
+
+
+class Benchmark:
+    """
+    One benchmark setup: a bot, its state and the fake world it sees.
+
+    :param options: the parsed command line options.
+    """
+    def __init__(self, options):
+        self.options = options
+        self.rng = random.Random(options.seed)
+        self.directory = None
+        self.bot = None
+        self.http = fakes.FakeHTTPClient()
+        self.guilds = []
+        self.authors = []
+        self.commanders = []
+        self.corpus = []
+        self.word_triggers = []
+        self.regex_triggers = []
+
+    def _write_json(self, name, value):
+        with open(os.path.join(self.directory, name), 'w') as fp:
+            json.dump(value, fp)
+
+    def _make_triggers(self):
+        count = self.options.triggers
+        regexes = round(count * self.options.regex_share)
+        self.word_triggers = [f'word{i}' for i in range(count - regexes)]
+        self.regex_triggers = [f'rx{i}[a-z]*\\d+' for i in range(regexes)]
+        return ([f'\\b({word})\\b' for word in self.word_triggers]
+                + self.regex_triggers)
+
+    def _make_message(self):
+        words = self.rng.choices(_VOCABULARY, k=self.rng.randint(3, 30))
+        roll = self.rng.random()
+        opts = self.options
+
+        # Triggers have to be at the start, as they are matched from there.
+        if roll < opts.hit_rate and (self.word_triggers
+                                     or self.regex_triggers):
+            if self.regex_triggers and (
+                    not self.word_triggers
+                    or self.rng.random() < opts.regex_share):
+                index = self.rng.randrange(len(self.regex_triggers))
+                words.insert(0, f'rx{index}abc{self.rng.randint(0, 99)}')
+            else:
+                words.insert(0, self.rng.choice(self.word_triggers))
+        elif roll < opts.hit_rate + opts.talk_rate:
+            words.insert(0, f'{self.options.name}:')
+        elif roll < opts.hit_rate + opts.talk_rate + opts.command_rate:
+            words[0:0] = [self.options.name, 'do:', 'help']
+        return ' '.join(words)
+
+    async def setup(self):
+        """Writes the state, builds the bot and the fake world."""
+        opts = self.options
+        self.directory = tempfile.mkdtemp(prefix='kat18-benchmark-')
+
+        owner = fakes.FakeUser(name='owner')
+        self.commanders = [owner] + [
+            fakes.FakeUser(name=f'commander {i}')
+            for i in range(max(0, opts.commanders - 1))
+        ]
+        self.authors = [fakes.FakeUser(name=f'author {i}')
+                        for i in range(opts.authors)]
+        self.authors += self.commanders
+
+        self.guilds = fakes.make_guilds(opts.guilds, opts.channels,
+                                        http=self.http)
+        emoji_guild = self.guilds[0]
+        emojis = [emoji_guild.add_emoji(f'emoji{i}') for i in range(20)]
+
+        channels = [(g.id, c.id) for g in self.guilds for c in g.channels]
+        self.rng.shuffle(channels)
+        # Past the real channels, blacklist some that we never see.
+        while len(channels) < opts.blacklist:
+            channels.append((self.guilds[0].id, fakes.snowflake()))
+        blacklist = {}
+        for guild_id, channel_id in channels[:opts.blacklist]:
+            blacklist.setdefault(str(guild_id), []).append(channel_id)
+
+        if opts.rate_limits:
+            limits = {}
+        else:
+            # Otherwise, after the first reaction, each channel is on timeout
+            # and we would only be timing the limiter.
+            unlimited = {'capacity': 1e12, 'per': 1e-6}
+            limits = {'guild': unlimited, 'channel': unlimited}
+
+        self._write_json('config.json', {
+            'owner_id': owner.id,
+            'client_id': 0,
+            'token': 'offline',
+            'name': opts.name,
+            'storage': 'json',
+            'reaction_limits': limits,
+        })
+        self._write_json('authorized_commanders.json',
+                         [c.id for c in self.commanders])
+        self._write_json('blacklisted_channels.json', blacklist)
+        self._write_json('react_triggers.json', self._make_triggers())
+        self._write_json('react_emojis.json', [str(e) for e in emojis])
+
+        if opts.corpus:
+            self.corpus = load_corpus(opts.corpus)
+        else:
+            self.corpus = [self._make_message()
+                           for _ in range(min(opts.messages, 5000))]
+
+        self.bot = client.KatBot(self.directory)
+        await self.bot.load_state()
+        # Raw expressions are not matched until they have been screened.
+        await self.bot.screen_loaded_patterns()
+        self.bot.http = self.http
+        self.bot._connection.user = fakes.FakeUser(name=opts.name, bot=True)
+        for guild in self.guilds:
+            self.bot.emoji_index.add_guild(guild)
+        await self.bot.reload_emoji_cache()
+
+    async def teardown(self):
+        """Stops anything the bot had scheduled and removes the state."""
+        if self.bot is not None:
+            if self.bot.state_watcher is not None:
+                self.bot.state_watcher.close()
+            self.bot.scheduler.close()
+            self.bot.outbox.close()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _handler(self, name):
+        if name == 'reacting':
+            return self._cog_handler(self.bot.get_cog('Reacting'))
+        elif name == 'talk':
+            return self._cog_handler(self.bot.get_cog('Talk'))
+        elif name == 'prefix':
+            return self.bot.get_context
+        elif name == 'pipeline':
+            return self._pipeline
+        raise ValueError(f'Unknown handler {name!r}')
+
+    def _cog_handler(self, cog):
+        # Routed as the pipeline would, but only to this cog.
+        async def handler(message):
+            view = self.bot.view(message)
+            if cog.handle_message in self.bot.messages.matching(view):
+                await cog.handle_message(view)
+        return handler
+
+    async def _pipeline(self, message):
+        # Everything that happens for a message, until every handler is done.
+        futures = await self.bot.on_message(message)
+        if futures:
+            await asyncio.wait(futures)
+
+    def _messages(self, count):
+        # Built up front, so that making them is not timed.
+        return [
+            fakes.FakeMessage(
+                self.corpus[i % len(self.corpus)],
+                self.rng.choice(self.authors),
+                fakes.pick_channel(self.guilds, self.rng))
+            for i in range(count)
+        ]
+
+    async def run_handler(self, name):
+        """Runs the corpus through one handler, and summarises the timings."""
+        handler = self._handler(name)
+
+        for message in self._messages(self.options.warmup):
+            await handler(message)
+
+        messages = self._messages(self.options.messages)
+        timings = []
+        perf_counter = time.perf_counter
+
+        started = perf_counter()
+        for message in messages:
+            start = perf_counter()
+            await handler(message)
+            timings.append(perf_counter() - start)
+        elapsed = perf_counter() - started
+
+        timings.sort()
+        return {
+            'messages': len(messages),
+            'seconds': elapsed,
+            'throughput': len(messages) / elapsed if elapsed else 0.0,
+            'p50': percentile(timings, 0.5),
+            'p99': percentile(timings, 0.99),
+            'max': timings[-1] if timings else 0.0,
+        }
+
+    async def run(self):
+        """Runs every selected handler, and gets the results by handler."""
+        # Talk waits a few seconds to look like it is typing. That is not
+        # what we want to measure.
+        talk_time = talk.talk_time
+        talk.talk_time = lambda message: 0
+        try:
+            await self.setup()
+            results = {}
+            for name in self.options.handlers:
+                random.seed(self.options.seed)
+                results[name] = await self.run_handler(name)
+            return results
+        finally:
+            talk.talk_time = talk_time
+            await self.teardown()
+
+
+def describe(options):
+    """The options that affect the results, for saving with a baseline."""
+    return {
+        key: getattr(options, key)
+        for key in ('messages', 'corpus', 'triggers', 'regex_share',
+                    'hit_rate', 'talk_rate', 'command_rate', 'blacklist',
+                    'commanders', 'authors', 'guilds', 'channels',
+                    'rate_limits', 'seed')
+    }
+
+
+def compare(baseline, results, threshold):
+    """
+    Compares results against a baseline. Throughput that drops, or latency
+    that rises, by more than the threshold fraction is a regression.
+
+    :return: lines to print, and whether anything regressed.
+    """
+    lines = []
+    regressed = False
+    for name, result in results.items():
+        before = baseline.get('results', {}).get(name)
+        if before is None:
+            lines.append(f'{name}: not in the baseline')
+            continue
+
+        for key, higher_is_better in (('throughput', True),
+                                      ('p50', False),
+                                      ('p99', False)):
+            old, new = before[key], result[key]
+            change = (new - old) / old if old else 0.0
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > threshold:
+                flag = '  <-- REGRESSION'
+                regressed = True
+            lines.append(f'{name} {key}: {old:.6g} -> {new:.6g} '
+                         f'({change:+.1%}){flag}')
+    return lines, regressed
+
+
+def print_results(results):
+    print(f'{"handler":<10} {"msgs":>8} {"msg/s":>12} '
+          f'{"p50 us":>10} {"p99 us":>10} {"max us":>10}')
+    for name, r in results.items():
+        print(f'{name:<10} {r["messages"]:>8} {r["throughput"]:>12.1f} '
+              f'{r["p50"] * 1e6:>10.1f} {r["p99"] * 1e6:>10.1f} '
+              f'{r["max"] * 1e6:>10.1f}')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m tools.bench.benchmark',
+        description='Benchmarks the message handlers offline.')
+    parser.add_argument('--handlers', nargs='+', choices=HANDLERS,
+                        default=list(HANDLERS))
+    parser.add_argument('--messages', type=int, default=20000,
+                        help='messages to time for each handler')
+    parser.add_argument('--warmup', type=int, default=500,
+                        help='messages to run before timing')
+    parser.add_argument('--corpus', help='JSON list or text file of messages')
+    parser.add_argument('--triggers', type=int, default=50)
+    parser.add_argument('--regex-share', type=float, default=0.2,
+                        help='fraction of triggers that are raw regexes')
+    parser.add_argument('--hit-rate', type=float, default=0.1,
+                        help='fraction of messages that start with a trigger')
+    parser.add_argument('--talk-rate', type=float, default=0.05,
+                        help='fraction of messages for Talk')
+    parser.add_argument('--command-rate', type=float, default=0.05,
+                        help='fraction of messages that are commands')
+    parser.add_argument('--blacklist', type=int, default=10,
+                        help='blacklisted channels')
+    parser.add_argument('--commanders', type=int, default=5)
+    parser.add_argument('--authors', type=int, default=200,
+                        help='authors that are not commanders')
+    parser.add_argument('--guilds', type=int, default=20)
+    parser.add_argument('--channels', type=int, default=10,
+                        help='channels in each guild')
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep the default reaction rate limits')
+    parser.add_argument('--name', default='Kat')
+    parser.add_argument('--seed', type=int, default=18)
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results against a baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fractional change that counts as a regression')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(Benchmark(options).run())
+
+    print_results(results)
+
+    if options.save:
+        with open(options.save, 'w') as fp:
+            json.dump({
+                'version': kat18.__version__,
+                'python': platform.python_version(),
+                'options': describe(options),
+                'results': results,
+            }, fp, indent=2)
+        print(f'Saved baseline to {options.save}')
+
+    if options.compare:
+        with open(options.compare) as fp:
+            baseline = json.load(fp)
+        if baseline.get('options') != describe(options):
+            print('Warning: the baseline was run with different options.')
+        print(f'Compared to {baseline.get("version")} '
+              f'on Python {baseline.get("python")}:')
+        lines, regressed = compare(baseline, results, options.threshold)
+        print('\n'.join(lines))
+        if regressed:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,678 @@
+"""
+A local stand-in for the Discord gateway and REST API, for load testing the
+whole bot without a connection to Discord.
+
+It hands the bot a set of made up guilds when it identifies, then streams
+events at it at a controlled rate. The events are either generated, or
+replayed from a file of recorded events. Every REST call the bot makes is
+recorded, and answered with something plausible.
+
+While it runs, it reports:
+
+- the time from sending a message to the first REST call made about that
+  message (a reaction, or a deletion). Replies to a channel cannot be tied
+  back to a message, so they are counted but not timed. Note that Reacting
+  deliberately waits up to 30 seconds before reacting.
+- how late the bot's heartbeats are. They are sent from the event loop, so
+  this goes up as the loop saturates.
+
+Start it, then start the bot with the API base it prints:
+
+    python -m tools.bench.fakediscord --guilds 500 --rate 200 --record rest.jsonl
+    python -m kat18 config-path http://127.0.0.1:8765/api/v7
+
+Generated guilds have emojis named ``emoji0``, ``emoji1`` and so on, which
+can be put in react_emojis.json by name.
+
+Replay files have a JSON object per line, with the event type as ``t``, the
+payload as ``d``, and optionally ``at``, the seconds since the start of the
+stream to send it at. GUILD_CREATE events at the start of the file are used
+as the guilds given to the bot when it connects. ``--save-stream`` writes
+generated events in this format.
+
+For a sharded bot, each shard that identifies gets the guilds on its shard,
+and each event goes to the shard its guild is on. ``--shards`` sets how many
+shards the bot is told to use, if it asks.
+"""
+import argparse
+import collections
+import itertools
+import json
+import logging
+import random
+import re
+import sys
+import time
+
+import aiohttp
+import aiohttp.web as web
+import asyncio
+
+
+__all__ = ['FakeDiscord', 'World', 'synthetic_stream', 'replay_stream']
+
+
+_MESSAGE_PATH = re.compile(r'/channels/(\d+)/messages/(\d+)')
+_CHANNEL_MESSAGES_PATH = re.compile(r'/channels/(\d+)/messages$')
+_SNOWFLAKE = re.compile(r'\d{15,}')
+_EPOCH = '2018-01-01T00:00:00+00:00'
+
+_VOCABULARY = (
+    'the a an and but or so if then what when where why how is are was '
+    'it this that these those i you we they me us them my your our their '
+    'cat dog bird fish meow purr hiss nap food play game chat server '
+    'hello hi hey yes no maybe ok lol good bad nice cool great love hate'
+).split()
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1,
+                      round(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+class World:
+    """
+    The made up guilds, channels, members and emojis that events refer to.
+    Payloads are built in the shape the gateway sends them.
+    """
+    def __init__(self, rng, guilds=100, channels=5, members=50, emojis=10,
+                 authors=1000, bot_id=None, bot_name='Kat'):
+        self.rng = rng
+        # The shard a guild is on comes from the bits above the lowest 22,
+        # so guilds get a sequence of their own in those bits, to spread
+        # them between shards. Everything else gets the one next to it.
+        base = 300_000_000_000_000_000
+        self._guild_ids = itertools.count(base, 1 << 22)
+        self._ids = itertools.count(base + 1, 1 << 22)
+        self.emojis_per_guild = emojis
+        self.bot = self.user(bot_id or self.snowflake(), bot_name, bot=True)
+        self.authors = [self.user(self.snowflake(), f'user{i}')
+                        for i in range(authors)]
+        self.guilds = collections.OrderedDict()
+        # Channel ID -> guild.
+        self.channels = {}
+        for g in range(guilds):
+            self.add_guild(self.guild(f'guild {g}', channels, members))
+
+    def add_guild(self, guild):
+        self.guilds[guild['id']] = guild
+        for channel in guild.get('channels', ()):
+            self.channels[channel['id']] = guild
+
+    def snowflake(self) -> int:
+        return next(self._ids)
+
+    @staticmethod
+    def user(user_id, name, bot=False):
+        return {
+            'id': str(user_id),
+            'username': name,
+            'discriminator': '0001',
+            'avatar': None,
+            'bot': bot,
+        }
+
+    def emoji(self, name):
+        return {
+            'id': str(self.snowflake()),
+            'name': name,
+            'roles': [],
+            'require_colons': True,
+            'managed': False,
+            'animated': False,
+        }
+
+    @staticmethod
+    def member(user):
+        return {
+            'user': user,
+            'roles': [],
+            'nick': None,
+            'joined_at': _EPOCH,
+            'deaf': False,
+            'mute': False,
+        }
+
+    def guild(self, name, channels, members):
+        guild_id = str(next(self._guild_ids))
+        # Only a few members are sent, as if the guild were large.
+        sample = self.rng.sample(self.authors, min(members, 10,
+                                                   len(self.authors)))
+        return {
+            'id': guild_id,
+            'name': name,
+            'icon': None,
+            'splash': None,
+            'owner_id': sample[0]['id'] if sample else self.bot['id'],
+            'region': 'us-east',
+            'afk_channel_id': None,
+            'afk_timeout': 300,
+            'verification_level': 0,
+            'default_message_notifications': 0,
+            'explicit_content_filter': 0,
+            'mfa_level': 0,
+            'features': [],
+            'large': False,
+            'unavailable': False,
+            'member_count': members,
+            'roles': [{
+                'id': guild_id,
+                'name': '@everyone',
+                'permissions': 104324161,
+                'position': 0,
+                'color': 0,
+                'hoist': False,
+                'managed': False,
+                'mentionable': False,
+            }],
+            'emojis': [self.emoji(f'emoji{i}')
+                       for i in range(self.emojis_per_guild)],
+            'channels': [{
+                'id': str(self.snowflake()),
+                'type': 0,
+                'name': f'channel-{c}',
+                'position': c,
+                'topic': None,
+                'nsfw': False,
+                'permission_overwrites': [],
+            } for c in range(channels)],
+            'members': [self.member(u) for u in [self.bot, *sample]],
+            'presences': [],
+            'voice_states': [],
+        }
+
+    def message(self, guild, channel_id, author, content):
+        return {
+            'id': str(self.snowflake()),
+            'type': 0,
+            'channel_id': channel_id,
+            'guild_id': guild['id'],
+            'author': author,
+            'member': self.member(author),
+            'content': content,
+            'timestamp': _EPOCH,
+            'edited_timestamp': None,
+            'tts': False,
+            'mention_everyone': False,
+            'mentions': [],
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': [],
+            'pinned': False,
+        }
+
+    def channel_guild(self, channel_id):
+        """Gets the guild that has the channel, or None."""
+        return self.channels.get(channel_id)
+
+
+def synthetic_stream(world, options):
+    """
+    Generates events forever. Most are messages: some start with a trigger,
+    some talk to the bot, some are commands and the rest are chatter. The
+    rest change a guild's emojis, or make a guild unavailable and then
+    available again.
+
+    :return: an iterator of (event type, payload).
+    """
+    rng = world.rng
+    owner = (world.user(options.owner_id, 'owner')
+             if options.owner_id else None)
+    guilds = list(world.guilds.values())
+    unavailable = []
+    unavailable_ids = set()
+
+    while True:
+        roll = rng.random()
+        if roll < options.availability_rate:
+            if unavailable:
+                guild = unavailable.pop()
+                unavailable_ids.discard(guild['id'])
+                yield 'GUILD_CREATE', guild
+            else:
+                guild = rng.choice(guilds)
+                unavailable.append(guild)
+                unavailable_ids.add(guild['id'])
+                yield 'GUILD_DELETE', {'id': guild['id'], 'unavailable': True}
+            continue
+
+        guild = rng.choice(guilds)
+        if guild['id'] in unavailable_ids:
+            continue
+        if roll < options.availability_rate + options.emoji_update_rate:
+            emojis = guild['emojis']
+            if emojis:
+                emojis[rng.randrange(len(emojis))] = world.emoji(
+                    f'emoji{rng.randrange(world.emojis_per_guild)}')
+            yield 'GUILD_EMOJIS_UPDATE', {'guild_id': guild['id'],
+                                          'emojis': list(emojis)}
+            continue
+
+        words = rng.choices(_VOCABULARY, k=rng.randint(3, 20))
+        author = rng.choice(world.authors)
+        kind = rng.random()
+        if kind < options.hit_rate:
+            words.insert(0, rng.choice(options.trigger_words))
+        elif kind < options.hit_rate + options.talk_rate:
+            words.insert(0, f'{options.name}:')
+            author = owner or author
+        elif kind < (options.hit_rate + options.talk_rate
+                     + options.command_rate):
+            words = [options.name, 'do:', rng.choice(options.commands)]
+            author = owner or author
+
+        channel = rng.choice(guild['channels'])
+        yield 'MESSAGE_CREATE', world.message(guild, channel['id'], author,
+                                              ' '.join(words))
+
+
+def replay_stream(file_name):
+    """
+    Reads recorded events.
+
+    :return: the GUILD_CREATE payloads at the start of the file, and a list
+        of (seconds since the start or None, event type, payload).
+    """
+    guilds, events = [], []
+    with open(file_name) as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record['t'] == 'GUILD_CREATE' and not events:
+                guilds.append(record['d'])
+            else:
+                events.append((record.get('at'), record['t'], record['d']))
+    return guilds, events
+
+
+class _Session:
+    """A gateway connection for one shard."""
+    def __init__(self, ws, shard_id, shard_count):
+        self.ws = ws
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.seq = 0
+        self.last_heartbeat = None
+
+    def owns(self, guild_id):
+        """True if the guild is on this session's shard."""
+        return (int(guild_id) >> 22) % self.shard_count == self.shard_id
+
+
+class FakeDiscord:
+    """
+    The fake gateway and REST API, served by one aiohttp application.
+
+    :param world: the guilds to give the bot when it identifies.
+    :param events: an iterable of (seconds since the start or None, event
+        type, payload). When the time is None, events are sent at ``rate``
+        events a second.
+    """
+    logger = logging.getLogger('FakeDiscord')
+
+    def __init__(self, world, events, host='127.0.0.1', port=8765, rate=50.0,
+                 heartbeat_interval=41.25, rest_delay=0.0, record=None,
+                 save_stream=None, limit=None, shards=1):
+        self.world = world
+        self.events = events
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.heartbeat_interval = heartbeat_interval
+        self.rest_delay = rest_delay
+        self.limit = limit
+        self.shards = shards
+        self._record_fp = open(record, 'w') if record else None
+        self._stream_fp = open(save_stream, 'w') if save_stream else None
+
+        self.started = time.monotonic()
+        self.events_sent = collections.Counter()
+        self.events_dropped = 0
+        self.rest_calls = collections.Counter()
+        # Message ID -> when we sent it, for messages nobody has acted on.
+        self._sent_at = collections.OrderedDict()
+        # Only the most recent samples are kept.
+        self.latencies = collections.deque(maxlen=100_000)
+        self.heartbeat_lateness = collections.deque(maxlen=10_000)
+        self.finished = asyncio.Event()
+
+        self._runner = None
+        self._pump = None
+        # Shard ID -> session.
+        self._sessions = {}
+
+        self.app = web.Application()
+        self.app.router.add_get('/ws', self._gateway)
+        self.app.router.add_route('*', '/api/{version}/{path:.*}', self._rest)
+
+    @property
+    def api_base(self):
+        return f'http://{self.host}:{self.port}/api/v7'
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.logger.info(f'Listening. Point the bot at {self.api_base}')
+
+    async def close(self):
+        if self._pump is not None:
+            self._pump.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+        for fp in (self._record_fp, self._stream_fp):
+            if fp is not None:
+                fp.close()
+
+    #
+    # Gateway.
+    #
+
+    async def _gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        session = None
+
+        await ws.send_json({'op': 10, 'd': {
+            'heartbeat_interval': int(self.heartbeat_interval * 1000),
+            '_trace': ['kat18-fakediscord'],
+        }})
+
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                payload = json.loads(msg.data)
+                op = payload.get('op')
+
+                if op == 1:
+                    if session is not None:
+                        self._heartbeat(session)
+                    await ws.send_json({'op': 11, 'd': None})
+                elif op == 2:
+                    shard_id, shard_count = (payload['d'].get('shard')
+                                             or (0, 1))
+                    session = _Session(ws, shard_id, shard_count)
+                    self._sessions[shard_id] = session
+                    self.logger.info(f'Shard {shard_id} of {shard_count} '
+                                     'identified. Sending READY.')
+                    await self._ready(session)
+                    if self._pump is None or self._pump.done():
+                        self._pump = asyncio.ensure_future(
+                            self._run_events())
+                elif op == 6:
+                    # We don't keep sessions around, so start a new one.
+                    await ws.send_json({'op': 9, 'd': False})
+        finally:
+            if session is not None:
+                self._sessions.pop(session.shard_id, None)
+            if not self._sessions and self._pump is not None:
+                self._pump.cancel()
+        return ws
+
+    def _heartbeat(self, session):
+        now = time.monotonic()
+        last = session.last_heartbeat
+        session.last_heartbeat = now
+        if last is not None:
+            self.heartbeat_lateness.append(
+                max(0.0, now - last - self.heartbeat_interval))
+
+    async def _dispatch(self, session, event_type, data):
+        session.seq += 1
+        await session.ws.send_str(json.dumps({
+            'op': 0, 's': session.seq, 't': event_type, 'd': data
+        }))
+        self.events_sent[event_type] += 1
+
+    async def _ready(self, session):
+        guilds = [guild for guild in self.world.guilds.values()
+                  if session.owns(guild['id'])]
+        await self._dispatch(session, 'READY', {
+            'v': 6,
+            'user': self.world.bot,
+            'guilds': [{'id': guild['id'], 'unavailable': True}
+                       for guild in guilds],
+            'session_id': f'fake-{session.shard_id}-{time.time()}',
+            'shard': [session.shard_id, session.shard_count],
+            'private_channels': [],
+            'relationships': [],
+            '_trace': ['kat18-fakediscord'],
+        })
+        for guild in guilds:
+            await self._dispatch(session, 'GUILD_CREATE', guild)
+
+    def _session_for(self, data):
+        """Gets the session for the shard the event's guild is on."""
+        guild_id = data.get('guild_id') or data.get('id')
+        for session in self._sessions.values():
+            if guild_id is None or session.owns(guild_id):
+                return session
+        return None
+
+    async def _run_events(self):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        if self._stream_fp is not None:
+            # So that a replay gives the bot the same guilds.
+            for guild in self.world.guilds.values():
+                self._stream_fp.write(json.dumps({
+                    't': 'GUILD_CREATE', 'd': guild
+                }) + '\n')
+
+        for i, (at, event_type, data) in enumerate(self.events):
+            if self.limit is not None and i >= self.limit:
+                break
+
+            due = start + (i / self.rate if at is None else at)
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            session = self._session_for(data)
+            if session is None:
+                # The shard for this guild is not connected.
+                self.events_dropped += 1
+                continue
+
+            if event_type == 'MESSAGE_CREATE':
+                self._sent_at[data['id']] = time.monotonic()
+                if len(self._sent_at) > 100_000:
+                    self._sent_at.popitem(last=False)
+            if self._stream_fp is not None:
+                self._stream_fp.write(json.dumps({
+                    'at': round(loop.time() - start, 6),
+                    't': event_type,
+                    'd': data
+                }) + '\n')
+
+            await self._dispatch(session, event_type, data)
+
+        self.logger.info('Sent every event.')
+        self.finished.set()
+
+    #
+    # REST.
+    #
+
+    async def _rest(self, request):
+        path = '/' + request.match_info['path']
+        method = request.method
+        now = time.monotonic()
+        body = None
+        if request.can_read_body:
+            try:
+                body = await request.json()
+            except ValueError:
+                body = None
+
+        self._record(method, path, body, now)
+
+        if self.rest_delay:
+            await asyncio.sleep(self.rest_delay)
+
+        if method == 'GET' and path in ('/gateway', '/gateway/bot'):
+            url = f'ws://{self.host}:{self.port}/ws'
+            return web.json_response({'url': url, 'shards': self.shards})
+        elif method == 'GET' and path == '/users/@me':
+            return web.json_response(self.world.bot)
+
+        match = _CHANNEL_MESSAGES_PATH.match(path)
+        if method == 'POST' and match:
+            guild = self.world.channel_guild(match.group(1))
+            message = self.world.message(
+                guild or {'id': None}, match.group(1), self.world.bot,
+                (body or {}).get('content') or '')
+            if guild is None:
+                del message['guild_id'], message['member']
+            return web.json_response(message)
+
+        if method == 'GET':
+            return web.json_response(
+                {'code': 10000, 'message': 'Unknown'}, status=404)
+        return web.Response(status=204)
+
+    def _record(self, method, path, body, now):
+        route = _SNOWFLAKE.sub('{id}', path)
+        self.rest_calls[f'{method} {route}'] += 1
+
+        match = _MESSAGE_PATH.match(path)
+        if match:
+            sent_at = self._sent_at.pop(match.group(2), None)
+            if sent_at is not None:
+                self.latencies.append(now - sent_at)
+
+        if self._record_fp is not None:
+            self._record_fp.write(json.dumps({
+                'at': round(now - self.started, 6),
+                'method': method,
+                'path': path,
+                'body': body,
+            }) + '\n')
+
+    #
+    # Reporting.
+    #
+
+    def report(self):
+        """Summarises everything so far, as lines of text."""
+        elapsed = time.monotonic() - self.started
+        sent = sum(self.events_sent.values())
+        latencies = sorted(self.latencies)
+        lateness = sorted(self.heartbeat_lateness)
+
+        lines = [
+            f'{elapsed:.0f}s: sent {sent} events '
+            f'({sent / elapsed if elapsed else 0:.1f}/s), '
+            f'{self.events_dropped} dropped, '
+            f'{sum(self.rest_calls.values())} REST calls, '
+            f'{len(self._sessions)} shards connected',
+            f'  event to action: n={len(latencies)} '
+            f'p50={_percentile(latencies, .5) * 1000:.1f}ms '
+            f'p99={_percentile(latencies, .99) * 1000:.1f}ms',
+            f'  heartbeat lateness: n={len(lateness)} '
+            f'max={(lateness[-1] if lateness else 0) * 1000:.1f}ms',
+        ]
+        for route, count in self.rest_calls.most_common(5):
+            lines.append(f'  {count:>8} {route}')
+        return lines
+
+    async def report_every(self, seconds):
+        while not self.finished.is_set():
+            await asyncio.sleep(seconds)
+            print('\n'.join(self.report()), flush=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m tools.bench.fakediscord',
+        description='Serves a fake Discord gateway and REST API locally.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--guilds', type=int, default=100)
+    parser.add_argument('--channels', type=int, default=5,
+                        help='channels in each guild')
+    parser.add_argument('--members', type=int, default=50,
+                        help='member count of each guild')
+    parser.add_argument('--emojis', type=int, default=10,
+                        help='emojis in each guild')
+    parser.add_argument('--authors', type=int, default=1000,
+                        help='distinct message authors')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='shards to recommend to the bot')
+    parser.add_argument('--rate', type=float, default=50.0,
+                        help='events a second')
+    parser.add_argument('--events', type=int,
+                        help='stop after this many events')
+    parser.add_argument('--name', default='Kat', help='the bot name')
+    parser.add_argument('--bot-id', type=int)
+    parser.add_argument('--owner-id', type=int,
+                        help='author talk and command messages as this user')
+    parser.add_argument('--trigger-words', nargs='+', default=['Kat'])
+    parser.add_argument('--commands', nargs='+', default=['help'])
+    parser.add_argument('--hit-rate', type=float, default=0.1)
+    parser.add_argument('--talk-rate', type=float, default=0.02)
+    parser.add_argument('--command-rate', type=float, default=0.02)
+    parser.add_argument('--emoji-update-rate', type=float, default=0.001)
+    parser.add_argument('--availability-rate', type=float, default=0.0005)
+    parser.add_argument('--heartbeat', type=float, default=41.25,
+                        help='heartbeat interval in seconds')
+    parser.add_argument('--rest-delay', type=float, default=0.0,
+                        help='seconds to wait before answering REST calls')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='replay recorded events rather than making them')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed, if the events have times')
+    parser.add_argument('--save-stream', metavar='FILE',
+                        help='write the events sent, for replaying later')
+    parser.add_argument('--record', metavar='FILE',
+                        help='write every REST call made')
+    parser.add_argument('--report-every', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=18)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level='INFO')
+    options = parse_args(argv)
+    rng = random.Random(options.seed)
+    world = World(rng, guilds=0 if options.replay else options.guilds,
+                  channels=options.channels, members=options.members,
+                  emojis=options.emojis, authors=options.authors,
+                  bot_id=options.bot_id, bot_name=options.name)
+
+    if options.replay:
+        guilds, recorded = replay_stream(options.replay)
+        for guild in guilds:
+            world.add_guild(guild)
+        events = [(None if at is None else at / options.speed, t, d)
+                  for at, t, d in recorded]
+    else:
+        events = ((None, t, d) for t, d in synthetic_stream(world, options))
+
+    server = FakeDiscord(world, events, host=options.host, port=options.port,
+                         rate=options.rate,
+                         heartbeat_interval=options.heartbeat,
+                         rest_delay=options.rest_delay,
+                         record=options.record,
+                         save_stream=options.save_stream,
+                         limit=options.events,
+                         shards=options.shards)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(server.start())
+    try:
+        loop.run_until_complete(server.report_every(options.report_every))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print('\n'.join(server.report()))
+        loop.run_until_complete(server.close())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+"""
+Lightweight stand-ins for the Discord objects that the message handlers
+look at, so that the handlers can be driven without a connection.
+
+These only have the attributes and methods that the bot uses. Anything
+that would talk to Discord is recorded on the :class:`FakeHTTPClient`
+instead.
+"""
+import itertools
+import random
+import typing
+
+
+__all__ = ['FakeHTTPClient', 'FakeUser', 'FakeEmoji', 'FakeGuild',
+           'FakeChannel', 'FakeMessage', 'make_guilds', 'pick_channel',
+           'snowflake']
+
+
+# Discord IDs are big enough that they never fit in a small int.
+_snowflakes = itertools.count(400_000_000_000_000_000)
+
+
+def snowflake() -> int:
+    """Gets a new, unique ID."""
+    return next(_snowflakes)
+
+
+class FakeHTTPClient:
+    """
+    Records the calls made to it rather than making them. Each call is
+    recorded as a tuple of the method name and its keyword arguments.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def _record(self, name, **kwargs):
+        self.calls.append((name, kwargs))
+
+    async def add_reaction(self, **kwargs):
+        self._record('add_reaction', **kwargs)
+
+    async def delete_message(self, **kwargs):
+        self._record('delete_message', **kwargs)
+
+    async def send_message(self, **kwargs):
+        self._record('send_message', **kwargs)
+
+    async def send_typing(self, **kwargs):
+        self._record('send_typing', **kwargs)
+
+    def count(self, name) -> int:
+        """Counts the calls made to the given method."""
+        return sum(1 for call, _ in self.calls if call == name)
+
+
+class FakeUser:
+    """A user, or a member of a guild."""
+    def __init__(self, id=None, name='user', bot=False, discriminator='0001'):
+        self.id = snowflake() if id is None else id
+        self.name = name
+        self.bot = bot
+        self.discriminator = discriminator
+
+    @property
+    def display_name(self):
+        return self.name
+
+    @property
+    def mention(self):
+        return f'<@{self.id}>'
+
+    def __str__(self):
+        return f'{self.name}#{self.discriminator}'
+
+
+class FakeEmoji:
+    """A custom emoji belonging to a guild."""
+    def __init__(self, name, guild=None, id=None):
+        self.id = snowflake() if id is None else id
+        self.name = name
+        self.guild = guild
+
+    def __str__(self):
+        return f'<:{self.name}:{self.id}>'
+
+
+class FakeGuild:
+    """A guild with channels, members and emojis."""
+    # As if we were not sharded.
+    shard_id = None
+
+    def __init__(self, name='guild', id=None, member_count=0):
+        self.id = snowflake() if id is None else id
+        self.name = name
+        self.member_count = member_count
+        self.channels = []
+        self.members = []
+        self.emojis = []
+
+    def add_channel(self, name='general', http=None) -> 'FakeChannel':
+        channel = FakeChannel(self, name, http=http)
+        self.channels.append(channel)
+        return channel
+
+    def add_emoji(self, name) -> FakeEmoji:
+        emoji = FakeEmoji(name, self)
+        self.emojis.append(emoji)
+        return emoji
+
+    def get_channel(self, channel_id) -> typing.Optional['FakeChannel']:
+        return next((c for c in self.channels if c.id == channel_id), None)
+
+    def __str__(self):
+        return self.name
+
+
+class _Typing:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def __aenter__(self):
+        await self.channel.http.send_typing(channel_id=self.channel.id)
+
+    async def __aexit__(self, *_):
+        pass
+
+
+class FakeChannel:
+    """A text channel in a guild."""
+    def __init__(self, guild, name='general', id=None, http=None):
+        self.id = snowflake() if id is None else id
+        self.guild = guild
+        self.name = name
+        self.http = FakeHTTPClient() if http is None else http
+
+    @property
+    def mention(self):
+        return f'<#{self.id}>'
+
+    def typing(self):
+        return _Typing(self)
+
+    async def send(self, content=None, **kwargs):
+        await self.http.send_message(channel_id=self.id, content=content,
+                                     **kwargs)
+        return FakeMessage(content, None, self)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMessage:
+    """A message sent by an author to a channel."""
+    # Read by discord.ext.commands.Context.
+    _state = None
+
+    def __init__(self, content, author, channel, id=None):
+        self.id = snowflake() if id is None else id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.mentions = []
+        self.attachments = []
+        self.embeds = []
+
+    @property
+    def guild(self):
+        return getattr(self.channel, 'guild', None)
+
+    async def add_reaction(self, emoji):
+        await self.channel.http.add_reaction(
+            channel_id=self.channel.id, message_id=self.id, emoji=emoji)
+
+    async def delete(self):
+        await self.channel.http.delete_message(
+            channel_id=self.channel.id, message_id=self.id)
+
+
+def make_guilds(guild_count: int, channels_per_guild: int,
+                members_per_guild: int = 0,
+                http: FakeHTTPClient = None) -> typing.List[FakeGuild]:
+    """
+    Makes some guilds with some channels each. Every channel shares the
+    given HTTP client, so that the calls to every channel can be counted.
+    """
+    if http is None:
+        http = FakeHTTPClient()
+
+    guilds = []
+    for g in range(guild_count):
+        guild = FakeGuild(f'guild {g}', member_count=members_per_guild)
+        for c in range(channels_per_guild):
+            guild.add_channel(f'channel-{c}', http=http)
+        guild.members.extend(FakeUser(name=f'member {m}')
+                             for m in range(min(members_per_guild, 100)))
+        guilds.append(guild)
+    return guilds
+
+
+def pick_channel(guilds, rng=random) -> FakeChannel:
+    """Picks a random channel in a random guild."""
+    return rng.choice(rng.choice(guilds).channels)